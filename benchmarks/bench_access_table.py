@@ -0,0 +1,63 @@
+"""Access checks per second of the compiled prefix index against the linear access table scan.
+
+Usage: python -m benchmarks.bench_access_table --number 20000
+"""
+import argparse
+import ipaddress
+import json
+import random
+import timeit
+
+from zoxy.server import ProxyServer
+
+
+def random_access_list(rng: random.Random, rule_count: int) -> list:
+    access_list = []
+    for _ in range(rule_count):
+        network = ipaddress.ip_network((rng.getrandbits(32), rng.randint(8, 32)), strict=False)
+        access_list.append([str(network), rng.choice(["*", "80", "443", "8080"])])
+    return access_list
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", default=20000, type=int)
+    parser.add_argument("--rules", default="10,100,1000,10000,100000", type=str)
+    parser.add_argument("--max_linear_rules", default=10000, type=int, help="skip the linear scan above this size")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    proxy_server = ProxyServer(url="127.0.0.1", port=0)
+    results = []
+    try:
+        for rule_count in [int(rules) for rules in args.rules.split(",")]:
+            proxy_server.blocked_accesses = random_access_list(rng, rule_count)
+            hosts = [str(ipaddress.ip_address(rng.getrandbits(32))) for _ in range(1024)]
+            host_iter = iter(hosts * (args.number // len(hosts) + 1))
+            elapsed = min(timeit.repeat(
+                lambda: proxy_server.is_connection_blocked(next(host_iter), 80),
+                number=args.number // 5,
+                repeat=5,
+            ))
+            result = {
+                "rules": rule_count,
+                "compiled_checks_per_second": int(args.number // 5 / elapsed),
+            }
+
+            if rule_count <= args.max_linear_rules:
+                number = max(1, args.number // 5 // max(1, rule_count // 100))
+                host_iter = iter(hosts * (number // len(hosts) + 1) * 5)
+                elapsed = min(timeit.repeat(
+                    lambda: proxy_server.is_testee_in_access_table(proxy_server._blocked_accesses, next(host_iter), 80),
+                    number=number,
+                    repeat=5,
+                ))
+                result["linear_checks_per_second"] = int(number / elapsed)
+            results.append(result)
+    finally:
+        proxy_server.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compare the thread and asyncio engines with many concurrent CONNECT tunnels.
+
+Usage: python -m benchmarks.bench_engines --connections 2000 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+from .common import EchoOrigin, get_free_port, get_rss, percentile, run_proxy, sample_rss
+
+
+async def tunnel_client(proxy_port: int, origin_port: int, stop_time: float, rtts: List[float], stats: Dict[str, int]):
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        writer.write(f"CONNECT 127.0.0.1:{origin_port} HTTP/1.1\r\n\r\n".encode())
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (OSError, asyncio.IncompleteReadError):
+        stats["failed"] += 1
+        return
+    if head.split(b" ", 2)[1:2] != [b"200"]:
+        # e.g. 503 of a full worker queue
+        stats["failed"] += 1
+        writer.close()
+        return
+    stats["established"] += 1
+    try:
+        while time.monotonic() < stop_time:
+            start = time.monotonic()
+            writer.write(b"ping")
+            await reader.readexactly(4)
+            rtts.append(time.monotonic() - start)
+            await asyncio.sleep(0.2)
+    except (OSError, asyncio.IncompleteReadError):
+        stats["dropped"] += 1
+    writer.close()
+
+
+async def run_engine(engine: str, connections: int, duration: float) -> dict:
+    origin = EchoOrigin()
+    await origin.start()
+    proxy_port = get_free_port()
+    # every tunnel holds a worker thread of the thread engine for the whole run
+    proxy_args = ["-p", str(proxy_port), "--engine", engine, "--max_workers", str(max(connections * 2, 64))]
+    with run_proxy(proxy_args) as proxy_process:
+        await asyncio.sleep(0.5)
+        base_rss = get_rss(proxy_process.pid)
+        stop_time = time.monotonic() + duration
+        rtts = [] # type: List[float]
+        rss_samples = [] # type: List[int]
+        stats = {"established": 0, "failed": 0, "dropped": 0}
+        await asyncio.gather(
+            sample_rss(proxy_process.pid, stop_time, rss_samples),
+            *[tunnel_client(proxy_port, origin.port, stop_time, rtts, stats) for _ in range(connections)]
+        )
+    origin.close()
+    peak_rss = max(rss_samples + [base_rss])
+    return {
+        "engine": engine,
+        "connections": connections,
+        "established": stats["established"],
+        "failed": stats["failed"],
+        "dropped": stats["dropped"],
+        "round_trips": len(rtts),
+        "rtt_p50_ms": percentile(rtts, 0.50) * 1000,
+        "rtt_p99_ms": percentile(rtts, 0.99) * 1000,
+        "base_rss_bytes": base_rss,
+        "peak_rss_bytes": peak_rss,
+        "rss_per_connection_bytes": (peak_rss - base_rss) // max(1, stats["established"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", default=1000, type=int)
+    parser.add_argument("--duration", default=10, type=float)
+    parser.add_argument("--engine", action="append", choices=["thread", "asyncio"], default=[])
+    args = parser.parse_args()
+
+    results = []
+    for engine in args.engine or ["thread", "asyncio"]:
+        results.append(asyncio.run(run_engine(engine, args.connections, args.duration)))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Forwarding lookups per second of the compiled first-match table against the linear rule scan.
+
+Usage: python -m benchmarks.bench_forwarding_table --number 20000
+"""
+import argparse
+import ipaddress
+import json
+import logging
+import random
+import timeit
+
+from zoxy.server import ProxyServer
+
+
+def random_forwarding(rng: random.Random, rule_count: int) -> list:
+    forwarding = []
+    for _ in range(rule_count):
+        network = ipaddress.ip_network((rng.getrandbits(32), rng.randint(8, 32)), strict=False)
+        forwarding.append([str(network), rng.choice(["*", "80", "443"]), "127.0.0.1", rng.choice(["*", "8000"])])
+    forwarding.append(["0.0.0.0/0", "*", "127.0.0.2", "*"])
+    return forwarding
+
+
+def linear_forwarding_dest(forwarding_list: list, dest_ip: str, dest_port: int):
+    # the scan get_forwarding_dest did before the compiled table
+    dest_ip_address = ipaddress.ip_network(dest_ip)
+    for forwarding in forwarding_list.copy():
+        if forwarding["original_ip"].supernet_of(dest_ip_address) and (
+            forwarding["original_port"] == "*" or str(dest_port) == forwarding["original_port"]
+        ):
+            return forwarding["destination_ip"], forwarding["destination_port"]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", default=20000, type=int)
+    parser.add_argument("--rules", default="10,100,1000,10000", type=str)
+    args = parser.parse_args()
+
+    # every lookup matches a rule and logs it, measure the lookup
+    logging.disable(logging.INFO)
+    rng = random.Random(0)
+    proxy_server = ProxyServer(url="127.0.0.1", port=0)
+    results = []
+    try:
+        for rule_count in [int(rules) for rules in args.rules.split(",")]:
+            proxy_server.forwarding = random_forwarding(rng, rule_count)
+            hosts = [str(ipaddress.ip_address(rng.getrandbits(32))) for _ in range(1024)]
+            host_iter = iter(hosts * (args.number // len(hosts) + 1))
+            elapsed = min(timeit.repeat(
+                lambda: proxy_server.get_forwarding_dest("test.org", 80, next(host_iter)),
+                number=args.number // 5,
+                repeat=5,
+            ))
+            compiled = int(args.number // 5 / elapsed)
+
+            number = max(1, args.number // 5 // max(1, rule_count // 10))
+            host_iter = iter(hosts * (number // len(hosts) + 1) * 5)
+            elapsed = min(timeit.repeat(
+                lambda: linear_forwarding_dest(proxy_server._forwarding_list, next(host_iter), 80),
+                number=number,
+                repeat=5,
+            ))
+            results.append({
+                "rules": rule_count,
+                "compiled_lookups_per_second": compiled,
+                "linear_lookups_per_second": int(number / elapsed),
+            })
+    finally:
+        proxy_server.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
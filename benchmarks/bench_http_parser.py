@@ -0,0 +1,104 @@
+"""Parses per second of the incremental HTTPParser against the previous split based parser.
+
+Usage: python -m benchmarks.bench_http_parser --number 20000
+"""
+import argparse
+import json
+import timeit
+
+from zoxy.http import HTTPParser, HTTPRequestReader, http_request_parse
+
+BROWSER_GET = (
+    b"GET http://www.example.org/static/app.js?v=3 HTTP/1.1\r\n"
+    b"Host: www.example.org\r\n"
+    b"Proxy-Connection: keep-alive\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36\r\n"
+    b"Accept: */*\r\n"
+    b"Referer: http://www.example.org/index.html\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Accept-Language: en-US,en;q=0.9,zh-TW;q=0.8\r\n"
+    b"Cookie: session=0123456789abcdef; theme=dark; _ga=GA1.2.1234567890.1234567890\r\n"
+    b"If-None-Match: \"5f8e-5bf0e1c2d3a40\"\r\n"
+    b"If-Modified-Since: Mon, 05 Apr 2021 13:49:57 GMT\r\n"
+    b"\r\n"
+)
+
+BROWSER_POST = (
+    b"POST http://api.example.org/v1/events HTTP/1.1\r\n"
+    b"Host: api.example.org\r\n"
+    b"Proxy-Connection: keep-alive\r\n"
+    b"Content-Length: 38\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:88.0) Gecko/20100101 Firefox/88.0\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Accept: application/json\r\n"
+    b"Origin: http://www.example.org\r\n"
+    b"Referer: http://www.example.org/index.html\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"\r\n"
+    b'{"event": "click", "target": "button"}'
+)
+
+
+class Header:
+    pass
+
+
+# the split based parser this package used before HTTPParser
+def legacy_http_request_parse(request):
+    header = Header()
+    request_block = request.split(b"\r\n")
+    request_block.reverse()
+    start_line = request_block.pop().decode(errors="ignore")
+    method, request_target, http_version = start_line.split(" ")
+    header_field = request_block.pop().decode(errors="ignore")
+    while header_field != "":
+        field_name, field_value = header_field.split(": ")
+        header.__setattr__(field_name, field_value)
+        header_field = request_block.pop().decode(errors="ignore")
+    body = request_block.pop()
+    return method, request_target, http_version, header, body
+
+
+def parse_with_headers(request):
+    http_request = http_request_parse(request)
+    return http_request.header["Host"]
+
+
+def parse_head(request):
+    parser = HTTPParser()
+    parser.feed(request)
+    return parser
+
+
+def read_request(request):
+    request_reader = HTTPRequestReader()
+    request_reader.feed(request)
+    return request_reader.pop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", default=20000, type=int)
+    args = parser.parse_args()
+
+    results = []
+    for name, request in [("browser_get", BROWSER_GET), ("browser_post", BROWSER_POST)]:
+        for parser_name, parse in [
+            ("legacy_http_request_parse", legacy_http_request_parse),
+            ("http_request_parse", http_request_parse),
+            ("http_request_parse with header", parse_with_headers),
+            ("HTTPParser.feed", parse_head),
+            ("HTTPRequestReader.feed", read_request),
+        ]:
+            elapsed = min(timeit.repeat(lambda: parse(request), number=args.number, repeat=5))
+            results.append({
+                "request": name,
+                "parser": parser_name,
+                "parses_per_second": int(args.number / elapsed),
+            })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
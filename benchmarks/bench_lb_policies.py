@@ -0,0 +1,72 @@
+"""Simulated request latency per load-balancing policy when one backend degrades.
+
+Usage: python -m benchmarks.bench_lb_policies --requests 50000
+"""
+import argparse
+import heapq
+import json
+import random
+
+from zoxy.balancing import BALANCING_POLICIES, BackendLease
+
+from .common import percentile
+
+
+def simulate(policy_name: str, args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    now = [0.0]
+    backend_count = args.backends
+    policy = BALANCING_POLICIES[policy_name]([1 / backend_count] * backend_count, clock=lambda: now[0])
+
+    # backend 0 gets slow for the middle half of the run
+    slow_start = args.requests / args.rate / 4
+    slow_end = slow_start * 3
+
+    events = [] # type: list
+    latencies = []
+    arrival_time = 0.0
+    for request_index in range(args.requests):
+        arrival_time += rng.expovariate(args.rate)
+        heapq.heappush(events, (arrival_time, request_index, None, 0.0))
+
+    while events:
+        event_time, request_index, lease, latency = heapq.heappop(events)
+        now[0] = event_time
+        if lease is None:
+            backend_index = policy.select()
+            lease = BackendLease(policy, backend_index)
+            service_time = rng.expovariate(1 / args.service_time)
+            if backend_index == 0 and slow_start <= event_time < slow_end:
+                service_time *= args.slowdown
+            # a busy backend gets slower
+            latency = service_time * (1 + policy.active[backend_index] / args.backend_concurrency)
+            heapq.heappush(events, (event_time + latency, request_index, lease, latency))
+        else:
+            lease.on_latency(latency)
+            lease.close()
+            latencies.append(latency)
+
+    return {
+        "policy": policy_name,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "p999_ms": round(percentile(latencies, 0.999) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", default=50000, type=int)
+    parser.add_argument("--rate", default=2000, type=float, help="requests per second")
+    parser.add_argument("--backends", default=4, type=int)
+    parser.add_argument("--service_time", default=0.01, type=float, help="mean seconds per request")
+    parser.add_argument("--backend_concurrency", default=8, type=int)
+    parser.add_argument("--slowdown", default=10, type=float, help="service time factor of the degraded backend")
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+
+    print(json.dumps([simulate(policy_name, args) for policy_name in BALANCING_POLICIES], indent=2))
+
+
+if __name__ == "__main__":
+    main()
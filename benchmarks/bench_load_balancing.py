@@ -0,0 +1,88 @@
+"""Backend selections per second with many threads, the lock-free schedule against the locked distribute_backend scan.
+
+Usage: python -m benchmarks.bench_load_balancing --threads 64 --duration 3
+"""
+import argparse
+import ipaddress
+import json
+import logging
+import threading
+import time
+from typing import Callable
+
+from zoxy.balancing import distribute_backend
+from zoxy.server import ProxyServer
+
+
+def run_threads(select: Callable[[], None], thread_count: int, duration: float) -> int:
+    start = threading.Event()
+    stop = threading.Event()
+    counts = [0] * thread_count
+
+    def worker(index: int):
+        start.wait()
+        count = 0
+        while not stop.is_set():
+            select()
+            count += 1
+        counts[index] = count
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", default=64, type=int)
+    parser.add_argument("--duration", default=3, type=float)
+    parser.add_argument("--backends", default=8, type=int)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    backend = [["127.0.0.1", str(9000 + index), str(100 // args.backends)] for index in range(args.backends)]
+    proxy_server = ProxyServer(
+        url="127.0.0.1",
+        port=0,
+        load_balancing={"frontend": ["127.0.0.1/32", "8080"], "backend": backend},
+    )
+
+    # what every request did before: take the global condition lock, check the frontend and scan the backends
+    lb_condition_lock = threading.Condition()
+    frontend = ipaddress.ip_network("127.0.0.1/32")
+    backend_access_count = [0] * args.backends
+    backend_access_rate = [int(backend_setting[2]) / 100 for backend_setting in backend]
+
+    def locked_select():
+        with lb_condition_lock:
+            if frontend.supernet_of(ipaddress.ip_network("127.0.0.1")) and "8080" == str(8080):
+                backend_index = distribute_backend(list(backend_access_count), list(backend_access_rate))
+                backend_access_count[backend_index] += 1
+            lb_condition_lock.notify()
+
+    def lock_free_select():
+        proxy_server.get_load_balancing_dest("127.0.0.1", 8080, "127.0.0.1")
+
+    results = []
+    try:
+        for name, select in [("locked distribute_backend", locked_select), ("lock-free schedule", lock_free_select)]:
+            selections = run_threads(select, args.threads, args.duration)
+            results.append({
+                "selector": name,
+                "threads": args.threads,
+                "backends": args.backends,
+                "selections_per_second": int(selections / args.duration),
+            })
+    finally:
+        proxy_server.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
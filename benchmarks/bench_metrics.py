@@ -0,0 +1,54 @@
+"""Nanoseconds per metric recording, single-threaded and with threads recording at once.
+
+Usage: python -m benchmarks.bench_metrics --number 200000 --threads 8
+"""
+import argparse
+import json
+import threading
+import time
+
+from zoxy.metrics import ProxyMetrics
+
+
+def record(metrics: ProxyMetrics, number: int):
+    backend_selections = metrics.backend_selections
+    for _ in range(number):
+        metrics.client_bytes_received.inc(1024)
+        metrics.upstream_connect_seconds.observe(0.003)
+        backend_selections.labels("127.0.0.1:9090").inc()
+
+
+def run(threads: int, number: int) -> dict:
+    metrics = ProxyMetrics()
+    workers = [threading.Thread(target=record, args=(metrics, number)) for _ in range(threads)]
+    start_time = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start_time
+    recordings = threads * number * 3
+    return {
+        "threads": threads,
+        "ns_per_recording": round(elapsed / recordings * 1e9, 1),
+        "render_ms": round(render_time(metrics) * 1000, 3),
+    }
+
+
+def render_time(metrics: ProxyMetrics) -> float:
+    start_time = time.perf_counter()
+    metrics.registry.render()
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", default=200000, type=int, help="recordings of each metric per thread")
+    parser.add_argument("--threads", default=8, type=int)
+    args = parser.parse_args()
+
+    print(json.dumps([run(1, args.number), run(args.threads, args.number // args.threads)], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Load test of a proxy process on loopback: plain GET, POST bodies and CONNECT tunnels, per routing configuration.
+
+Every configuration runs in a proxy process of its own, clients and origins share this process.
+A request is one GET or POST with its response, or one round trip of --tunnel_chunk bytes in a tunnel.
+Usage: python -m benchmarks.bench_proxy --concurrency 64 --duration 5 --config plain --config load_balancing
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+from .common import EchoOrigin, HTTPOrigin, get_content_length, get_free_port, get_rss, percentile, run_proxy, sample_rss
+
+CONFIGS = ("plain", "access", "forwarding", "load_balancing")
+# requests to this address only reach an origin through a forwarding or load balancing rule
+ROUTED_IP = "127.0.0.2"
+ROUTED_PORT = 8081
+
+
+def get_proxy_args(config: str, origins: List[HTTPOrigin], rules: int) -> List[str]:
+    # rules that never match come first, like a real table the request has to get through
+    filler = [f"10.{index // 256 % 256}.{index % 256}.0/24" for index in range(rules)]
+    if config == "access":
+        args = []
+        for network in filler:
+            args += ["--allowed_access", network, "80", "--blocked_access", network, "443"]
+        return args + ["--allowed_access", "127.0.0.0/8", "*"]
+    if config == "forwarding":
+        args = []
+        for network in filler:
+            args += ["--forwarding", network, "80", "127.0.0.1", "80"]
+        return args + ["--forwarding", f"{ROUTED_IP}/32", str(ROUTED_PORT), "127.0.0.1", str(origins[0].port)]
+    if config == "load_balancing":
+        args = ["--lb_frontend", f"{ROUTED_IP}/32", str(ROUTED_PORT)]
+        for origin in origins:
+            args += ["--lb_backend", "127.0.0.1", str(origin.port), str(100 // len(origins))]
+        return args
+    return []
+
+
+def get_target(config: str, origins: List[HTTPOrigin]) -> str:
+    if config in ("forwarding", "load_balancing"):
+        return f"{ROUTED_IP}:{ROUTED_PORT}"
+    return f"127.0.0.1:{origins[0].port}"
+
+
+async def http_client(proxy_port: int, target: str, body_len: int, stop_time: float, latencies: List[float], stats: Dict[str, int]):
+    if body_len:
+        request = f"POST http://{target}/ HTTP/1.1\r\nHost: {target}\r\nContent-Length: {body_len}\r\n\r\n".encode() + b"x" * body_len
+    else:
+        request = f"GET http://{target}/ HTTP/1.1\r\nHost: {target}\r\n\r\n".encode()
+    writer = None
+    while time.monotonic() < stop_time:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+            start = time.monotonic()
+            writer.write(request)
+            header = await reader.readuntil(b"\r\n\r\n")
+            body = await reader.readexactly(get_content_length(header))
+            latencies.append(time.monotonic() - start)
+            if not header.startswith(b"HTTP/1.1 200"):
+                stats["errors"] += 1
+            stats["bytes"] += len(request) + len(header) + len(body)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            # the proxy closed a keep-alive connection, e.g. after its max requests
+            stats["reconnects"] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def tunnel_client(proxy_port: int, target: str, chunk_len: int, stop_time: float, latencies: List[float], stats: Dict[str, int]):
+    chunk = b"x" * chunk_len
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+        writer.write(f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n\r\n".encode())
+        header = await reader.readuntil(b"\r\n\r\n")
+    except (OSError, asyncio.IncompleteReadError):
+        stats["errors"] += 1
+        return
+    if not header.startswith(b"HTTP/1.1 200"):
+        stats["errors"] += 1
+        writer.close()
+        return
+    try:
+        while time.monotonic() < stop_time:
+            start = time.monotonic()
+            writer.write(chunk)
+            await reader.readexactly(chunk_len)
+            latencies.append(time.monotonic() - start)
+            stats["bytes"] += chunk_len * 2
+    except (OSError, asyncio.IncompleteReadError):
+        stats["errors"] += 1
+    writer.close()
+
+
+async def run_config(config: str, args: argparse.Namespace) -> List[dict]:
+    origins = [HTTPOrigin(b"x" * args.response_len) for _ in range(2)]
+    echo_origins = [EchoOrigin() for _ in range(2)]
+    for origin in origins + echo_origins:
+        await origin.start()
+
+    workloads = [("get", 0)] + [(f"post_{body_len}", body_len) for body_len in args.post_len] + [("connect", args.tunnel_chunk)]
+    results = []
+    proxy_port = get_free_port()
+    proxy_args = ["-p", str(proxy_port), "--engine", args.engine, "--max_workers", str(max(args.concurrency * 2, 64))]
+    try:
+        for workload, size in workloads:
+            if args.workload and workload.split("_")[0] not in args.workload:
+                continue
+            # tunnels go to the echo origins through the same rules
+            routed_origins = echo_origins if workload == "connect" else origins
+            with run_proxy(proxy_args + get_proxy_args(config, routed_origins, args.rules)) as proxy_process:
+                await asyncio.sleep(0.5)
+                target = get_target(config, routed_origins)
+                latencies = [] # type: List[float]
+                rss_samples = [get_rss(proxy_process.pid)]
+                stats = {"bytes": 0, "errors": 0, "reconnects": 0}
+                start_time = time.monotonic()
+                stop_time = start_time + args.duration
+                client = tunnel_client if workload == "connect" else http_client
+                await asyncio.gather(
+                    sample_rss(proxy_process.pid, stop_time, rss_samples),
+                    *[client(proxy_port, target, size, stop_time, latencies, stats) for _ in range(args.concurrency)]
+                )
+                elapsed = time.monotonic() - start_time
+            results.append({
+                "config": config,
+                "workload": workload,
+                "engine": args.engine,
+                "concurrency": args.concurrency,
+                "requests": len(latencies),
+                "requests_per_second": round(len(latencies) / elapsed, 1),
+                "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+                "p999_ms": round(percentile(latencies, 0.999) * 1000, 3),
+                "mb_per_second": round(stats["bytes"] / elapsed / 1e6, 2),
+                "errors": stats["errors"],
+                "reconnects": stats["reconnects"],
+                "peak_rss_bytes": max(rss_samples),
+            })
+    finally:
+        for origin in origins + echo_origins:
+            origin.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", action="append", choices=CONFIGS, default=[])
+    parser.add_argument("--workload", action="append", choices=["get", "post", "connect"], default=[])
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--concurrency", default=64, type=int, help="client connections at once")
+    parser.add_argument("--duration", default=5, type=float, help="seconds per config and workload")
+    parser.add_argument("--post_len", default="1024,65536,1048576", type=lambda value: [int(size) for size in value.split(",")], help="POST body sizes")
+    parser.add_argument("--response_len", default=1024, type=int)
+    parser.add_argument("--tunnel_chunk", default=16384, type=int, help="bytes per tunnel round trip")
+    parser.add_argument("--rules", default=100, type=int, help="non-matching rules before the matching one")
+    args = parser.parse_args()
+
+    results = []
+    for config in args.config or CONFIGS:
+        results += asyncio.run(run_config(config, args))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""CPU and peak RSS of many concurrent relayed streams: recv into new bytes, a fixed 1 MiB recv_into buffer, adaptive buffers.
+
+Every variant runs in its own process, RSS is the peak over the process's RSS before the streams started.
+Usage: python -m benchmarks.bench_relay_buffers --streams 200 --stream_kib 4096
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import socket
+import threading
+import time
+from typing import Callable, Optional
+
+from zoxy.relay import AdaptiveBufferSize, Channel, Relay
+
+
+class FixedChannel(Channel):
+    def __init__(self, name: str, reader: socket.socket, writer: socket.socket, on_data: Optional[Callable[[bytes], None]] = None, buffer_len: int = 65536):
+        super().__init__(name, reader, writer, on_data, buffer_len)
+        self.buffer_size = AdaptiveBufferSize(min_len=buffer_len, max_len=buffer_len)
+        self.drained()
+
+
+class FixedRelay(Relay):
+    channel_class = FixedChannel
+
+
+class BytesChannel(Channel):
+    def __init__(self, name: str, reader: socket.socket, writer: socket.socket, on_data: Optional[Callable[[bytes], None]] = None, buffer_len: int = 65536):
+        super().__init__(name, reader, writer, on_data, 0)
+        self.max_pending_len = buffer_len
+        self.pending = bytearray()
+
+    @property
+    def pending_len(self) -> int:
+        return len(self.pending)
+
+    def has_room(self) -> bool:
+        return len(self.pending) < self.max_pending_len
+
+
+class BytesRelay(Relay):
+    # what the relay did before: a new bytes object of up to recv_len per recv, appended to a pending bytearray
+    channel_class = BytesChannel
+
+    def _recv(self, channel: BytesChannel) -> bool: # type: ignore[override]
+        try:
+            data = channel.reader.recv(self.recv_len)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        if not data:
+            channel.eof = True
+            return True
+        channel.pending += data
+        return True
+
+    def _send(self, channel: BytesChannel) -> bool: # type: ignore[override]
+        try:
+            with memoryview(channel.pending) as pending_view:
+                sent = channel.writer.send(pending_view)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        del channel.pending[:sent]
+        channel.transferred_len += sent
+        return True
+
+
+RELAYS = {
+    "recv bytes": BytesRelay,
+    "fixed recv_into": FixedRelay,
+    "adaptive recv_into": Relay,
+}
+
+
+def run_stream(relay_class: type, stream_len: int, chunk: bytes):
+    client_socket, src_socket = socket.socketpair()
+    dest_socket, origin_socket = socket.socketpair()
+    relay = relay_class(src_socket, dest_socket, recv_len=1024 * 1024, max_pending_len=1024 * 1024, idle_timeout=30)
+    relay_thread = threading.Thread(target=relay.run)
+    relay_thread.start()
+
+    def send():
+        for _ in range(stream_len // len(chunk)):
+            client_socket.sendall(chunk)
+        client_socket.shutdown(socket.SHUT_WR)
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    while origin_socket.recv(65536):
+        pass
+    origin_socket.shutdown(socket.SHUT_WR)
+    sender.join()
+    relay_thread.join()
+    for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+        sock.close()
+
+
+def run_variant(name: str, args: argparse.Namespace, results: "multiprocessing.Queue"):
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    chunk = b"x" * (args.chunk_kib * 1024)
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    streams = [
+        threading.Thread(target=run_stream, args=(RELAYS[name], args.stream_kib * 1024, chunk))
+        for _ in range(args.streams)
+    ]
+    for stream in streams:
+        stream.start()
+    for stream in streams:
+        stream.join()
+    results.put({
+        "relay": name,
+        "streams": args.streams,
+        "mib": args.streams * args.stream_kib // 1024,
+        "seconds": round(time.perf_counter() - start_time, 3),
+        "cpu_seconds": round(time.process_time() - start_cpu, 3),
+        # ru_maxrss is KiB on Linux
+        "peak_rss_growth_mib": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024, 1),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", default=200, type=int)
+    parser.add_argument("--stream_kib", default=4096, type=int)
+    parser.add_argument("--chunk_kib", default=16, type=int, help="size of every write of a stream's client")
+    args = parser.parse_args()
+
+    results = []
+    for name in RELAYS:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_variant, args=(name, args, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
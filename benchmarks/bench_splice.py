@@ -0,0 +1,81 @@
+"""Loopback throughput and relay CPU per GiB of a CONNECT tunnel, os.splice against copying through Python.
+
+The client and origin run in their own processes, the CPU time is the relay's alone.
+Usage: python -m benchmarks.bench_splice --size 2048
+"""
+import argparse
+import json
+import multiprocessing
+import socket
+import time
+
+from zoxy.relay import SPLICE_SUPPORTED, Relay, SpliceRelay
+
+
+def send_payload(port: int, size: int):
+    chunk = b"x" * (1024 * 1024)
+    with socket.create_connection(("127.0.0.1", port)) as client_socket:
+        for _ in range(size):
+            client_socket.sendall(chunk)
+        client_socket.shutdown(socket.SHUT_WR)
+        client_socket.recv(1)
+
+
+def sink_payload(listener: socket.socket):
+    origin_socket, _ = listener.accept()
+    with origin_socket:
+        while origin_socket.recv(1024 * 1024):
+            pass
+        origin_socket.shutdown(socket.SHUT_WR)
+
+
+def listen() -> socket.socket:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    return listener
+
+
+def run_relay(relay_class: type, size: int) -> dict:
+    proxy_listener = listen()
+    origin_listener = listen()
+    sink = multiprocessing.Process(target=sink_payload, args=(origin_listener,))
+    sink.start()
+    source = multiprocessing.Process(target=send_payload, args=(proxy_listener.getsockname()[1], size))
+    source.start()
+
+    src_socket, _ = proxy_listener.accept()
+    dest_socket = socket.create_connection(origin_listener.getsockname())
+    relay = relay_class(src_socket, dest_socket, recv_len=1024 * 1024, max_pending_len=1024 * 1024, idle_timeout=10)
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    relay.run()
+    cpu = time.process_time() - start_cpu
+    elapsed = time.perf_counter() - start_time
+
+    for sock in [src_socket, dest_socket, proxy_listener, origin_listener]:
+        sock.close()
+    source.join(10)
+    sink.join(10)
+    gib = relay.s_to_d.transferred_len / 1024 ** 3
+    return {
+        "relay": relay_class.__name__,
+        "gib": round(gib, 3),
+        "gib_per_second": round(gib / elapsed, 3),
+        "cpu_seconds_per_gib": round(cpu / gib, 3) if gib else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default=2048, type=int, help="MiB sent through the tunnel")
+    args = parser.parse_args()
+
+    relay_classes = [Relay] # type: list
+    if SPLICE_SUPPORTED:
+        relay_classes.append(SpliceRelay)
+    print(json.dumps([run_relay(relay_class, args.size) for relay_class in relay_classes], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Plain HTTP requests per second through the proxy with 1, 2, 4 ... worker processes.
+
+Client load runs in its own processes, so on a machine with N cores expect scaling up to about N / 2 workers.
+Usage: python -m benchmarks.bench_workers --workers 1,2,4 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+from .common import HTTPOrigin, get_free_port, run_proxy
+
+
+async def http_client(proxy_port: int, origin_port: int, stop_time: float) -> int:
+    request = f"GET http://127.0.0.1:{origin_port}/ HTTP/1.1\r\nHost: 127.0.0.1:{origin_port}\r\n\r\n".encode()
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+    except OSError:
+        return 0
+    count = 0
+    try:
+        while time.monotonic() < stop_time:
+            writer.write(request)
+            header = await reader.readuntil(b"\r\n\r\n")
+            content_length = int(header.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+            await reader.readexactly(content_length)
+            count += 1
+    except (OSError, asyncio.IncompleteReadError, IndexError, ValueError):
+        pass
+    writer.close()
+    return count
+
+
+async def run_clients(proxy_port: int, origin_port: int, connections: int, duration: float) -> int:
+    stop_time = time.monotonic() + duration
+    counts = await asyncio.gather(*[http_client(proxy_port, origin_port, stop_time) for _ in range(connections)])
+    return sum(counts)
+
+
+def client_process(proxy_port: int, origin_port: int, connections: int, duration: float, results: "multiprocessing.Queue"):
+    results.put(asyncio.run(run_clients(proxy_port, origin_port, connections, duration)))
+
+
+def origin_process(port_queue: "multiprocessing.Queue"):
+    async def serve():
+        origin = HTTPOrigin()
+        await origin.start()
+        port_queue.put(origin.port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def run_workers(workers: int, args: argparse.Namespace, origin_port: int) -> dict:
+    proxy_port = get_free_port()
+    with run_proxy(["-p", str(proxy_port), "--workers", str(workers), "--engine", args.engine]):
+        # every worker has to be listening, not only the first
+        time.sleep(1)
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(
+                target=client_process,
+                args=(proxy_port, origin_port, args.connections // args.client_processes, args.duration, results),
+            )
+            for _ in range(args.client_processes)
+        ]
+        for client in clients:
+            client.start()
+        requests = sum(results.get() for _ in clients)
+        for client in clients:
+            client.join()
+    return {
+        "workers": workers,
+        "engine": args.engine,
+        "connections": args.connections,
+        "requests_per_second": int(requests / args.duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4", type=str)
+    parser.add_argument("--duration", default=10, type=float)
+    parser.add_argument("--connections", default=64, type=int)
+    parser.add_argument("--client_processes", default=max(1, (os.cpu_count() or 2) // 2), type=int)
+    parser.add_argument("--engine", default="thread", choices=["thread", "asyncio"])
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    origin = multiprocessing.Process(target=origin_process, args=(port_queue,), daemon=True)
+    origin.start()
+    origin_port = port_queue.get()
+    try:
+        results = [run_workers(int(workers), args, origin_port) for workers in args.workers.split(",")]
+    finally:
+        origin.terminate()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
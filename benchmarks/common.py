@@ -0,0 +1,121 @@
+import asyncio
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Iterator, List, Optional
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe_socket:
+        probe_socket.bind(("127.0.0.1", 0))
+        return probe_socket.getsockname()[1]
+
+
+def get_rss(pid: int) -> int:
+    # Linux only, returns bytes
+    try:
+        with open(f"/proc/{pid}/status", "r") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values: List[float], rate: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * rate))
+    return values[index]
+
+
+def get_content_length(header: bytes) -> int:
+    for line in header.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            return int(value)
+    return 0
+
+
+async def sample_rss(pid: int, stop_time: float, samples: List[int]):
+    while time.monotonic() < stop_time:
+        samples.append(get_rss(pid))
+        await asyncio.sleep(0.1)
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Port {port} is not ready")
+
+
+@contextlib.contextmanager
+def run_proxy(args: List[str]) -> Iterator[subprocess.Popen]:
+    port = int(args[args.index("-p") + 1])
+    proxy_process = subprocess.Popen(
+        [sys.executable, "-m", "zoxy", "-u", "127.0.0.1"] + args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    try:
+        wait_for_port(port)
+        yield proxy_process
+    finally:
+        proxy_process.terminate()
+        proxy_process.wait(10)
+
+
+class EchoOrigin:
+    def __init__(self):
+        self.port = get_free_port()
+        self.server = None # type: Optional[asyncio.AbstractServer]
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.echo, "127.0.0.1", self.port, backlog=4096)
+
+    async def echo(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (OSError, asyncio.CancelledError):
+            pass
+        writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+class HTTPOrigin(EchoOrigin):
+    # answers every request with a fixed body, keeping the connection open
+    def __init__(self, body: bytes = b"ok"):
+        super().__init__()
+        self.response = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+
+    async def echo(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readuntil(b"\r\n\r\n")
+                content_length = get_content_length(header)
+                if content_length:
+                    await reader.readexactly(content_length)
+                writer.write(self.response)
+                await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.CancelledError):
+            pass
+        writer.close()
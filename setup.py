@@ -31,4 +31,9 @@ setuptools.setup(
         ],
     },
     install_requires=requirements,
+    extras_require={
+        "yaml": ["PyYAML"],
+        "toml": ["tomli ; python_version<\"3.11\""],
+        "h2": ["h2"],
+    },
 )
\ No newline at end of file
@@ -60,12 +60,12 @@ class ProxyServerAccessTest(unittest.TestCase):
             checker_allowed_accesses[ipaddress.ip_network(ip)].append(str(port))
         self.proxy_server.allowed_accesses = allowed_access_list
         self.assertDictEqual(self.proxy_server._allowed_accesses, checker_allowed_accesses)
-        self.assertTrue(self.proxy_server._ProxyServer__enable_allowed_access)
+        self.assertTrue(self.proxy_server.routing.allowed_accesses)
 
         # Clear
         self.proxy_server.allowed_accesses = []
         self.assertDictEqual(self.proxy_server._allowed_accesses, {})
-        self.assertFalse(self.proxy_server._ProxyServer__enable_allowed_access)
+        self.assertFalse(self.proxy_server.routing.allowed_accesses)
 
     def test_get_blocked_accesses(self):
         self.assertListEqual(self.proxy_server.blocked_accesses, self.config["blocked_accesses"])
@@ -77,12 +77,12 @@ class ProxyServerAccessTest(unittest.TestCase):
             checker_blocked_accesses[ipaddress.ip_network(ip)].append(str(port))
         self.proxy_server.blocked_accesses = blocked_access_list
         self.assertDictEqual(self.proxy_server._blocked_accesses, checker_blocked_accesses)
-        self.assertTrue(self.proxy_server._ProxyServer__enable_blocked_access)
+        self.assertTrue(self.proxy_server.routing.blocked_accesses)
 
         # Clear
         self.proxy_server.blocked_accesses = []
         self.assertDictEqual(self.proxy_server._blocked_accesses, {})
-        self.assertFalse(self.proxy_server._ProxyServer__enable_blocked_access)
+        self.assertFalse(self.proxy_server.routing.blocked_accesses)
 
     def test_is_testee_in_access_table(self):
         access_list = [
@@ -188,4 +188,13 @@ class ProxyServerAccessTest(unittest.TestCase):
         result = self.proxy_server.is_connection_blocked("111.0.0.1", 1234)
         self.assertTrue(result)
         result = self.proxy_server.is_connection_blocked("111.0.0.50", 1111)
-        self.assertTrue(result)
\ No newline at end of file
+        self.assertTrue(result)
+
+    def test_is_connection_blocked_ipv6(self):
+        self.proxy_server.blocked_accesses = [
+            ["2001:db8::/32", "*"],
+            ["192.0.0.0/24", "*"],
+        ]
+        self.assertTrue(self.proxy_server.is_connection_blocked("2001:db8::1", 1234))
+        self.assertFalse(self.proxy_server.is_connection_blocked("2001:db9::1", 1234))
+        self.assertTrue(self.proxy_server.is_connection_blocked("192.0.0.1", 1234))
@@ -0,0 +1,113 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from zoxy.admission import ConnectionLimiter, ConnectionWorkerPool
+
+
+class ConnectionLimiterTest(unittest.TestCase):
+    def test_max_connections(self):
+        limiter = ConnectionLimiter(max_connections=2)
+        self.assertIsNone(limiter.admit("127.0.0.1"))
+        self.assertIsNone(limiter.admit("127.0.0.2"))
+        self.assertEqual(limiter.admit("127.0.0.3"), "max_connections")
+        limiter.release("127.0.0.1")
+        self.assertIsNone(limiter.admit("127.0.0.3"))
+        self.assertEqual(limiter.connections, 2)
+        self.assertEqual(limiter.rejected, 1)
+
+    def test_max_connections_per_ip(self):
+        limiter = ConnectionLimiter(max_connections_per_ip=1)
+        self.assertIsNone(limiter.admit("127.0.0.1"))
+        self.assertEqual(limiter.admit("127.0.0.1"), "max_connections_per_ip")
+        self.assertIsNone(limiter.admit("127.0.0.2"))
+        limiter.release("127.0.0.1")
+        self.assertEqual(limiter.connections_of("127.0.0.1"), 0)
+        self.assertIsNone(limiter.admit("127.0.0.1"))
+
+    def test_unlimited(self):
+        limiter = ConnectionLimiter()
+        for _ in range(100):
+            self.assertIsNone(limiter.admit("127.0.0.1"))
+        self.assertEqual(limiter.connections_of("127.0.0.1"), 100)
+
+
+class ConnectionWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = threading.Semaphore(0)
+        self.handled = []
+        self.rejected = []
+
+    def tearDown(self):
+        self.release.set()
+
+    def handler(self, client_socket, client_address):
+        self.started.release()
+        self.release.wait(5)
+        self.handled.append(client_address)
+
+    def on_reject(self, client_socket, client_address):
+        self.rejected.append(client_address)
+
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_queue_when_workers_busy(self):
+        pool = ConnectionWorkerPool(self.handler, self.on_reject, max_workers=2, max_queue=1)
+        self.addCleanup(pool.shutdown)
+        for port in range(3):
+            self.assertTrue(pool.submit(Mock(), ("127.0.0.1", port)))
+        for _ in range(2):
+            self.assertTrue(self.started.acquire(timeout=5))
+        self.assertEqual(pool.workers, 2)
+        self.assertEqual(pool.active, 2)
+        self.assertEqual(pool.queued, 1)
+        # the queue is full
+        self.assertFalse(pool.submit(Mock(), ("127.0.0.1", 3)))
+        self.assertEqual(pool.rejected, 1)
+
+        self.release.set()
+        self.wait_until(lambda: len(self.handled) == 3)
+        self.wait_until(lambda: pool.active == 0)
+        self.assertEqual(pool.queued, 0)
+        self.assertEqual(pool.workers, 2)
+
+    def test_reject_when_workers_busy(self):
+        pool = ConnectionWorkerPool(self.handler, self.on_reject, max_workers=1, overload_policy="reject")
+        self.addCleanup(pool.shutdown)
+        self.assertTrue(pool.submit(Mock(), ("127.0.0.1", 0)))
+        self.assertTrue(self.started.acquire(timeout=5))
+        self.assertFalse(pool.submit(Mock(), ("127.0.0.1", 1)))
+
+    def test_queue_timeout(self):
+        pool = ConnectionWorkerPool(self.handler, self.on_reject, max_workers=1, queue_timeout=0.05)
+        self.addCleanup(pool.shutdown)
+        self.assertTrue(pool.submit(Mock(), ("127.0.0.1", 0)))
+        self.assertTrue(pool.submit(Mock(), ("127.0.0.1", 1)))
+        self.assertTrue(self.started.acquire(timeout=5))
+        time.sleep(0.1)
+        self.release.set()
+        self.wait_until(lambda: self.rejected == [("127.0.0.1", 1)])
+        self.wait_until(lambda: self.handled == [("127.0.0.1", 0)])
+        self.assertEqual(pool.queue_timeouts, 1)
+
+    def test_queue_timeout_with_workers_busy(self):
+        pool = ConnectionWorkerPool(self.handler, self.on_reject, max_workers=1, queue_timeout=0.05)
+        self.addCleanup(pool.shutdown)
+        self.assertTrue(pool.submit(Mock(), ("127.0.0.1", 0)))
+        self.assertTrue(self.started.acquire(timeout=5))
+        self.assertTrue(pool.submit(Mock(), ("127.0.0.1", 1)))
+        # rejected while the only worker is still busy
+        self.wait_until(lambda: self.rejected == [("127.0.0.1", 1)])
+        self.assertEqual(self.handled, [])
+        self.assertEqual(pool.queued, 0)
+        self.assertEqual(pool.queue_timeouts, 1)
+
+    def test_unknown_overload_policy(self):
+        with self.assertRaises(ValueError):
+            ConnectionWorkerPool(self.handler, self.on_reject, overload_policy="drop")
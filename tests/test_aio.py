@@ -0,0 +1,175 @@
+import asyncio
+import socket
+import threading
+import time
+import unittest
+
+from zoxy.aio import AsyncProxyServer
+
+
+class EchoServer:
+    def __init__(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # ProxyServer sets a global default timeout, accept should still block
+        self.server_socket.settimeout(None)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.listen(10)
+        self.port = self.server_socket.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                client_socket, _ = self.server_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.echo, args=(client_socket,), daemon=True).start()
+
+    def echo(self, client_socket: socket.socket):
+        client_socket.settimeout(5)
+        try:
+            while True:
+                data = client_socket.recv(65536)
+                if not data:
+                    break
+                client_socket.sendall(data)
+        except OSError:
+            pass
+        client_socket.close()
+
+    def close(self):
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server_socket.close()
+
+
+class SinkServer(EchoServer):
+    # read and never answer
+    def echo(self, client_socket: socket.socket):
+        client_socket.settimeout(5)
+        try:
+            while client_socket.recv(65536):
+                pass
+        except OSError:
+            pass
+        client_socket.close()
+
+
+class HTTPOrigin(EchoServer):
+    # answer every GET with its request target as the body
+    def echo(self, client_socket: socket.socket):
+        client_socket.settimeout(5)
+        data = b""
+        try:
+            while True:
+                while b"\r\n\r\n" not in data:
+                    chunk = client_socket.recv(65536)
+                    if not chunk:
+                        raise ConnectionError()
+                    data += chunk
+                head, _, data = data.partition(b"\r\n\r\n")
+                body = head.split(b" ")[1]
+                client_socket.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        except OSError:
+            pass
+        client_socket.close()
+
+
+class AsyncProxyServerTest(unittest.TestCase):
+    def setUp(self):
+        self.echo_server = EchoServer()
+        self.http_origin = HTTPOrigin()
+        self.config = {
+            "url": "127.0.0.1",
+            "port": 0,
+            "blocked_accesses": [
+                ["192.0.0.0/24", "*"],
+            ],
+        }
+        self.proxy_server = AsyncProxyServer(**self.config)
+        self.proxy_port = self.proxy_server.server_socket.getsockname()[1]
+        self.proxy_thread = threading.Thread(target=lambda: asyncio.run(self.proxy_server.serve()), daemon=True)
+        self.proxy_thread.start()
+        # wait for the loop to take the listening socket, closing before that would race with serve
+        deadline = time.monotonic() + 5
+        while self.proxy_server._AsyncProxyServer__server is None and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def tearDown(self):
+        self.proxy_server.close()
+        self.proxy_thread.join(5)
+        self.echo_server.close()
+        self.http_origin.close()
+
+    def test_property_api(self):
+        self.assertListEqual(self.proxy_server.blocked_accesses, self.config["blocked_accesses"])
+        self.proxy_server.forwarding = [["0.0.0.0/0", "*", "127.0.0.2", "*"]]
+        self.assertListEqual(self.proxy_server.forwarding, [["0.0.0.0/0", "*", "127.0.0.2", "*"]])
+
+    def test_connect_tunnel(self):
+        client_socket = socket.create_connection(("127.0.0.1", self.proxy_port), timeout=5)
+        client_socket.sendall(f"CONNECT 127.0.0.1:{self.echo_server.port} HTTP/1.1\r\n\r\n".encode())
+        self.assertEqual(client_socket.recv(1024), b"HTTP/1.1 200 Connection established\r\n\r\n")
+        for data in [b"first", b"second"]:
+            client_socket.sendall(data)
+            self.assertEqual(client_socket.recv(1024), data)
+        client_socket.close()
+
+    def test_tunnel_idle_timeout_counts_both_directions(self):
+        self.proxy_server._AsyncProxyServer__relay_idle_timeout = 0.3
+        sink_server = SinkServer()
+        self.addCleanup(sink_server.close)
+        client_socket = socket.create_connection(("127.0.0.1", self.proxy_port), timeout=5)
+        self.addCleanup(client_socket.close)
+        client_socket.sendall(f"CONNECT 127.0.0.1:{sink_server.port} HTTP/1.1\r\n\r\n".encode())
+        self.assertEqual(client_socket.recv(1024), b"HTTP/1.1 200 Connection established\r\n\r\n")
+        # an upload keeps the tunnel open although nothing comes back
+        for _ in range(6):
+            client_socket.sendall(b"data")
+            time.sleep(0.1)
+        client_socket.settimeout(0.1)
+        with self.assertRaises(socket.timeout):
+            client_socket.recv(1024)
+        client_socket.settimeout(5)
+        self.assertEqual(client_socket.recv(1024), b"")
+
+    def test_plain_http(self):
+        client_socket = socket.create_connection(("127.0.0.1", self.proxy_port), timeout=5)
+        request = (
+            f"GET http://127.0.0.1:{self.http_origin.port}/ HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{self.http_origin.port}\r\n"
+            "\r\n"
+        ).encode()
+        client_socket.sendall(request)
+        response = b""
+        while not response.endswith(b"/"):
+            response += client_socket.recv(1024)
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+        client_socket.close()
+
+    def test_keep_alive_pipelining(self):
+        client_socket = socket.create_connection(("127.0.0.1", self.proxy_port), timeout=5)
+        targets = [f"http://127.0.0.1:{self.http_origin.port}/{path}".encode() for path in ["first", "second"]]
+        client_socket.sendall(b"".join(
+            b"GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n" % target for target in targets
+        ))
+        expected = b"".join(
+            b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(target), target) for target in targets
+        )
+        response = b""
+        while len(response) < len(expected):
+            data = client_socket.recv(1024)
+            if not data:
+                break
+            response += data
+        self.assertEqual(response, expected)
+        client_socket.close()
+
+    def test_blocked_client(self):
+        self.proxy_server.blocked_accesses = [["127.0.0.0/24", "*"]]
+        client_socket = socket.create_connection(("127.0.0.1", self.proxy_port), timeout=5)
+        self.assertEqual(client_socket.recv(1024), b"")
+        client_socket.close()
@@ -0,0 +1,177 @@
+import math
+import threading
+import unittest
+from collections import Counter
+
+from zoxy.balancing import (
+    BackendLease,
+    ConsistentHashPolicy,
+    LeastConnectionsPolicy,
+    PeakEWMAPolicy,
+    PowerOfTwoChoicesPolicy,
+    RatePolicy,
+    WeightedSchedule,
+    distribute_backend,
+    get_balancing_policy,
+    get_schedule,
+)
+
+
+class WeightedScheduleTest(unittest.TestCase):
+    def test_schedule_follows_distribute_backend(self):
+        backend_access_rate = [0.5, 0.3, 0.2]
+        backend_access_count = [0, 0, 0]
+        expected = []
+        for _ in range(30):
+            backend_index = distribute_backend(backend_access_count, backend_access_rate)
+            backend_access_count[backend_index] += 1
+            expected.append(backend_index)
+        weighted_schedule = WeightedSchedule(backend_access_rate)
+        self.assertEqual(len(weighted_schedule), 10)
+        self.assertListEqual([weighted_schedule.select() for _ in range(30)], expected)
+
+    def test_schedule_period(self):
+        self.assertListEqual(get_schedule([0.8, 0.2]), [0, 1, 0, 0, 0])
+        self.assertEqual(Counter(get_schedule([0.33, 0.33, 0.34])), {0: 33, 1: 33, 2: 34})
+        self.assertListEqual(get_schedule([]), [])
+
+    def test_concurrent_select(self):
+        weighted_schedule = WeightedSchedule([0.7, 0.2, 0.1])
+        counts = Counter()
+        lock = threading.Lock()
+
+        def select():
+            local_counts = Counter(weighted_schedule.select() for _ in range(1000))
+            with lock:
+                counts.update(local_counts)
+
+        threads = [threading.Thread(target=select) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every selection took its own slot of the schedule
+        self.assertEqual(counts, {0: 11200, 1: 3200, 2: 1600})
+
+
+class BalancingPolicyTest(unittest.TestCase):
+    def test_get_balancing_policy(self):
+        self.assertIsInstance(get_balancing_policy("rate", [0.5, 0.5]), RatePolicy)
+        self.assertIsInstance(get_balancing_policy("least_conn", [0.5, 0.5]), LeastConnectionsPolicy)
+        with self.assertRaises(ValueError):
+            get_balancing_policy("random", [0.5, 0.5])
+
+    def test_least_connections(self):
+        policy = LeastConnectionsPolicy([0.5, 0.5])
+        first = BackendLease(policy, policy.select())
+        second = BackendLease(policy, policy.select())
+        self.assertNotEqual(first.backend_index, second.backend_index)
+        first.close()
+        first.close()
+        self.assertEqual(policy.active[first.backend_index], 0)
+        self.assertEqual(policy.select(), first.backend_index)
+
+    def test_least_connections_weighted(self):
+        policy = LeastConnectionsPolicy([0.75, 0.25])
+        leases = [BackendLease(policy, policy.select()) for _ in range(8)]
+        self.assertEqual(Counter(lease.backend_index for lease in leases), {0: 6, 1: 2})
+
+    def test_peak_ewma(self):
+        now = [0.0]
+        policy = PeakEWMAPolicy([0.5, 0.5], clock=lambda: now[0], decay_time=10)
+        policy.on_latency(0, 0.5)
+        policy.on_latency(1, 0.01)
+        self.assertEqual(policy.select(), 1)
+        # a peak counts at once
+        policy.on_latency(1, 1.0)
+        self.assertEqual(policy.ewma[1], 1.0)
+        self.assertEqual(policy.select(), 0)
+        # fast samples decay it back
+        for _ in range(10):
+            now[0] += 10
+            policy.on_latency(0, 0.5)
+            policy.on_latency(1, 0.01)
+        self.assertLess(policy.ewma[1], 0.5)
+        self.assertEqual(policy.select(), 1)
+
+    def test_peak_ewma_decays_without_samples(self):
+        now = [0.0]
+        policy = PeakEWMAPolicy([0.5, 0.5], clock=lambda: now[0], decay_time=10, default_latency=0.01)
+        policy.on_latency(0, 1.0)
+        policy.on_latency(1, 0.1)
+        BackendLease(policy, 1)
+        self.assertEqual(policy.select(), 1)
+        # backend 0 gets no requests and so no samples, its peak still fades
+        now[0] += 10
+        self.assertAlmostEqual(policy.latency(0), 0.01 + 0.99 / math.e)
+        self.assertEqual(policy.select(), 1)
+        now[0] += 50
+        self.assertEqual(policy.select(), 0)
+
+    def test_power_of_two_choices(self):
+        policy = PowerOfTwoChoicesPolicy([0.5, 0.5])
+        for _ in range(10):
+            BackendLease(policy, 0)
+        # whenever both backends are drawn the idle one wins
+        self.assertGreater(Counter(policy.select() for _ in range(1000))[1], 700)
+
+    def test_skip_unavailable_backend(self):
+        self.assertEqual(distribute_backend([0, 0, 0], [0.5, 0.3, 0.2], [False, True, True]), 1)
+        self.assertEqual(Counter(get_schedule([0.5, 0.3, 0.2], [False, True, True])), {1: 3, 2: 2})
+        # nothing available schedules every backend
+        self.assertEqual(Counter(get_schedule([0.5, 0.5], [False, False])), {0: 1, 1: 1})
+
+        for policy_class in [RatePolicy, LeastConnectionsPolicy, PeakEWMAPolicy, PowerOfTwoChoicesPolicy]:
+            policy = policy_class([0.25, 0.25, 0.5])
+            policy.set_available(2, False)
+            # open leases spread least_conn and p2c over every candidate
+            leases = [BackendLease(policy, policy.select()) for _ in range(100)]
+            self.assertNotIn(2, {lease.backend_index for lease in leases}, policy.name)
+            policy.set_available(0, False)
+            self.assertSetEqual({policy.select() for _ in range(100)}, {1}, policy.name)
+            policy.set_available(1, False)
+            # nothing available falls back to every backend
+            leases = [BackendLease(policy, policy.select()) for _ in range(100)]
+            self.assertIn(2, {lease.backend_index for lease in leases}, policy.name)
+
+
+class ConsistentHashPolicyTest(unittest.TestCase):
+    backend_names = ["10.0.0.1:80", "10.0.0.2:80", "10.0.0.3:80", "10.0.0.4:80"]
+    keys = [f"192.168.{index // 256}.{index % 256}" for index in range(4000)]
+
+    def test_same_key_same_backend(self):
+        policy = ConsistentHashPolicy([0.25] * 4, backend_names=self.backend_names)
+        other_policy = ConsistentHashPolicy([0.25] * 4, backend_names=self.backend_names)
+        for key in self.keys[:100]:
+            self.assertEqual(policy.select(key), policy.select(key))
+            self.assertEqual(policy.select(key), other_policy.select(key))
+
+    def test_weighted(self):
+        policy = ConsistentHashPolicy([0.5, 0.2, 0.2, 0.1], backend_names=self.backend_names)
+        counts = Counter(policy.select(key) for key in self.keys)
+        for backend_index, access_rate in enumerate([0.5, 0.2, 0.2, 0.1]):
+            self.assertAlmostEqual(counts[backend_index] / len(self.keys), access_rate, delta=0.06)
+
+    def test_add_backend_moves_few_keys(self):
+        policy = ConsistentHashPolicy([0.25] * 4, backend_names=self.backend_names)
+        bigger_policy = ConsistentHashPolicy([0.2] * 5, backend_names=self.backend_names + ["10.0.0.5:80"])
+        moved = [key for key in self.keys if policy.select(key) != bigger_policy.select(key)]
+        # only keys now owned by the new backend move
+        self.assertSetEqual({bigger_policy.select(key) for key in moved}, {4})
+        self.assertLess(len(moved) / len(self.keys), 0.3)
+
+    def test_unavailable_backend_moves_only_its_keys(self):
+        policy = ConsistentHashPolicy([0.25] * 4, backend_names=self.backend_names)
+        before = {key: policy.select(key) for key in self.keys}
+        policy.set_available(1, False)
+        for key, backend_index in before.items():
+            if backend_index == 1:
+                self.assertNotEqual(policy.select(key), 1)
+            else:
+                self.assertEqual(policy.select(key), backend_index)
+
+    def test_without_key(self):
+        policy = ConsistentHashPolicy([0.8, 0.2], backend_names=self.backend_names[:2])
+        self.assertListEqual([policy.select() for _ in range(5)], [0, 1, 0, 0, 0])
+        policy.set_available(0, False)
+        self.assertSetEqual({policy.select() for _ in range(5)}, {1})
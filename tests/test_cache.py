@@ -0,0 +1,224 @@
+import tempfile
+import threading
+import unittest
+
+from zoxy.cache import HTTPCache, get_freshness_lifetime, parse_cache_control
+from zoxy.http import HTTPHeaders, HTTPParser
+
+URL = "http://test.org/index"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def get_parser(head: bytes) -> HTTPParser:
+    parser = HTTPParser(is_response=True, request_method="GET")
+    parser.feed(head)
+    return parser
+
+
+def fetch(lookup, head: bytes, body: bytes = b"") -> bool:
+    # what ProxyServer.pipe_response does with a response, returns whether it went to the client
+    forward = lookup.on_head(get_parser(head))
+    lookup.on_body(body)
+    lookup.on_end(True)
+    return forward
+
+
+class CachePolicyTest(unittest.TestCase):
+    def test_parse_cache_control(self):
+        self.assertEqual(
+            parse_cache_control(["public, max-age=60", "No-Cache, s-maxage=\"30\""]),
+            {"public": None, "max-age": "60", "no-cache": None, "s-maxage": "30"},
+        )
+
+    def test_freshness_lifetime(self):
+        now = 784111777.0
+        headers = HTTPHeaders([("Date", "Sun, 06 Nov 1994 08:49:37 GMT"), ("Expires", "Sun, 06 Nov 1994 08:50:37 GMT")])
+        self.assertEqual(get_freshness_lifetime(headers, {}, "200", now), 60)
+        self.assertEqual(get_freshness_lifetime(headers, {"max-age": "10"}, "200", now), 10)
+        self.assertEqual(get_freshness_lifetime(headers, {"max-age": "10", "s-maxage": "20"}, "200", now), 20)
+        headers["Expires"] = "0"
+        self.assertEqual(get_freshness_lifetime(headers, {}, "200", now), 0)
+        # a tenth of the time since Last-Modified
+        headers = HTTPHeaders([("Date", "Sun, 06 Nov 1994 08:49:37 GMT"), ("Last-Modified", "Sun, 06 Nov 1994 08:32:57 GMT")])
+        self.assertEqual(get_freshness_lifetime(headers, {}, "200", now), 100)
+
+
+class HTTPCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = HTTPCache(clock=self.clock)
+        self.headers = HTTPHeaders([("Host", "test.org")])
+
+    def test_hit_and_expire(self):
+        lookup = self.cache.open("GET", URL, self.headers)
+        self.assertFalse(lookup.fresh)
+        with lookup:
+            self.assertTrue(fetch(lookup, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nConnection: close\r\nContent-Length: 4\r\n\r\n", b"test"))
+
+        self.clock.now += 10
+        with self.cache.open("GET", URL, self.headers) as lookup:
+            self.assertTrue(lookup.fresh)
+            head, body = lookup.get_response(keep_alive=True)
+            # fields of the origin connection are not stored
+            self.assertEqual(head, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 4\r\nAge: 10\r\n\r\n")
+            self.assertEqual(body, b"test")
+
+        self.clock.now += 60
+        with self.cache.open("GET", URL, self.headers) as lookup:
+            self.assertFalse(lookup.fresh)
+        self.assertEqual(self.cache.stats["hits"], 1)
+        self.assertEqual(self.cache.stats["misses"], 2)
+
+    def test_not_stored(self):
+        responses = [
+            b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\nContent-Length: 0\r\n\r\n",
+            b"HTTP/1.1 200 OK\r\nCache-Control: private, max-age=60\r\nContent-Length: 0\r\n\r\n",
+            b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nVary: *\r\nContent-Length: 0\r\n\r\n",
+            # nothing says how long it is fresh, and no validator
+            b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n",
+            b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n",
+        ]
+        for response in responses:
+            with self.cache.open("GET", URL, self.headers) as lookup:
+                fetch(lookup, response)
+            self.assertEqual(self.cache.stats["stores"], 0, response)
+        for method, headers in [("POST", self.headers), ("GET", HTTPHeaders([("Authorization", "Basic eA==")]))]:
+            self.assertIsNone(self.cache.open(method, URL, headers))
+
+    def test_request_cache_control(self):
+        with self.cache.open("GET", URL, self.headers) as lookup:
+            fetch(lookup, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 0\r\n\r\n")
+        self.clock.now += 10
+        with self.cache.open("GET", URL, HTTPHeaders([("Cache-Control", "no-cache")])) as lookup:
+            self.assertFalse(lookup.fresh)
+        with self.cache.open("GET", URL, HTTPHeaders([("Cache-Control", "max-age=5")])) as lookup:
+            self.assertFalse(lookup.fresh)
+        self.assertIsNone(self.cache.open("GET", URL, HTTPHeaders([("Cache-Control", "no-store")])))
+
+    def test_vary(self):
+        for encoding in ["gzip", "br"]:
+            headers = HTTPHeaders([("Accept-Encoding", encoding)])
+            with self.cache.open("GET", URL, headers) as lookup:
+                self.assertFalse(lookup.fresh)
+                fetch(lookup, f"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nVary: Accept-Encoding\r\nContent-Encoding: {encoding}\r\nContent-Length: 0\r\n\r\n".encode())
+        for encoding in ["gzip", "br"]:
+            with self.cache.open("GET", URL, HTTPHeaders([("Accept-Encoding", encoding)])) as lookup:
+                self.assertTrue(lookup.fresh)
+                self.assertIn(f"Content-Encoding: {encoding}".encode(), lookup.get_response(True)[0])
+
+        # an unsafe request drops every stored response of the url
+        self.assertIsNone(self.cache.open("POST", URL, self.headers))
+        with self.cache.open("GET", URL, HTTPHeaders([("Accept-Encoding", "gzip")])) as lookup:
+            self.assertFalse(lookup.fresh)
+
+    def test_revalidate(self):
+        with self.cache.open("GET", URL, self.headers) as lookup:
+            fetch(lookup, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=10\r\nETag: \"v1\"\r\nContent-Length: 4\r\n\r\n", b"test")
+        self.clock.now += 20
+
+        request = b"GET http://test.org/index HTTP/1.1\r\nHost: test.org\r\n\r\n"
+        with self.cache.open("GET", URL, self.headers) as lookup:
+            self.assertFalse(lookup.fresh)
+            self.assertEqual(
+                lookup.get_upstream_request(request, len(request)),
+                b"GET http://test.org/index HTTP/1.1\r\nHost: test.org\r\nIf-None-Match: \"v1\"\r\n\r\n",
+            )
+            # the 304 answers the cache, not the client
+            self.assertFalse(fetch(lookup, b"HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=30\r\nETag: \"v1\"\r\n\r\n"))
+            self.assertTrue(lookup.not_modified)
+            head, body = lookup.get_response(keep_alive=False)
+            self.assertEqual(head, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=30\r\nETag: \"v1\"\r\nContent-Length: 4\r\nAge: 0\r\nConnection: close\r\n\r\n")
+            self.assertEqual(body, b"test")
+
+        self.clock.now += 20
+        with self.cache.open("GET", URL, HTTPHeaders([("If-None-Match", "W/\"v1\"")])) as lookup:
+            self.assertTrue(lookup.fresh)
+            head, body = lookup.get_response(keep_alive=True)
+            self.assertEqual(head, b"HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=30\r\nETag: \"v1\"\r\nAge: 20\r\n\r\n")
+            self.assertEqual(body, b"")
+        self.assertEqual(self.cache.stats["revalidations"], 1)
+
+    def test_memory_eviction(self):
+        cache = HTTPCache(max_memory_bytes=300, clock=self.clock)
+        for index in range(4):
+            with cache.open("GET", f"{URL}{index}", self.headers) as lookup:
+                fetch(lookup, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 50\r\n\r\n", b"x" * 50)
+        stats = cache.stats
+        self.assertLessEqual(stats["memory_bytes"], 300)
+        self.assertEqual(stats["memory_entries"] + stats["evictions"], 4)
+        with cache.open("GET", f"{URL}0", self.headers) as lookup:
+            self.assertFalse(lookup.fresh)
+        with cache.open("GET", f"{URL}3", self.headers) as lookup:
+            self.assertTrue(lookup.fresh)
+
+    def test_disk_tier(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = HTTPCache(max_memory_bytes=300, disk_directory=directory.name, max_disk_bytes=10000, clock=self.clock)
+        for index in range(4):
+            with cache.open("GET", f"{URL}{index}", self.headers) as lookup:
+                fetch(lookup, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 50\r\n\r\n", b"x" * 50)
+        stats = cache.stats
+        # entries pushed out of memory moved to disk
+        self.assertGreater(stats["disk_entries"], 0)
+        self.assertEqual(stats["memory_entries"] + stats["disk_entries"], 4)
+        self.assertEqual(stats["evictions"], 0)
+        for index in range(4):
+            with cache.open("GET", f"{URL}{index}", self.headers) as lookup:
+                self.assertTrue(lookup.fresh)
+                head, body = lookup.get_response(keep_alive=True)
+                self.assertEqual(bytes(body), b"x" * 50)
+                body.release()
+
+        # large responses go to disk at once
+        with cache.open("GET", f"{URL}large", self.headers) as lookup:
+            fetch(lookup, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 1000\r\n\r\n", b"x" * 1000)
+        self.assertEqual(cache.stats["disk_entries"], stats["disk_entries"] + 1)
+
+    def test_collapse_misses(self):
+        leader = self.cache.open("GET", URL, self.headers)
+        results = []
+
+        def follow():
+            with self.cache.open("GET", URL, self.headers) as lookup:
+                results.append(lookup.fresh)
+
+        followers = [threading.Thread(target=follow) for _ in range(4)]
+        for follower in followers:
+            follower.start()
+        # the followers wait for the fetch of the leader, then hit what it stored
+        with leader:
+            fetch(leader, b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 0\r\n\r\n")
+        for follower in followers:
+            follower.join(5)
+        self.assertEqual(results, [True] * 4)
+        self.assertEqual(self.cache.stats["misses"], 1)
+
+    def test_uncacheable_response_ends_collapse(self):
+        cache = HTTPCache(fill_timeout=5, clock=self.clock)
+        leader = cache.open("GET", URL, self.headers)
+        self.addCleanup(leader.close)
+        leader.on_head(get_parser(b"HTTP/1.1 200 OK\r\nCache-Control: no-store\r\nContent-Length: 4\r\n\r\n"))
+        # the leader still pipes its body, the next miss does not wait for it
+        follower_done = threading.Event()
+
+        def follow():
+            cache.open("GET", URL, self.headers).close()
+            follower_done.set()
+
+        threading.Thread(target=follow, daemon=True).start()
+        self.assertTrue(follower_done.wait(1))
+
+        large = cache.open("GET", URL, self.headers)
+        self.addCleanup(large.close)
+        large.on_head(get_parser(b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 4\r\n\r\n"))
+        self.assertIsNotNone(large.fill)
+        large.on_body(b"x" * (cache.max_entry_bytes + 1))
+        self.assertIsNone(large.fill)
@@ -0,0 +1,26 @@
+import unittest
+
+from zoxy.capture import ResponseRingBuffer
+
+
+class ResponseRingBufferTest(unittest.TestCase):
+    def test_keep_latest_bytes(self):
+        ring_buffer = ResponseRingBuffer(max_len=10)
+        ring_buffer(("127.0.0.1", 8000), b"12345")
+        ring_buffer(("127.0.0.2", 8000), b"abcde")
+        self.assertEqual(ring_buffer.getvalue(), b"12345abcde")
+        self.assertEqual(len(ring_buffer), 10)
+
+        ring_buffer(("127.0.0.1", 8000), b"fgh")
+        self.assertEqual(ring_buffer.getvalue(), b"abcdefgh")
+        self.assertEqual(ring_buffer.getvalue(("127.0.0.1", 8000)), b"fgh")
+        self.assertLessEqual(len(ring_buffer), 10)
+
+    def test_chunk_larger_than_max_len(self):
+        ring_buffer = ResponseRingBuffer(max_len=4)
+        ring_buffer(("127.0.0.1", 8000), b"0123456789")
+        self.assertEqual(ring_buffer.getvalue(), b"6789")
+
+        ring_buffer.clear()
+        self.assertEqual(ring_buffer.getvalue(), b"")
+        self.assertEqual(len(ring_buffer), 0)
@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+from zoxy.coalesce import FanoutBuffer, FanoutLagError, FanoutSink, RequestCoalescer, get_coalescing_key
+from zoxy.http import HTTPHeaders
+
+
+class FanoutBufferTest(unittest.TestCase):
+    def test_readers_read_whole_stream(self):
+        buffer = FanoutBuffer(max_buffer_len=100, max_lag_len=100)
+        first_reader = buffer.subscribe()
+        buffer.append(b"abc")
+        self.assertEqual(first_reader.read(1), b"abc")
+        # a reader joining later starts at the beginning too
+        second_reader = buffer.subscribe()
+        buffer.append(b"def")
+        self.assertEqual(first_reader.read(1), b"def")
+        self.assertEqual(second_reader.read(1), b"abcdef")
+        buffer.finish()
+        self.assertEqual(first_reader.read(1), b"")
+        self.assertEqual(second_reader.read(1), b"")
+        self.assertIsNone(buffer.subscribe())
+
+    def test_read_waits_for_data(self):
+        buffer = FanoutBuffer()
+        reader = buffer.subscribe()
+        with self.assertRaises(TimeoutError):
+            reader.read(0.01)
+        threading.Timer(0.05, buffer.append, args=(b"late",)).start()
+        self.assertEqual(reader.read(5), b"late")
+
+    def test_slow_reader_dropped(self):
+        buffer = FanoutBuffer(max_buffer_len=10, max_lag_len=20)
+        fast_reader = buffer.subscribe()
+        slow_reader = buffer.subscribe()
+        for _ in range(4):
+            # the writer never waits for the slow reader
+            buffer.append(b"x" * 8)
+            self.assertEqual(fast_reader.read(1), b"x" * 8)
+        # past the buffer length nobody joins any more
+        self.assertFalse(buffer.joinable)
+        self.assertIsNone(buffer.subscribe())
+        with self.assertRaises(FanoutLagError):
+            slow_reader.read(1)
+        buffer.append(b"y")
+        self.assertEqual(fast_reader.read(1), b"y")
+
+
+class RequestCoalescerTest(unittest.TestCase):
+    def test_get_coalescing_key(self):
+        headers = HTTPHeaders([("Host", "test.org"), ("Accept-Encoding", "gzip")])
+        key = get_coalescing_key("GET", "HTTP/1.1", "http://test.org/", headers)
+        self.assertIsNotNone(key)
+        self.assertEqual(key, get_coalescing_key("GET", "HTTP/1.1", "http://test.org/", HTTPHeaders([("Accept-Encoding", "gzip")])))
+        self.assertNotEqual(key, get_coalescing_key("GET", "HTTP/1.1", "http://test.org/", HTTPHeaders([("Accept-Encoding", "br")])))
+        self.assertIsNone(get_coalescing_key("POST", "HTTP/1.1", "http://test.org/", headers))
+        self.assertIsNone(get_coalescing_key("GET", "HTTP/1.0", "http://test.org/", headers))
+        self.assertIsNone(get_coalescing_key("GET", "HTTP/1.1", "http://test.org/", HTTPHeaders([("Cookie", "id=1")])))
+        self.assertIsNone(get_coalescing_key("GET", "HTTP/1.1", "http://test.org/", HTTPHeaders([("If-None-Match", "\"v1\"")])))
+
+    def test_join(self):
+        coalescer = RequestCoalescer()
+        flight, reader = coalescer.join("key")
+        self.assertIsNone(reader)
+        same_flight, reader = coalescer.join("key")
+        self.assertIs(same_flight, flight)
+        self.assertIsNotNone(reader)
+        self.assertIsNone(coalescer.join("other")[1])
+        coalescer.finish("key", flight)
+        # a finished fetch is not joined
+        self.assertIsNone(coalescer.join("key")[1])
+        self.assertEqual(coalescer.stats["leaders"], 3)
+        self.assertEqual(coalescer.stats["subscribers"], 1)
+
+    def test_private_response_not_shared(self):
+        for head, shared in [
+            (b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\n", True),
+            (b"HTTP/1.1 200 OK\r\nSet-Cookie: id=1\r\nContent-Length: 4\r\n\r\n", False),
+            (b"HTTP/1.1 200 OK\r\nCache-Control: private\r\nContent-Length: 4\r\n\r\n", False),
+            (b"HTTP/1.1 200 OK\r\nCache-Control: max-age=0, no-store\r\nContent-Length: 4\r\n\r\n", False),
+        ]:
+            buffer = FanoutBuffer()
+            sink = FanoutSink(buffer)
+            # the head may arrive in pieces
+            sink.sendall(head[:10])
+            self.assertTrue(buffer.shared)
+            sink.sendall(head[10:] + b"test")
+            self.assertEqual(buffer.shared, shared, head)
+            self.assertEqual(buffer.joinable, shared, head)
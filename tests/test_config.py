@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+
+from zoxy import config
+from zoxy.config import ConfigWatcher, load_config
+
+SETTINGS = {
+    "allowed_accesses": [["127.0.0.0/24", "*"]],
+    "forwarding": [["196.168.0.0/24", "*", "127.0.0.2", "*"]],
+    "load_balancing": {
+        "frontend": ["127.0.0.1/32", "8080"],
+        "backend": [["127.0.0.1", "9090", "80"], ["127.0.0.1", "9091", "20"]],
+        "policy": "least_conn",
+    },
+}
+
+
+class LoadConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name: str, content: str) -> str:
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write(content)
+        return path
+
+    def test_load_json(self):
+        self.assertEqual(load_config(self.write("zoxy.json", json.dumps(SETTINGS))), SETTINGS)
+
+    @unittest.skipIf(config.yaml is None, "PyYAML is not installed")
+    def test_load_yaml(self):
+        path = self.write("zoxy.yaml", config.yaml.safe_dump(SETTINGS))
+        self.assertEqual(load_config(path), SETTINGS)
+
+    @unittest.skipIf(config.tomllib is None, "no TOML parser")
+    def test_load_toml(self):
+        path = self.write("zoxy.toml", (
+            'allowed_accesses = [["127.0.0.0/24", "*"]]\n'
+            'forwarding = [["196.168.0.0/24", "*", "127.0.0.2", "*"]]\n'
+            '[load_balancing]\n'
+            'frontend = ["127.0.0.1/32", "8080"]\n'
+            'backend = [["127.0.0.1", "9090", "80"], ["127.0.0.1", "9091", "20"]]\n'
+            'policy = "least_conn"\n'
+        ))
+        self.assertEqual(load_config(path), SETTINGS)
+
+    def test_load_invalid(self):
+        with self.assertRaises(ValueError):
+            load_config(self.write("zoxy.json", json.dumps({"forwarding": [], "port": 8080})))
+        with self.assertRaises(ValueError):
+            load_config(self.write("zoxy.json", json.dumps([])))
+        with self.assertRaises(ValueError):
+            load_config(self.write("zoxy.ini", ""))
+
+
+class ConfigWatcherTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "zoxy.json")
+        self.write(SETTINGS)
+        self.apply = Mock()
+
+    def write(self, settings):
+        # write and rename, like an editor saving a file
+        with open(self.path + ".tmp", "w", encoding="utf-8") as fh:
+            fh.write(json.dumps(settings) if isinstance(settings, dict) else settings)
+        os.replace(self.path + ".tmp", self.path)
+
+    def test_reload_applies_changes(self):
+        watcher = ConfigWatcher(self.path, self.apply, settings=load_config(self.path))
+        self.assertTrue(watcher.reload())
+        self.apply.assert_not_called()
+
+        self.write(dict(SETTINGS, forwarding=[]))
+        self.assertTrue(watcher.reload())
+        # only the setting that changed is applied again
+        self.apply.assert_called_once_with({"forwarding": []})
+        self.assertEqual(watcher.reloads, 2)
+
+    def test_reload_keeps_settings_on_error(self):
+        watcher = ConfigWatcher(self.path, self.apply)
+        self.write("{not json")
+        self.assertFalse(watcher.reload())
+        self.apply.side_effect = ValueError("bad rule")
+        self.write(SETTINGS)
+        self.assertFalse(watcher.reload())
+        self.assertEqual(watcher.errors, 2)
+
+        # settings that failed are applied again on the next reload
+        self.apply.side_effect = None
+        self.assertTrue(watcher.reload())
+        self.apply.assert_called_with(SETTINGS)
+
+    def test_watch_file_change(self):
+        watcher = ConfigWatcher(self.path, self.apply, interval=0.01, settings=SETTINGS)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        self.write(dict(SETTINGS, allowed_accesses=[]))
+        for _ in range(500):
+            if self.apply.called:
+                break
+            time.sleep(0.01)
+        self.apply.assert_called_once_with({"allowed_accesses": []})
+
+    def test_request_reload(self):
+        watcher = ConfigWatcher(self.path, self.apply, interval=0)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        watcher.request_reload()
+        for _ in range(500):
+            if self.apply.called:
+                break
+            time.sleep(0.01)
+        self.apply.assert_called_once_with(SETTINGS)
@@ -33,12 +33,12 @@ class ProxyServerForwardingTest(unittest.TestCase):
                 "destination_port": str(destination_port),
             })
         self.assertListEqual(self.proxy_server._forwarding_list, checker_forwarding_list)
-        self.assertTrue(self.proxy_server._ProxyServer__enable_forwarding)
+        self.assertTrue(self.proxy_server.routing.forwarding_list)
 
         # Clear
         self.proxy_server.forwarding = []
         self.assertListEqual(self.proxy_server._forwarding_list, [])
-        self.assertFalse(self.proxy_server._ProxyServer__enable_forwarding)
+        self.assertFalse(self.proxy_server.routing.forwarding_list)
 
     def test_get_forwarding_dest(self):
         forwarding_domain, forwarding_port = self.proxy_server.get_forwarding_dest("196.168.2.1", 1234)
@@ -0,0 +1,210 @@
+import socket
+import threading
+import unittest
+
+from zoxy import h2c
+from zoxy.h2c import H2cPool, get_h2_request_headers, get_http1_response_head
+from zoxy.pool import ConnectionPoolFull
+from zoxy.server import ProxyServer
+
+
+class H2cStandInServer:
+    # a local h2c server: answers every request with its method, path and body,
+    # with a Content-Length unless the path is /chunked, refuses the first refused_streams requests
+    def __init__(self, max_concurrent_streams: int = 100, refused_streams: int = 0):
+        self.max_concurrent_streams = max_concurrent_streams
+        self.refused_streams = refused_streams
+        self.connections = 0
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.listen(8)
+        self.port = self.server_socket.getsockname()[1]
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def close(self):
+        self.server_socket.close()
+
+    def __accept(self):
+        while True:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.__serve, args=(sock,), daemon=True).start()
+
+    def __serve(self, sock: socket.socket):
+        sock.settimeout(None)
+        config = h2c.h2.config.H2Configuration(client_side=False, header_encoding=None)
+        connection = h2c.h2.connection.H2Connection(config=config)
+        connection.local_settings = h2c.h2.settings.Settings(
+            client=False,
+            initial_values={h2c.h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: self.max_concurrent_streams},
+        )
+        connection.initiate_connection()
+        sock.sendall(connection.data_to_send())
+        requests = {}
+        with sock:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                for event in connection.receive_data(data):
+                    if isinstance(event, h2c.h2.events.RequestReceived) and self.refused_streams:
+                        self.refused_streams -= 1
+                        connection.reset_stream(event.stream_id, h2c.h2.errors.ErrorCodes.REFUSED_STREAM)
+                    elif isinstance(event, h2c.h2.events.RequestReceived):
+                        requests[event.stream_id] = [dict(event.headers), b""]
+                    elif isinstance(event, h2c.h2.events.DataReceived) and event.stream_id in requests:
+                        requests[event.stream_id][1] += event.data
+                        connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2c.h2.events.StreamEnded) and event.stream_id in requests:
+                        headers, body = requests.pop(event.stream_id)
+                        response_body = headers[b":method"] + b" " + headers[b":path"] + b" " + body
+                        response_headers = [(b":status", b"200"), (b"x-authority", headers[b":authority"])]
+                        if headers[b":path"] != b"/chunked":
+                            response_headers.append((b"content-length", str(len(response_body)).encode()))
+                        connection.send_headers(event.stream_id, response_headers)
+                        frame_len = connection.max_outbound_frame_size
+                        for start in range(0, len(response_body), frame_len):
+                            end = start + frame_len
+                            connection.send_data(event.stream_id, response_body[start:end], end_stream=end >= len(response_body))
+                sock.sendall(connection.data_to_send())
+
+
+class H2cTranslationTest(unittest.TestCase):
+    def test_get_h2_request_headers(self):
+        headers, body = get_h2_request_headers(
+            b"POST http://127.1.0.1:8080/path?q=1 HTTP/1.1\r\n"
+            b"Host: 127.1.0.1:8080\r\n"
+            b"Connection: keep-alive, X-Hop\r\n"
+            b"X-Hop: 1\r\n"
+            b"Content-Length: 4\r\n"
+            b"TE: gzip\r\n"
+            b"\r\n"
+            b"test"
+        )
+        self.assertEqual(headers, [
+            (b":method", b"POST"),
+            (b":scheme", b"http"),
+            (b":authority", b"127.1.0.1:8080"),
+            (b":path", b"/path?q=1"),
+            (b"content-length", b"4"),
+        ])
+        self.assertEqual(body, b"test")
+
+        headers, _ = get_h2_request_headers(b"GET / HTTP/1.1\r\nHost: test.org\r\n\r\n")
+        self.assertEqual(headers[2:4], [(b":authority", b"test.org"), (b":path", b"/")])
+
+    def test_get_http1_response_head(self):
+        head, is_chunked = get_http1_response_head([(b":status", b"200"), (b"content-length", b"4")], "GET")
+        self.assertEqual(head, b"HTTP/1.1 200 OK\r\ncontent-length: 4\r\n\r\n")
+        self.assertFalse(is_chunked)
+        # HTTP/2 needs no length, HTTP/1.1 then gets chunks
+        head, is_chunked = get_http1_response_head([(b":status", b"404")], "GET")
+        self.assertEqual(head, b"HTTP/1.1 404 Not Found\r\ntransfer-encoding: chunked\r\n\r\n")
+        self.assertTrue(is_chunked)
+        self.assertFalse(get_http1_response_head([(b":status", b"304")], "GET")[1])
+        self.assertFalse(get_http1_response_head([(b":status", b"200")], "HEAD")[1])
+
+
+@unittest.skipIf(h2c.h2 is None, "h2 is not installed")
+class H2cPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = H2cStandInServer()
+        self.addCleanup(self.server.close)
+        self.pool = H2cPool(max_connections_per_host=2, max_concurrent_streams=2, wait_timeout=0.2)
+        self.addCleanup(self.pool.clear)
+        self.connect = lambda host, port: socket.create_connection((host, port), timeout=1)
+
+    def read_response(self, stream: h2c.H2cStream) -> bytes:
+        response = b""
+        while True:
+            data = stream.recv(65536)
+            if not data:
+                return response
+            response += data
+
+    def test_streams_share_connection(self):
+        for _ in range(3):
+            stream = self.pool.open_stream("127.0.0.1", self.server.port, self.connect)
+            stream.sendall(b"POST /echo HTTP/1.1\r\nHost: test.org\r\nContent-Length: 4\r\n\r\ntest")
+            self.assertEqual(
+                self.read_response(stream),
+                b"HTTP/1.1 200 OK\r\nx-authority: test.org\r\ncontent-length: 15\r\n\r\nPOST /echo test",
+            )
+            stream.close()
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.pool.stats["streams"], 3)
+        self.assertEqual(self.pool.stats["active_streams"], 0)
+
+    def test_response_without_length_is_chunked(self):
+        stream = self.pool.open_stream("127.0.0.1", self.server.port, self.connect)
+        self.addCleanup(stream.close)
+        stream.sendall(b"GET /chunked HTTP/1.1\r\nHost: test.org\r\n\r\n")
+        self.assertEqual(
+            self.read_response(stream),
+            b"HTTP/1.1 200 OK\r\nx-authority: test.org\r\ntransfer-encoding: chunked\r\n\r\n"
+            b"d\r\nGET /chunked \r\n0\r\n\r\n",
+        )
+
+    def test_stream_limit(self):
+        streams = []
+        for _ in range(4):
+            streams.append(self.pool.open_stream("127.0.0.1", self.server.port, self.connect))
+            self.addCleanup(streams[-1].close)
+        # 2 streams per connection, 2 connections
+        self.assertEqual(self.pool.connection_count(), 2)
+        with self.assertRaises(ConnectionPoolFull):
+            self.pool.open_stream("127.0.0.1", self.server.port, self.connect)
+        streams[0].close()
+        self.pool.open_stream("127.0.0.1", self.server.port, self.connect).close()
+        self.assertEqual(self.pool.stats["connects"], 2)
+
+    def test_large_request_body_follows_flow_control(self):
+        stream = self.pool.open_stream("127.0.0.1", self.server.port, self.connect)
+        self.addCleanup(stream.close)
+        body = b"x" * (1024 * 256)
+        stream.sendall(b"PUT /large HTTP/1.1\r\nHost: test.org\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        self.assertTrue(self.read_response(stream).endswith(b"PUT /large " + body))
+
+
+@unittest.skipIf(h2c.h2 is None, "h2 is not installed")
+class H2cProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.server = H2cStandInServer()
+        self.addCleanup(self.server.close)
+        self.proxy_server = ProxyServer(
+            url="0.0.0.0",
+            port=9999,
+            forwarding=[["127.1.0.1", "*", "127.0.0.1", str(self.server.port)]],
+            h2c_pool=H2cPool(),
+        )
+        self.addCleanup(self.proxy_server.close)
+
+    def test_forwarded_requests_multiplexed(self):
+        for _ in range(3):
+            client_socket, src_socket = socket.socketpair()
+            self.addCleanup(client_socket.close)
+            client_socket.sendall(b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n")
+            client_socket.shutdown(socket.SHUT_WR)
+            self.proxy_server.proxy_thread(src_socket, ("127.0.0.1", 8000))
+            self.assertEqual(
+                client_socket.recv(1024),
+                b"HTTP/1.1 200 OK\r\nx-authority: 127.1.0.1\r\ncontent-length: 6\r\n\r\nGET / ",
+            )
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.proxy_server.h2c_pool.stats["streams"], 3)
+
+    def test_refused_stream_retried(self):
+        self.server.refused_streams = 1
+        client_socket, src_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        client_socket.sendall(b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n")
+        client_socket.shutdown(socket.SHUT_WR)
+        self.proxy_server.proxy_thread(src_socket, ("127.0.0.1", 8000))
+        self.assertEqual(
+            client_socket.recv(1024),
+            b"HTTP/1.1 200 OK\r\nx-authority: 127.1.0.1\r\ncontent-length: 6\r\n\r\nGET / ",
+        )
+        self.assertEqual(self.proxy_server.h2c_pool.stats["streams"], 2)
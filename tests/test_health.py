@@ -0,0 +1,150 @@
+import socket
+import threading
+import unittest
+from collections import Counter
+
+from zoxy.balancing import LeastConnectionsPolicy, RatePolicy
+from zoxy.health import HealthChecker, http_probe, tcp_probe
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class HealthCheckerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.policy = RatePolicy([0.5, 0.5], clock=self.clock)
+        self.health_checker = HealthChecker(
+            self.policy,
+            [("127.0.0.1", 9090), ("127.0.0.1", 9091)],
+            consecutive_errors=3,
+            ejection_time=10,
+            clock=self.clock,
+        )
+
+    def test_eject_on_connect_errors(self):
+        for _ in range(2):
+            self.health_checker.on_connect_error(0)
+        self.assertTrue(self.health_checker.is_available(0))
+        # a success in between starts counting again
+        self.health_checker.on_connect_success(0)
+        for _ in range(2):
+            self.health_checker.on_connect_error(0)
+        self.assertTrue(self.health_checker.is_available(0))
+        self.health_checker.on_connect_error(0)
+        self.assertFalse(self.health_checker.is_available(0))
+        self.assertListEqual(self.policy.available, [False, True])
+        self.assertSetEqual({self.policy.select() for _ in range(10)}, {1})
+
+    def test_readmit_after_ejection_time(self):
+        for _ in range(3):
+            self.health_checker.on_connect_error(0)
+        self.clock.now = 9
+        self.health_checker.check()
+        self.assertFalse(self.health_checker.is_available(0))
+        self.clock.now = 10
+        self.health_checker.check()
+        self.assertTrue(self.health_checker.is_available(0))
+        self.assertEqual(Counter(self.policy.select() for _ in range(10)), {0: 5, 1: 5})
+
+        # half open: one more error ejects it again, for longer
+        self.health_checker.on_connect_error(0)
+        self.assertFalse(self.health_checker.is_available(0))
+        self.clock.now = 29
+        self.health_checker.check()
+        self.assertFalse(self.health_checker.is_available(0))
+        self.clock.now = 30
+        self.health_checker.check()
+        self.assertTrue(self.health_checker.is_available(0))
+        self.assertEqual(self.health_checker.states[0]["ejections"], 2)
+
+    def test_all_backends_ejected(self):
+        for backend_index in range(2):
+            for _ in range(3):
+                self.health_checker.on_connect_error(backend_index)
+        # nothing left to fail over to, selection falls back to every backend
+        self.assertEqual(Counter(self.policy.select() for _ in range(10)), {0: 5, 1: 5})
+
+    def test_probe_thresholds(self):
+        health_checker = HealthChecker(
+            self.policy,
+            [("127.0.0.1", 9090), ("127.0.0.1", 9091)],
+            healthy_threshold=2,
+            unhealthy_threshold=3,
+            clock=self.clock,
+        )
+        for _ in range(2):
+            health_checker.on_probe(1, False)
+        self.assertTrue(health_checker.is_available(1))
+        health_checker.on_probe(1, False)
+        self.assertFalse(health_checker.is_available(1))
+        health_checker.on_probe(1, True)
+        self.assertFalse(health_checker.is_available(1))
+        health_checker.on_probe(1, True)
+        self.assertTrue(health_checker.is_available(1))
+
+    def test_check_probes_backends(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(8)
+        closed_port = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed_port.bind(("127.0.0.1", 0))
+        try:
+            policy = LeastConnectionsPolicy([0.5, 0.5, 0.5])
+            health_checker = HealthChecker(
+                policy,
+                [("127.0.0.1", listener.getsockname()[1]), ("127.0.0.1", closed_port.getsockname()[1]), ("127.0.0.1", None)],
+                probe="tcp",
+                unhealthy_threshold=1,
+                timeout=0.5,
+            )
+            health_checker.check()
+            # a "*" port backend is not probed
+            self.assertListEqual(policy.available, [True, False, True])
+        finally:
+            listener.close()
+            closed_port.close()
+
+    def test_unknown_probe(self):
+        with self.assertRaises(ValueError):
+            HealthChecker(self.policy, [("127.0.0.1", 9090)], probe="udp")
+
+
+class ProbeTest(unittest.TestCase):
+    def serve(self, response: bytes) -> int:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+
+        def handle():
+            client_socket, _ = listener.accept()
+            with client_socket:
+                client_socket.recv(1024)
+                client_socket.sendall(response)
+
+        thread = threading.Thread(target=handle, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 1)
+        return listener.getsockname()[1]
+
+    def test_tcp_probe(self):
+        port = self.serve(b"")
+        self.assertTrue(tcp_probe("127.0.0.1", port, 0.5))
+        closed_port = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed_port.bind(("127.0.0.1", 0))
+        self.addCleanup(closed_port.close)
+        self.assertFalse(tcp_probe("127.0.0.1", closed_port.getsockname()[1], 0.5))
+
+    def test_http_probe(self):
+        port = self.serve(b"HTTP/1.1 204 No Content\r\n\r\n")
+        self.assertTrue(http_probe("127.0.0.1", port, 0.5, "/healthz"))
+        port = self.serve(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n")
+        self.assertFalse(http_probe("127.0.0.1", port, 0.5))
+        port = self.serve(b"")
+        self.assertFalse(http_probe("127.0.0.1", port, 0.5))
@@ -1,6 +1,11 @@
 import unittest
 
-from zoxy.http import HTTPRequest, http_request_parse, HTTPResponse, http_response_parse
+from zoxy.http import (
+    HTTPRequest, http_request_parse, HTTPResponse, http_response_parse, HTTPRequestReader, HTTPParseError, HTTPHeaderTooLarge,
+    HTTPBodyTooLarge,
+    HTTPHeaders, HTTPParser, HTTPBodyReader,
+    FRAMING_NONE, FRAMING_CONTENT_LENGTH, FRAMING_CHUNKED, FRAMING_CLOSE,
+)
 
 class HTTPRequestTest(unittest.TestCase):
     def test_httprequest_class(self):
@@ -18,9 +23,9 @@ class HTTPRequestTest(unittest.TestCase):
         self.assertEqual(http_request.method, "POST")
         self.assertEqual(http_request.request_target, "http://test.org/")
         self.assertEqual(http_request.http_version, "HTTP/1.1")
-        self.assertEqual(http_request.header.__getattribute__("Host"), "test.org")
-        self.assertEqual(http_request.header.__getattribute__("Content-Length"), "17")
-        self.assertEqual(http_request.header.__getattribute__("Content-Type"), "application/json")
+        self.assertEqual(http_request.header["Host"], "test.org")
+        self.assertEqual(http_request.header["Content-Length"], "17")
+        self.assertEqual(http_request.header["Content-Type"], "application/json")
         self.assertEqual(http_request.body, b'{"test": "value"}')
 
     def test_http_request_parse(self):
@@ -37,9 +42,9 @@ class HTTPRequestTest(unittest.TestCase):
         self.assertEqual(http_request.method, "POST")
         self.assertEqual(http_request.request_target, "http://test.org/")
         self.assertEqual(http_request.http_version, "HTTP/1.1")
-        self.assertEqual(http_request.header.__getattribute__("Host"), "test.org")
-        self.assertEqual(http_request.header.__getattribute__("Content-Length"), "17")
-        self.assertEqual(http_request.header.__getattribute__("Content-Type"), "application/json")
+        self.assertEqual(http_request.header["Host"], "test.org")
+        self.assertEqual(http_request.header["Content-Length"], "17")
+        self.assertEqual(http_request.header["Content-Type"], "application/json")
         self.assertEqual(http_request.body, b'{"test": "value"}')
 
 
@@ -59,9 +64,9 @@ class HTTPResponseTest(unittest.TestCase):
         self.assertEqual(http_response.http_version, "HTTP/1.0")
         self.assertEqual(http_response.status_code, "200")
         self.assertEqual(http_response.status_msg, "OK")
-        self.assertEqual(http_response.header.__getattribute__("Server"), "BaseHTTP/0.6 Python/3.7.3")
-        self.assertEqual(http_response.header.__getattribute__("Date"), "Mon, 05 Apr 2021 13:49:57 GMT")
-        self.assertEqual(http_response.header.__getattribute__("Content-type"), "text/html")
+        self.assertEqual(http_response.header["Server"], "BaseHTTP/0.6 Python/3.7.3")
+        self.assertEqual(http_response.header["Date"], "Mon, 05 Apr 2021 13:49:57 GMT")
+        self.assertEqual(http_response.header["Content-type"], "text/html")
         self.assertEqual(http_response.body, b'SUCCESS')
 
     def test_http_response_parse(self):
@@ -78,7 +83,215 @@ class HTTPResponseTest(unittest.TestCase):
         self.assertEqual(http_response.http_version, "HTTP/1.0")
         self.assertEqual(http_response.status_code, "200")
         self.assertEqual(http_response.status_msg, "OK")
-        self.assertEqual(http_response.header.__getattribute__("Server"), "BaseHTTP/0.6 Python/3.7.3")
-        self.assertEqual(http_response.header.__getattribute__("Date"), "Mon, 05 Apr 2021 13:49:57 GMT")
-        self.assertEqual(http_response.header.__getattribute__("Content-type"), "text/html")
+        self.assertEqual(http_response.header["Server"], "BaseHTTP/0.6 Python/3.7.3")
+        self.assertEqual(http_response.header["Date"], "Mon, 05 Apr 2021 13:49:57 GMT")
+        self.assertEqual(http_response.header["Content-type"], "text/html")
         self.assertEqual(http_response.body, b'SUCCESS')
+
+
+class HTTPRequestReaderTest(unittest.TestCase):
+    def test_read_content_length_request(self):
+        request = (
+            b'POST http://test.org/ HTTP/1.1\r\n'
+            b'Host: test.org\r\n'
+            b'Content-Length: 17\r\n'
+            b'\r\n'
+            b'{"test": "value"}'
+        )
+        request_reader = HTTPRequestReader()
+        self.assertFalse(request_reader.feed(request[:20]))
+        self.assertFalse(request_reader.feed(request[20:-5]))
+        self.assertTrue(request_reader.feed(request[-5:] + b"GET /next"))
+        self.assertEqual(request_reader.pop(), (request, b"GET /next"))
+
+    def test_read_request_without_body(self):
+        request = b'CONNECT test.org:443 HTTP/1.1\r\nHost: test.org:443\r\n\r\n'
+        request_reader = HTTPRequestReader()
+        self.assertTrue(request_reader.feed(request + b"\x16\x03\x01"))
+        self.assertEqual(request_reader.pop(), (request, b"\x16\x03\x01"))
+
+    def test_read_chunked_request(self):
+        request = (
+            b'POST http://test.org/ HTTP/1.1\r\n'
+            b'Host: test.org\r\n'
+            b'Transfer-Encoding: chunked\r\n'
+            b'\r\n'
+            b'5\r\nhello\r\n'
+            b'7;ext=1\r\n\r\nworld\r\n'
+            b'0\r\n'
+            b'Trailer: value\r\n'
+            b'\r\n'
+        )
+        request_reader = HTTPRequestReader()
+        for index in range(len(request) - 1):
+            self.assertFalse(request_reader.feed(request[index:index + 1]))
+        self.assertTrue(request_reader.feed(request[-1:]))
+        self.assertEqual(request_reader.pop(), (request, b""))
+
+    def test_header_too_large(self):
+        request_reader = HTTPRequestReader(max_header_len=32)
+        with self.assertRaises(HTTPHeaderTooLarge):
+            request_reader.feed(b"GET / HTTP/1.1\r\nHost: " + b"a" * 32)
+
+    def test_body_too_large(self):
+        request_reader = HTTPRequestReader(max_body_len=4)
+        self.assertTrue(request_reader.feed(b"POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\ntest"))
+        # refused by its Content-Length before the body arrives
+        with self.assertRaises(HTTPBodyTooLarge):
+            HTTPRequestReader(max_body_len=4).feed(b"POST / HTTP/1.1\r\nContent-Length: 5\r\n\r\n")
+        request_reader = HTTPRequestReader(max_body_len=4)
+        request_reader.feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n")
+        with self.assertRaises(HTTPBodyTooLarge):
+            request_reader.feed(b"5\r\nhello\r\n")
+
+    def test_invalid_content_length(self):
+        request_reader = HTTPRequestReader()
+        with self.assertRaises(HTTPParseError):
+            request_reader.feed(b"POST / HTTP/1.1\r\nContent-Length: abc\r\n\r\n")
+
+
+class HTTPHeadersTest(unittest.TestCase):
+    def test_case_insensitive_multidict(self):
+        headers = HTTPHeaders([("Set-Cookie", "a=1"), ("Host", "test.org"), ("set-cookie", "b=2")])
+        self.assertEqual(headers["host"], "test.org")
+        self.assertEqual(headers["SET-COOKIE"], "a=1")
+        self.assertEqual(headers.getall("Set-Cookie"), ["a=1", "b=2"])
+        self.assertIn("HOST", headers)
+        self.assertNotIn("Content-Length", headers)
+        self.assertIsNone(headers.get("Content-Length"))
+        self.assertEqual(list(headers), ["Set-Cookie", "Host", "set-cookie"])
+
+        headers["HOST"] = "other.org"
+        del headers["Set-Cookie"]
+        self.assertEqual(headers.items(), [("HOST", "other.org")])
+        with self.assertRaises(KeyError):
+            headers["Set-Cookie"]
+
+
+class HTTPParserTest(unittest.TestCase):
+    def test_parse_in_place(self):
+        request = (
+            b'GET http://test.org/ HTTP/1.1\r\n'
+            b'Host: test.org\r\n'
+            b'Referer: http://test.org/a:b\r\n'
+            b'X-Empty:\r\n'
+            b'\r\n'
+        )
+        parser = HTTPParser()
+        self.assertEqual(parser.feed(request), len(request))
+        field_name, field_value = parser.raw_headers[1]
+        self.assertIsInstance(field_name, memoryview)
+        self.assertIs(field_name.obj, request)
+        self.assertEqual(bytes(field_value), b"http://test.org/a:b")
+        self.assertEqual(parser.headers["referer"], "http://test.org/a:b")
+        self.assertEqual(parser.headers["X-Empty"], "")
+        self.assertEqual(bytes(parser.head), request)
+        self.assertEqual(parser.framing, FRAMING_NONE)
+
+    def test_parse_split_head(self):
+        request = (
+            b'POST http://test.org/ HTTP/1.1\r\n'
+            b'Host: test.org\r\n'
+            b'Content-Length: 4\r\n'
+            b'\r\n'
+            b'body'
+        )
+        parser = HTTPParser()
+        self.assertIsNone(parser.feed(request[:30]))
+        self.assertIsNone(parser.feed(request[30:-6]))
+        self.assertEqual(parser.feed(request[-6:]), 2)
+        self.assertEqual(parser.header_len, len(request) - 4)
+        self.assertEqual(parser.method, "POST")
+        self.assertEqual(parser.headers["Host"], "test.org")
+        self.assertEqual(parser.framing, FRAMING_CONTENT_LENGTH)
+        self.assertEqual(parser.content_length, 4)
+
+    def test_response_framing(self):
+        for response, request_method, framing in [
+            (b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\n", "GET", FRAMING_CONTENT_LENGTH),
+            (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: gzip, chunked\r\n\r\n", "GET", FRAMING_CHUNKED),
+            (b"HTTP/1.0 200 OK\r\nServer: test\r\n\r\n", "GET", FRAMING_CLOSE),
+            (b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\n", "HEAD", FRAMING_NONE),
+            (b"HTTP/1.1 204 No Content\r\n\r\n", "GET", FRAMING_NONE),
+            (b"HTTP/1.1 304 Not Modified\r\nContent-Length: 3\r\n\r\n", "GET", FRAMING_NONE),
+        ]:
+            parser = HTTPParser(is_response=True, request_method=request_method)
+            parser.feed(response)
+            self.assertEqual(parser.framing, framing, response)
+
+    def test_ambiguous_request_framing(self):
+        for request in [
+            b"POST / HTTP/1.1\r\nContent-Length: 4\r\nContent-Length: 5\r\n\r\n",
+            b"POST / HTTP/1.1\r\nContent-Length: +1_0\r\n\r\n",
+            b"POST / HTTP/1.1\r\nContent-Length: 1 0\r\n\r\n",
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n",
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: xchunked\r\nContent-Length: 4\r\n\r\n",
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\nContent-Length: 4\r\n\r\n",
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked, gzip\r\n\r\n",
+        ]:
+            with self.assertRaises(HTTPParseError, msg=request):
+                HTTPParser().feed(request)
+        # the same length twice is one length
+        parser = HTTPParser()
+        parser.feed(b"POST / HTTP/1.1\r\nContent-Length: 4\r\nContent-Length: 4\r\n\r\n")
+        self.assertEqual((parser.framing, parser.content_length), (FRAMING_CONTENT_LENGTH, 4))
+        # a response without chunked last ends with the connection, whatever its length says
+        parser = HTTPParser(is_response=True)
+        parser.feed(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: gzip\r\nContent-Length: 4\r\n\r\n")
+        self.assertEqual(parser.framing, FRAMING_CLOSE)
+
+    def test_connection_tokens(self):
+        parser = HTTPParser()
+        parser.feed(b"GET / HTTP/1.1\r\nConnection: Keep-Alive, Upgrade\r\n\r\n")
+        self.assertEqual(parser.connection_tokens, ["keep-alive", "upgrade"])
+
+    def test_invalid_header(self):
+        parser = HTTPParser()
+        parser.feed(b"GET / HTTP/1.1\r\nHost: test.org\r\nno colon\r\n\r\n")
+        with self.assertRaises(HTTPParseError):
+            parser.raw_headers
+        with self.assertRaises(HTTPParseError):
+            HTTPParser().feed(b"GET / HTTP/1.1\r\nContent-Length: -1\r\n\r\n")
+        with self.assertRaises(HTTPParseError):
+            HTTPParser(is_response=True).feed(b"HTTP/1.1 abc\r\n\r\n")
+        with self.assertRaises(HTTPHeaderTooLarge):
+            HTTPParser(max_header_len=16).feed(b"GET / HTTP/1.1\r\nHost: test.org\r\n\r\n")
+
+    def test_body_with_crlf(self):
+        response = (
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Length: 12\r\n'
+            b'\r\n'
+            b'line1\r\nline2'
+        )
+        http_response = http_response_parse(response)
+        self.assertEqual(http_response.body, b"line1\r\nline2")
+
+
+class HTTPBodyReaderTest(unittest.TestCase):
+    def test_content_length(self):
+        body_reader = HTTPBodyReader(FRAMING_CONTENT_LENGTH, 5)
+        self.assertEqual(body_reader.feed(b"abc"), 3)
+        self.assertFalse(body_reader.complete)
+        self.assertEqual(body_reader.feed(b"xxdefg", 2), 2)
+        self.assertTrue(body_reader.complete)
+
+    def test_chunked(self):
+        body = b"4\r\nwiki\r\n6;name=value\r\npedia \r\n0\r\nExpires: never\r\n\r\n"
+        body_reader = HTTPBodyReader(FRAMING_CHUNKED)
+        self.assertEqual(body_reader.feed(body[:9]), 9)
+        self.assertFalse(body_reader.complete)
+        self.assertEqual(body_reader.feed(body[9:] + b"next"), len(body) - 9)
+        self.assertTrue(body_reader.complete)
+
+    def test_invalid_chunk_size(self):
+        for size_line in (b"0x4", b"+4", b"4_0", b"-4", b"", b"g"):
+            with self.assertRaises(HTTPParseError, msg=size_line):
+                HTTPBodyReader(FRAMING_CHUNKED).feed(size_line + b"\r\nwiki\r\n0\r\n\r\n")
+
+    def test_close_delimited(self):
+        body_reader = HTTPBodyReader(FRAMING_CLOSE)
+        self.assertEqual(body_reader.feed(b"abc"), 3)
+        self.assertFalse(body_reader.complete)
+        body_reader.feed_eof()
+        self.assertTrue(body_reader.complete)
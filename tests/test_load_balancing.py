@@ -1,5 +1,6 @@
 import ipaddress
 import unittest
+from unittest import mock
 
 from zoxy.server import ProxyServer
 
@@ -45,7 +46,7 @@ class ProxyServerForwardingTest(unittest.TestCase):
                 "access_count": 0,
             })
         self.assertDictEqual(self.proxy_server._load_balancing, checker_load_balancing_setting)
-        self.assertTrue(self.proxy_server._ProxyServer__enable_load_balancing)
+        self.assertTrue(self.proxy_server.routing.load_balancing_enabled)
 
         # Clear
         self.proxy_server.load_balancing = {
@@ -60,7 +61,7 @@ class ProxyServerForwardingTest(unittest.TestCase):
             "backend": [
             ],
         })
-        self.assertFalse(self.proxy_server._ProxyServer__enable_load_balancing)
+        self.assertFalse(self.proxy_server.routing.load_balancing_enabled)
 
     def test_distribute_backend(self):
         backend_access_count = [0, 0]
@@ -110,3 +111,108 @@ class ProxyServerForwardingTest(unittest.TestCase):
             forwarding_domain, forwarding_port = self.proxy_server.get_load_balancing_dest("192.0.0.1", 8080)
             self.assertEqual(forwarding_domain, "127.0.0.1")
             self.assertEqual(forwarding_port, port)
+
+    def test_load_balancing_policy(self):
+        load_balancing = {
+            "frontend": ["127.0.0.1/32", "8080"],
+            "backend": [
+                ["127.0.0.1", "9090", "50"],
+                ["127.0.0.1", "9091", "50"],
+            ],
+            "policy": "least_conn",
+        }
+        self.proxy_server.load_balancing = load_balancing
+        self.assertDictEqual(self.proxy_server.load_balancing, load_balancing)
+
+        # open connections steer the next selection
+        _, first_port, first_lease = self.proxy_server.select_load_balancing_backend("127.0.0.1", 8080)
+        _, second_port, second_lease = self.proxy_server.select_load_balancing_backend("127.0.0.1", 8080)
+        self.assertNotEqual(first_port, second_port)
+        first_lease.close()
+        _, third_port, third_lease = self.proxy_server.select_load_balancing_backend("127.0.0.1", 8080)
+        self.assertEqual(third_port, first_port)
+        second_lease.close()
+        third_lease.close()
+
+        with self.assertRaises(ValueError):
+            self.proxy_server.load_balancing = dict(load_balancing, policy="random")
+
+    def test_eject_backend_on_connect_errors(self):
+        load_balancing = {
+            "frontend": ["127.0.0.1/32", "8080"],
+            "backend": [
+                ["127.0.0.1", "9090", "50"],
+                ["127.0.0.1", "9091", "50"],
+            ],
+            "health_check": {"consecutive_errors": 2, "ejection_time": 30},
+        }
+        self.proxy_server.load_balancing = load_balancing
+        self.assertDictEqual(self.proxy_server.load_balancing, load_balancing)
+
+        with mock.patch.object(self.proxy_server, "get_dest_socket", side_effect=ConnectionRefusedError):
+            for _ in range(4):
+                dest_domain, dest_port, lb_lease = self.proxy_server.select_load_balancing_backend("127.0.0.1", 8080)
+                with self.assertRaises(ConnectionRefusedError):
+                    self.proxy_server.connect_dest(dest_domain, dest_port, lb_lease=lb_lease)
+                lb_lease.close()
+
+        # both backends had two connect errors, 9090 first, every backend ejected means none is skipped
+        self.assertListEqual([state["ejected"] for state in self.proxy_server.load_balancing_health], [True, True])
+        self.assertSetEqual({self.proxy_server.get_load_balancing_dest("127.0.0.1", 8080)[1] for _ in range(4)}, {9090, 9091})
+
+    def test_skip_ejected_backend(self):
+        self.proxy_server.load_balancing = {
+            "frontend": ["127.0.0.1/32", "8080"],
+            "backend": [
+                ["127.0.0.1", "9090", "50"],
+                ["127.0.0.1", "9091", "50"],
+            ],
+            "health_check": {"consecutive_errors": 1},
+        }
+        with mock.patch.object(self.proxy_server, "get_dest_socket", side_effect=ConnectionRefusedError):
+            dest_domain, dest_port, lb_lease = self.proxy_server.select_load_balancing_backend("127.0.0.1", 8080)
+            self.assertEqual(dest_port, 9090)
+            with self.assertRaises(ConnectionRefusedError):
+                self.proxy_server.connect_dest(dest_domain, dest_port, lb_lease=lb_lease)
+            lb_lease.close()
+        self.assertListEqual([state["available"] for state in self.proxy_server.load_balancing_health], [False, True])
+        for _ in range(4):
+            self.assertEqual(self.proxy_server.get_load_balancing_dest("127.0.0.1", 8080), ("127.0.0.1", 9091))
+
+    def test_hash_load_balancing(self):
+        load_balancing = {
+            "frontend": ["127.0.0.1/32", "8080"],
+            "backend": [
+                ["127.0.0.1", "9090", "50"],
+                ["127.0.0.1", "9091", "50"],
+            ],
+            "policy": "hash",
+        }
+        self.proxy_server.load_balancing = load_balancing
+        self.assertDictEqual(self.proxy_server.load_balancing, load_balancing)
+
+        # the same client always lands on the same backend
+        ports = set()
+        for client_index in range(16):
+            client_ip = f"10.0.0.{client_index}"
+            _, dest_port, dest_ip, lb_lease = self.proxy_server.get_routing_dest("127.0.0.1", 8080, client_ip)
+            lb_lease.close()
+            for _ in range(4):
+                _, same_dest_port, _, lb_lease = self.proxy_server.get_routing_dest("127.0.0.1", 8080, client_ip)
+                lb_lease.close()
+                self.assertEqual(same_dest_port, dest_port)
+            ports.add(dest_port)
+        self.assertSetEqual(ports, {9090, 9091})
+
+        load_balancing["hash_key"] = "host"
+        self.proxy_server.load_balancing = load_balancing
+        self.assertDictEqual(self.proxy_server.load_balancing, load_balancing)
+        _, dest_port, _, lb_lease = self.proxy_server.get_routing_dest("127.0.0.1", 8080, "10.0.0.1")
+        lb_lease.close()
+        for client_index in range(16):
+            _, same_dest_port, _, lb_lease = self.proxy_server.get_routing_dest("127.0.0.1", 8080, f"10.0.0.{client_index}")
+            lb_lease.close()
+            self.assertEqual(same_dest_port, dest_port)
+
+        with self.assertRaises(ValueError):
+            self.proxy_server.load_balancing = dict(load_balancing, hash_key="cookie")
@@ -0,0 +1,69 @@
+import unittest
+import urllib.error
+import urllib.request
+
+from zoxy.metrics import MetricsRegistry, MetricsServer, ProxyMetrics
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter("zoxy_test_total", "Test counter", ["backend"])
+        counter.labels("127.0.0.1:9090").inc()
+        counter.labels("127.0.0.1:9090").inc(2)
+        counter.labels("127.0.0.1:\"9091\"").inc()
+        self.registry.gauge("zoxy_test_open", "Test gauge", function=lambda: 3)
+        self.assertEqual(self.registry.render(), (
+            "# HELP zoxy_test_total Test counter\n"
+            "# TYPE zoxy_test_total counter\n"
+            "zoxy_test_total{backend=\"127.0.0.1:9090\"} 3\n"
+            "zoxy_test_total{backend=\"127.0.0.1:\\\"9091\\\"\"} 1\n"
+            "# HELP zoxy_test_open Test gauge\n"
+            "# TYPE zoxy_test_open gauge\n"
+            "zoxy_test_open 3\n"
+        ))
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("zoxy_test_seconds", "Test histogram", buckets=[0.1, 1])
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value)
+        self.assertEqual(self.registry.render(), (
+            "# HELP zoxy_test_seconds Test histogram\n"
+            "# TYPE zoxy_test_seconds histogram\n"
+            "zoxy_test_seconds_bucket{le=\"0.1\"} 2\n"
+            "zoxy_test_seconds_bucket{le=\"1\"} 3\n"
+            "zoxy_test_seconds_bucket{le=\"+Inf\"} 4\n"
+            "zoxy_test_seconds_sum 2.65\n"
+            "zoxy_test_seconds_count 4\n"
+        ))
+
+    def test_register_twice(self):
+        self.registry.counter("zoxy_test_total", "Test counter")
+        with self.assertRaises(ValueError):
+            self.registry.counter("zoxy_test_total", "Test counter")
+
+    def test_wrong_label_count(self):
+        counter = self.registry.counter("zoxy_test_total", "Test counter", ["backend"])
+        with self.assertRaises(ValueError):
+            counter.labels("127.0.0.1", "9090")
+
+
+class MetricsServerTest(unittest.TestCase):
+    def test_serve_metrics(self):
+        metrics = ProxyMetrics()
+        metrics.connections_accepted.inc()
+        metrics_server = MetricsServer(metrics.registry, port=0)
+        metrics_server.start()
+        self.addCleanup(metrics_server.stop)
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_server.port}/metrics", timeout=5) as response:
+            self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+            body = response.read().decode()
+        self.assertIn("zoxy_connections_accepted_total 1\n", body)
+        self.assertIn("# TYPE zoxy_upstream_connect_seconds histogram\n", body)
+
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(f"http://127.0.0.1:{metrics_server.port}/", timeout=5)
+        self.assertEqual(context.exception.code, 404)
@@ -0,0 +1,105 @@
+import socket
+import time
+import unittest
+
+from zoxy.pool import ConnectionPool, ConnectionPoolFull
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(max_idle_per_host=2, max_per_host=3, idle_timeout=30, wait_timeout=0.1)
+        self.peers = []
+
+    def tearDown(self):
+        self.pool.clear()
+        for sock in self.peers:
+            sock.close()
+
+    def connect(self, host: str, port: int) -> socket.socket:
+        dest_socket, peer_socket = socket.socketpair()
+        self.peers.append(peer_socket)
+        return dest_socket
+
+    def test_reuse_idle_connection(self):
+        dest_socket = self.pool.acquire("127.0.0.1", 80, self.connect)
+        self.pool.release("127.0.0.1", 80, dest_socket, True)
+        self.assertEqual(self.pool.idle_count("127.0.0.1", 80), 1)
+        self.assertIs(self.pool.acquire("127.0.0.1", 80, self.connect), dest_socket)
+        self.assertEqual(self.pool.active_count("127.0.0.1", 80), 1)
+        # another port is another key
+        self.assertIsNot(self.pool.acquire("127.0.0.1", 8080, self.connect), dest_socket)
+        self.assertEqual(self.pool.stats["hits"], 1)
+        self.assertEqual(self.pool.stats["misses"], 2)
+
+    def test_not_reusable_connection_is_closed(self):
+        dest_socket = self.pool.acquire("127.0.0.1", 80, self.connect)
+        self.pool.release("127.0.0.1", 80, dest_socket, False)
+        self.assertEqual(self.pool.idle_count(), 0)
+        self.assertEqual(dest_socket.fileno(), -1)
+
+    def test_drop_closed_connection(self):
+        dest_socket = self.pool.acquire("127.0.0.1", 80, self.connect)
+        self.pool.release("127.0.0.1", 80, dest_socket, True)
+        # the server closed the idle connection
+        self.peers[0].close()
+        self.assertIsNot(self.pool.acquire("127.0.0.1", 80, self.connect), dest_socket)
+        self.assertEqual(self.pool.stats["evictions"], 1)
+        self.assertEqual(self.pool.stats["misses"], 2)
+
+    def test_drop_connection_with_unexpected_data(self):
+        dest_socket = self.pool.acquire("127.0.0.1", 80, self.connect)
+        self.pool.release("127.0.0.1", 80, dest_socket, True)
+        self.peers[0].sendall(b"HTTP/1.1 408 Request Timeout\r\n\r\n")
+        self.assertIsNot(self.pool.acquire("127.0.0.1", 80, self.connect), dest_socket)
+
+    def test_evict_by_age(self):
+        self.pool.idle_timeout = 0.01
+        dest_socket = self.pool.acquire("127.0.0.1", 80, self.connect)
+        self.pool.release("127.0.0.1", 80, dest_socket, True)
+        time.sleep(0.02)
+        self.pool.evict_expired()
+        self.assertEqual(self.pool.idle_count(), 0)
+        self.assertEqual(self.pool.stats["evictions"], 1)
+
+    def test_evict_on_release(self):
+        self.pool.idle_timeout = 0.01
+        dest_socket = self.pool.acquire("127.0.0.1", 80, self.connect)
+        self.pool.release("127.0.0.1", 80, dest_socket, True)
+        time.sleep(0.02)
+        # another host's release sweeps the expired connection
+        self.pool.release("127.0.0.1", 8080, self.pool.acquire("127.0.0.1", 8080, self.connect), False)
+        self.assertEqual(dest_socket.fileno(), -1)
+        self.assertEqual(self.pool.stats["evictions"], 1)
+        self.assertEqual(self.pool.stats["hosts"], 0)
+
+    def test_unused_hosts_are_forgotten(self):
+        dest_socket = self.pool.acquire("127.0.0.1", 80, self.connect)
+        self.assertEqual(self.pool.stats["hosts"], 1)
+        self.pool.release("127.0.0.1", 80, dest_socket, True)
+        self.assertEqual(self.pool.stats["hosts"], 1)
+        self.pool.release("127.0.0.1", 80, self.pool.acquire("127.0.0.1", 80, self.connect), False)
+        self.assertEqual(self.pool.stats["hosts"], 0)
+
+    def test_max_idle_per_host(self):
+        dest_sockets = [self.pool.acquire("127.0.0.1", 80, self.connect) for _ in range(3)]
+        for dest_socket in dest_sockets:
+            self.pool.release("127.0.0.1", 80, dest_socket, True)
+        self.assertEqual(self.pool.idle_count("127.0.0.1", 80), 2)
+        self.assertEqual(dest_sockets[2].fileno(), -1)
+
+    def test_max_per_host(self):
+        dest_sockets = [self.pool.acquire("127.0.0.1", 80, self.connect) for _ in range(3)]
+        with self.assertRaises(ConnectionPoolFull):
+            self.pool.acquire("127.0.0.1", 80, self.connect)
+        self.pool.release("127.0.0.1", 80, dest_sockets[0], True)
+        self.assertIs(self.pool.acquire("127.0.0.1", 80, self.connect), dest_sockets[0])
+
+    def test_connect_error_frees_slot(self):
+        def refuse(host: str, port: int) -> socket.socket:
+            raise ConnectionRefusedError()
+
+        for _ in range(4):
+            with self.assertRaises(ConnectionRefusedError):
+                self.pool.acquire("127.0.0.1", 80, refuse)
+        self.assertEqual(self.pool.active_count(), 0)
+        self.assertEqual(self.pool.stats["hosts"], 0)
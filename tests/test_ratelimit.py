@@ -0,0 +1,85 @@
+import unittest
+
+from zoxy.ratelimit import ByteThrottle, RateLimitTable, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_try_take(self):
+        bucket = TokenBucket(rate=2, burst=2, now=0)
+        self.assertTrue(bucket.try_take(1, 0))
+        self.assertTrue(bucket.try_take(1, 0))
+        self.assertFalse(bucket.try_take(1, 0))
+        self.assertFalse(bucket.try_take(1, 0.25))
+        self.assertTrue(bucket.try_take(1, 0.5))
+        # never refills over its burst
+        bucket.refill(100)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_take_returns_pause(self):
+        bucket = TokenBucket(rate=1000, burst=1000, now=0)
+        self.assertEqual(bucket.take(500, 0), 0)
+        self.assertAlmostEqual(bucket.take(1500, 0), 1.0)
+        self.assertAlmostEqual(bucket.take(0, 0.5), 0.5)
+        self.assertEqual(bucket.take(0, 1), 0)
+
+
+class RateLimitTableTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_first_rule_matches(self):
+        table = RateLimitTable([
+            ["127.0.0.1", "8080", 1, "*"],
+            ["127.0.0.0/24", "*", 2, 1000],
+        ], clock=self.clock)
+        self.assertEqual(table.to_list(), [["127.0.0.1/32", "8080", 1.0, "*"], ["127.0.0.0/24", "*", 2.0, 1000.0]])
+        allowed, byte_limit = table.acquire("127.0.0.1", 8080)
+        self.assertTrue(allowed)
+        self.assertIsNone(byte_limit)
+        self.assertFalse(table.acquire("127.0.0.1", 8080)[0])
+        # another port falls through to the second rule
+        allowed, byte_limit = table.acquire("127.0.0.1", 80)
+        self.assertTrue(allowed)
+        self.assertIsNotNone(byte_limit)
+        self.assertEqual(table.acquire("192.168.0.1", 80), (True, None))
+        self.assertEqual(table.limited, 1)
+
+    def test_bucket_per_ip(self):
+        table = RateLimitTable([["127.0.0.0/24", "*", 1, "*"]], clock=self.clock)
+        self.assertTrue(table.acquire("127.0.0.1", 80)[0])
+        self.assertFalse(table.acquire("127.0.0.1", 80)[0])
+        self.assertTrue(table.acquire("127.0.0.2", 80)[0])
+        self.assertEqual(table.keys, 2)
+        self.clock.now = 1
+        self.assertTrue(table.acquire("127.0.0.1", 80)[0])
+
+    def test_evict_idle_buckets(self):
+        table = RateLimitTable([["0.0.0.0/0", "*", 1, "*"]], idle_timeout=10, max_keys=3, clock=self.clock)
+        for host in ["127.0.0.1", "127.0.0.2", "127.0.0.3"]:
+            table.acquire(host, 80)
+        # over max_keys the least recently used goes
+        table.acquire("127.0.0.4", 80)
+        self.assertEqual(table.keys, 3)
+        self.clock.now = 10
+        table.acquire("127.0.0.5", 80)
+        self.assertEqual(table.keys, 1)
+        self.assertEqual(table.evictions, 4)
+
+    def test_byte_throttle(self):
+        client_limits = RateLimitTable([["127.0.0.1", "*", "*", 1000]], clock=self.clock)
+        dest_limits = RateLimitTable([["10.0.0.1", "*", "*", 4000]], clock=self.clock)
+        throttle = ByteThrottle([client_limits.acquire("127.0.0.1", 80)[1], dest_limits.acquire("10.0.0.1", 80)[1]])
+        self.assertEqual(throttle(1000), 0)
+        # the slower limit sets the pause
+        self.assertAlmostEqual(throttle(2000), 2.0)
+        # reads stay within the smallest burst
+        self.assertEqual(throttle.read_len(1024 * 1024), 1000)
+        self.assertEqual(throttle.read_len(512), 512)
@@ -0,0 +1,116 @@
+import socket
+import threading
+import time
+import unittest
+
+from zoxy.relay import AdaptiveBufferSize, Relay
+
+
+class AdaptiveBufferSizeTest(unittest.TestCase):
+    def test_grow_while_reads_fill_it(self):
+        buffer_size = AdaptiveBufferSize(min_len=1024, max_len=8192)
+        self.assertEqual(buffer_size.len, 1024)
+        for expected_len in [2048, 4096, 8192, 8192]:
+            buffer_size.observe(buffer_size.len, buffer_size.len)
+            self.assertEqual(buffer_size.len, expected_len)
+
+    def test_shrink_after_small_reads(self):
+        buffer_size = AdaptiveBufferSize(min_len=1024, max_len=8192, shrink_after=4)
+        buffer_size.len = 8192
+        for _ in range(3):
+            buffer_size.observe(100, 8192)
+        # a read using more than a quarter starts the count again
+        buffer_size.observe(4096, 8192)
+        for _ in range(3):
+            buffer_size.observe(100, 8192)
+        self.assertEqual(buffer_size.len, 8192)
+        buffer_size.observe(100, 8192)
+        self.assertEqual(buffer_size.len, 4096)
+        for _ in range(100):
+            buffer_size.observe(100, buffer_size.len)
+        self.assertEqual(buffer_size.len, 1024)
+
+
+class RelayBufferTest(unittest.TestCase):
+    def test_buffer_follows_throughput(self):
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        relay = Relay(src_socket, dest_socket, recv_len=1024 * 1024, max_pending_len=1024 * 1024, idle_timeout=5)
+        self.assertEqual(len(relay.s_to_d.buffer), 16 * 1024)
+        relay_thread = threading.Thread(target=relay.run)
+        relay_thread.start()
+
+        payload = b"x" * (1024 * 1024 * 8)
+        sender = threading.Thread(target=client_socket.sendall, args=(payload,))
+        sender.start()
+        received = 0
+        while received < len(payload):
+            received += len(origin_socket.recv(1024 * 1024))
+        sender.join(5)
+        # a bulk stream grows its own direction only
+        self.assertGreater(relay.s_to_d.buffer_size.len, 16 * 1024)
+        self.assertEqual(relay.d_to_s.buffer_size.len, 16 * 1024)
+
+        client_socket.shutdown(socket.SHUT_WR)
+        origin_socket.shutdown(socket.SHUT_WR)
+        relay_thread.join(5)
+        self.assertFalse(relay_thread.is_alive())
+        self.assertEqual(relay.s_to_d.transferred_len, len(payload))
+        for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+            sock.close()
+
+    def test_throttle_pauses_reads(self):
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        taken = []
+
+        def throttle(received: int) -> float:
+            taken.append(received)
+            return 0.2 if len(taken) == 1 else 0
+
+        relay = Relay(src_socket, dest_socket, recv_len=1024, max_pending_len=1024, idle_timeout=5, throttle=throttle)
+        relay_thread = threading.Thread(target=relay.run)
+        relay_thread.start()
+
+        start_time = time.monotonic()
+        client_socket.sendall(b"x" * 1024)
+        self.assertEqual(len(origin_socket.recv(1024)), 1024)
+        client_socket.sendall(b"y")
+        self.assertEqual(origin_socket.recv(1024), b"y")
+        # the second read waited for the pause of the first
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.2)
+        self.assertEqual(taken, [1024, 1])
+
+        client_socket.shutdown(socket.SHUT_WR)
+        origin_socket.shutdown(socket.SHUT_WR)
+        relay_thread.join(5)
+        self.assertFalse(relay_thread.is_alive())
+        for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+            sock.close()
+
+    def test_throttle_pause_longer_than_idle_timeout(self):
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        taken = []
+
+        def throttle(received: int) -> float:
+            taken.append(received)
+            return 0.3 if len(taken) == 1 else 0
+
+        relay = Relay(src_socket, dest_socket, recv_len=1024, max_pending_len=1024, idle_timeout=0.1, throttle=throttle)
+        relay_thread = threading.Thread(target=relay.run)
+        relay_thread.start()
+        origin_socket.settimeout(5)
+
+        client_socket.sendall(b"x" * 1024 + b"y")
+        self.assertEqual(len(origin_socket.recv(1024)), 1024)
+        # the tunnel is slowed down, not closed as idle
+        self.assertEqual(origin_socket.recv(1024), b"y")
+        self.assertEqual(taken, [1024, 1])
+
+        client_socket.shutdown(socket.SHUT_WR)
+        origin_socket.shutdown(socket.SHUT_WR)
+        relay_thread.join(5)
+        self.assertFalse(relay_thread.is_alive())
+        for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+            sock.close()
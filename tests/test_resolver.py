@@ -0,0 +1,75 @@
+import socket
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+from zoxy.resolver import Resolver
+
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.resolve_func = Mock(return_value="127.0.0.5")
+        self.resolver = Resolver(ttl=60, negative_ttl=60, resolve_func=self.resolve_func)
+
+    def test_cache(self):
+        self.assertEqual(self.resolver.resolve("test.org"), "127.0.0.5")
+        self.assertEqual(self.resolver.resolve("test.org"), "127.0.0.5")
+        self.resolve_func.assert_called_once_with("test.org")
+        self.assertEqual(self.resolver.stats["hits"], 1)
+        self.assertEqual(self.resolver.stats["misses"], 1)
+        self.assertEqual(self.resolver.hit_rate, 0.5)
+
+    def test_ip_address(self):
+        self.assertEqual(self.resolver.resolve("127.0.0.1"), "127.0.0.1")
+        self.assertEqual(self.resolve_func.call_count, 0)
+
+    def test_ttl(self):
+        self.resolver.ttl = 0.01
+        self.resolver.resolve("test.org")
+        time.sleep(0.02)
+        self.resolver.resolve("test.org")
+        self.assertEqual(self.resolve_func.call_count, 2)
+
+    def test_negative_cache(self):
+        self.resolve_func.side_effect = socket.gaierror(-2, "Name or service not known")
+        for _ in range(3):
+            with self.assertRaises(socket.gaierror):
+                self.resolver.resolve("unknown.test.org")
+        self.resolve_func.assert_called_once_with("unknown.test.org")
+        self.assertEqual(self.resolver.stats["negative_hits"], 2)
+
+    def test_max_entries(self):
+        self.resolver.max_entries = 2
+        for host in ["a.test.org", "b.test.org", "c.test.org"]:
+            self.resolver.resolve(host)
+        self.assertEqual(self.resolver.stats["entries"], 2)
+        # the oldest one was dropped
+        self.resolver.resolve("a.test.org")
+        self.assertEqual(self.resolve_func.call_count, 4)
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_resolve(host: str) -> str:
+            started.set()
+            release.wait(5)
+            return "127.0.0.6"
+
+        self.resolver.resolve_func = Mock(side_effect=slow_resolve)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.resolver.resolve("test.org")))
+            for _ in range(8)
+        ]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, ["127.0.0.6"] * 8)
+        self.assertEqual(self.resolver.resolve_func.call_count, 1)
@@ -0,0 +1,88 @@
+import ipaddress
+import random
+import unittest
+
+from zoxy.routing import FirstMatchTable, PrefixTable, parse_address
+
+
+class PrefixTableTest(unittest.TestCase):
+    def setUp(self):
+        self.prefix_table = PrefixTable([
+            (ipaddress.ip_network("0.0.0.0/0"), "default"),
+            (ipaddress.ip_network("10.0.0.0/8"), "10/8"),
+            (ipaddress.ip_network("10.1.0.0/16"), "10.1/16"),
+            (ipaddress.ip_network("10.1.2.3/32"), "10.1.2.3/32"),
+            (ipaddress.ip_network("10.1.0.0/16"), "10.1/16 again"),
+            (ipaddress.ip_network("2001:db8::/32"), "2001:db8/32"),
+        ])
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address("10.0.0.1"), (4, 0x0a000001))
+        self.assertEqual(parse_address("::1"), (6, 1))
+        with self.assertRaises(ValueError):
+            parse_address("test.org")
+
+    def test_lookup_longest_prefix_first(self):
+        self.assertListEqual(
+            list(self.prefix_table.lookup("10.1.2.3")),
+            ["10.1.2.3/32", "10.1/16", "10.1/16 again", "10/8", "default"],
+        )
+        self.assertListEqual(list(self.prefix_table.lookup("10.2.0.1")), ["10/8", "default"])
+        self.assertListEqual(list(self.prefix_table.lookup("192.0.0.1")), ["default"])
+        self.assertListEqual(self.prefix_table.longest_match("10.1.9.9"), ["10.1/16", "10.1/16 again"])
+        self.assertEqual(len(self.prefix_table), 6)
+
+    def test_lookup_ipv6(self):
+        self.assertListEqual(list(self.prefix_table.lookup("2001:db8::1")), ["2001:db8/32"])
+        self.assertListEqual(list(self.prefix_table.lookup("2001:db9::1")), [])
+
+    def test_same_result_as_supernet_of(self):
+        rng = random.Random(0)
+        networks = [
+            ipaddress.ip_network((rng.getrandbits(32), rng.randint(8, 24)), strict=False)
+            for _ in range(200)
+        ]
+        prefix_table = PrefixTable((network, index) for index, network in enumerate(networks))
+        for _ in range(200):
+            host = str(ipaddress.ip_address(rng.choice(networks).network_address + rng.randint(0, 255)))
+            host_network = ipaddress.ip_network(host)
+            expected = {index for index, network in enumerate(networks) if network.supernet_of(host_network)}
+            self.assertSetEqual(set(prefix_table.lookup(host)), expected)
+
+
+class FirstMatchTableTest(unittest.TestCase):
+    def test_first_match_wins(self):
+        first_match_table = FirstMatchTable([
+            (ipaddress.ip_network("10.0.0.0/8"), "80", "broad first"),
+            (ipaddress.ip_network("10.1.0.0/16"), "80", "narrow second"),
+            (ipaddress.ip_network("10.1.0.0/16"), "*", "narrow any port"),
+            (ipaddress.ip_network("0.0.0.0/0"), "*", "default"),
+        ])
+        # a longer prefix does not win over an earlier rule
+        self.assertEqual(first_match_table.lookup("10.1.0.1", 80), "broad first")
+        self.assertEqual(first_match_table.lookup("10.1.0.1", 443), "narrow any port")
+        self.assertEqual(first_match_table.lookup("10.2.0.1", 443), "default")
+        self.assertEqual(len(first_match_table), 4)
+        self.assertIsNone(FirstMatchTable().lookup("10.1.0.1", 80))
+
+    def test_same_result_as_linear_scan(self):
+        rng = random.Random(0)
+        rules = [
+            (
+                ipaddress.ip_network((rng.getrandbits(32) & 0xff0fffff, rng.randint(8, 24)), strict=False),
+                rng.choice(["*", "80", "443"]),
+                index,
+            )
+            for index in range(300)
+        ]
+        first_match_table = FirstMatchTable(rules)
+        for _ in range(300):
+            host = str(ipaddress.ip_address(rng.choice(rules)[0].network_address + rng.randint(0, 255)))
+            port = rng.choice([80, 443, 8080])
+            host_network = ipaddress.ip_network(host)
+            expected = next(
+                (index for network, rule_port, index in rules
+                 if network.supernet_of(host_network) and (rule_port == "*" or rule_port == str(port))),
+                None,
+            )
+            self.assertEqual(first_match_table.lookup(host, port), expected)
@@ -1,7 +1,15 @@
+import errno
+import os
 import socket
+import threading
 import unittest
+from typing import Tuple
 from unittest.mock import Mock, patch, call
 
+from zoxy.cache import HTTPCache
+from zoxy.capture import ResponseRingBuffer
+from zoxy.coalesce import RequestCoalescer
+from zoxy.resolver import Resolver
 from zoxy.server import ProxyServer
 
 class ServerSocketTest(unittest.TestCase):
@@ -31,6 +39,11 @@ class ServerSocketTest(unittest.TestCase):
             self.proxy_server._parse_dest_url(testee),
             ("test.org", 443)
         )
+        testee = "test.org:8443"
+        self.assertEqual(
+            self.proxy_server._parse_dest_url(testee),
+            ("test.org", 8443)
+        )
 
     @patch("socket.socket", return_value=Mock())
     def test_get_dest_socket(self, mock_socket: unittest.mock.MagicMock):
@@ -41,16 +54,18 @@ class ServerSocketTest(unittest.TestCase):
         dest_socket.settimeout.assert_called_with(self.proxy_server._ProxyServer__dest_connection_timeout)
 
     @patch("zoxy.server.ProxyServer.pipe_data", return_value=None)
-    def test_pipe(self, mock_pipe_data: unittest.mock.MagicMock):
+    @patch("zoxy.server.ProxyServer.pipe_response", return_value=True)
+    def test_pipe(self, mock_pipe_response: unittest.mock.MagicMock, mock_pipe_data: unittest.mock.MagicMock):
         mock_src_socket = Mock()
         mock_dest_socket = Mock()
         test_request = b"Test requests\r\n"
 
         # is_https_tunnel: False
-        self.proxy_server.pipe(mock_src_socket, test_request, mock_dest_socket, False)
+        self.assertTrue(self.proxy_server.pipe(mock_src_socket, test_request, mock_dest_socket, False))
         self.assertEqual(mock_src_socket.sendall.call_count, 0)
         mock_dest_socket.sendall.assert_called_with(test_request)
-        mock_pipe_data.assert_called_with(mock_src_socket, mock_dest_socket)
+        mock_pipe_response.assert_called_with(mock_src_socket, mock_dest_socket, "GET")
+        self.assertEqual(mock_pipe_data.call_count, 0)
 
         mock_src_socket.reset_mock()
         mock_dest_socket.reset_mock()
@@ -62,17 +77,151 @@ class ServerSocketTest(unittest.TestCase):
         mock_pipe_data.assert_called_with(mock_src_socket, mock_dest_socket)
 
     def test_pipe_data(self):
-        mock_src_socket = Mock()
-        mock_dest_socket = Mock()
-        test_src_data = [b"Test src data\r\n"] + [b""] * self.proxy_server._ProxyServer__max_pipe_timeout
-        test_dest_data = [b"Test dest data\r\n"] + [b""] * self.proxy_server._ProxyServer__max_pipe_timeout
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        pipe_result = []
+        pipe_thread = threading.Thread(
+            target=lambda: pipe_result.append(self.proxy_server.pipe_data(src_socket, dest_socket))
+        )
+        pipe_thread.start()
+
+        client_socket.sendall(b"Test src data\r\n")
+        self.assertEqual(origin_socket.recv(1024), b"Test src data\r\n")
+        origin_socket.sendall(b"Test dest data\r\n")
+        self.assertEqual(client_socket.recv(1024), b"Test dest data\r\n")
+
+        # both sides half-close, the relay ends without waiting for the idle timeout
+        client_socket.shutdown(socket.SHUT_WR)
+        self.assertEqual(origin_socket.recv(1024), b"")
+        origin_socket.sendall(b"Last dest data\r\n")
+        origin_socket.shutdown(socket.SHUT_WR)
+        self.assertEqual(client_socket.recv(1024), b"Last dest data\r\n")
+        self.assertEqual(client_socket.recv(1024), b"")
+        pipe_thread.join(5)
+        self.assertFalse(pipe_thread.is_alive())
+        self.assertEqual(pipe_result, [len(b"Test dest data\r\nLast dest data\r\n")])
+
+        for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+            sock.close()
+
+    def test_pipe_data_with_response_capture(self):
+        self.proxy_server.response_capture = ResponseRingBuffer(max_len=8)
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        pipe_thread = threading.Thread(target=self.proxy_server.pipe_data, args=(src_socket, dest_socket))
+        pipe_thread.start()
+
+        origin_socket.sendall(b"Test dest data\r\n")
+        self.assertEqual(client_socket.recv(1024), b"Test dest data\r\n")
+        client_socket.shutdown(socket.SHUT_WR)
+        origin_socket.shutdown(socket.SHUT_WR)
+        pipe_thread.join(5)
+        self.assertEqual(self.proxy_server.response_capture.getvalue(), b"t data\r\n")
+        for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+            sock.close()
+
+    def test_pipe_data_backpressure(self):
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        pipe_thread = threading.Thread(target=self.proxy_server.pipe_data, args=(src_socket, dest_socket))
+        pipe_thread.start()
 
-        mock_src_socket.recv.side_effect = iter(test_src_data)
-        mock_dest_socket.recv.side_effect = iter(test_dest_data)
-        response_data = self.proxy_server.pipe_data(mock_src_socket, mock_dest_socket)
-        self.assertEqual(mock_src_socket.sendall.mock_calls, [call(data) for data in test_dest_data])
-        self.assertEqual(mock_dest_socket.sendall.call_args_list, [call(data) for data in test_src_data])
-        self.assertEqual(b"".join(test_dest_data), response_data)
+        # a stalled client must not stop the other direction
+        payload = b"x" * (1024 * 1024 * 4)
+        sender = threading.Thread(target=origin_socket.sendall, args=(payload,))
+        sender.start()
+        client_socket.sendall(b"ping")
+        self.assertEqual(origin_socket.recv(1024), b"ping")
+
+        received = bytearray()
+        while len(received) < len(payload):
+            received += client_socket.recv(65536)
+        sender.join(5)
+        self.assertEqual(bytes(received), payload)
+
+        client_socket.shutdown(socket.SHUT_WR)
+        origin_socket.shutdown(socket.SHUT_WR)
+        pipe_thread.join(5)
+        self.assertFalse(pipe_thread.is_alive())
+        for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+            sock.close()
+
+    def test_pipe_data_with_and_without_splice(self):
+        payload = bytes(range(256)) * 4096 * 4
+        for splice_tunnel in [True, False]:
+            self.proxy_server.splice_tunnel = splice_tunnel
+            client_socket, src_socket = socket.socketpair()
+            dest_socket, origin_socket = socket.socketpair()
+            pipe_result = []
+            pipe_thread = threading.Thread(
+                target=lambda: pipe_result.append(self.proxy_server.pipe_data(src_socket, dest_socket))
+            )
+            pipe_thread.start()
+
+            senders = [
+                threading.Thread(target=client_socket.sendall, args=(payload,)),
+                threading.Thread(target=origin_socket.sendall, args=(payload[::-1],)),
+            ]
+            for sender in senders:
+                sender.start()
+            for sock, expected in [(origin_socket, payload), (client_socket, payload[::-1])]:
+                received = bytearray()
+                while len(received) < len(expected):
+                    received += sock.recv(65536)
+                self.assertEqual(bytes(received), expected, f"splice_tunnel={splice_tunnel}")
+            for sender in senders:
+                sender.join(5)
+
+            client_socket.shutdown(socket.SHUT_WR)
+            origin_socket.shutdown(socket.SHUT_WR)
+            pipe_thread.join(5)
+            self.assertFalse(pipe_thread.is_alive())
+            self.assertEqual(pipe_result, [len(payload)])
+            for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+                sock.close()
+
+    @unittest.skipUnless(hasattr(os, "splice"), "os.splice is Linux only")
+    def test_pipe_data_splice_fallback(self):
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        pipe_thread = threading.Thread(target=self.proxy_server.pipe_data, args=(src_socket, dest_socket))
+        # no file descriptors left for the pipes
+        with patch("os.pipe2", side_effect=OSError(errno.EMFILE, "Too many open files")):
+            pipe_thread.start()
+            client_socket.sendall(b"Test src data\r\n")
+            self.assertEqual(origin_socket.recv(1024), b"Test src data\r\n")
+        client_socket.shutdown(socket.SHUT_WR)
+        origin_socket.shutdown(socket.SHUT_WR)
+        pipe_thread.join(5)
+        self.assertFalse(pipe_thread.is_alive())
+        for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+            sock.close()
+
+    def test_pipe_response(self):
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        responses = [
+            (b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\ntest", "GET", True),
+            (b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n4\r\ntest\r\n0\r\n\r\n", "POST", True),
+            (b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\nConnection: close\r\n\r\ntest", "GET", False),
+            (b"HTTP/1.0 200 OK\r\nContent-Length: 4\r\n\r\ntest", "GET", False),
+            (b"HTTP/1.1 304 Not Modified\r\nContent-Length: 4\r\n\r\n", "GET", True),
+            (b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\n", "HEAD", True),
+        ]
+        for response, request_method, keep_alive in responses:
+            # bytes after the end of the response must not be forwarded
+            origin_socket.sendall(response + b"HTTP/1.1 200 OK\r\n")
+            self.assertEqual(self.proxy_server.pipe_response(src_socket, dest_socket, request_method), keep_alive)
+            self.assertEqual(client_socket.recv(1024), response)
+
+        # close delimited body ends with the dest connection
+        response = b"HTTP/1.1 200 OK\r\n\r\ntest"
+        origin_socket.sendall(response)
+        origin_socket.shutdown(socket.SHUT_WR)
+        self.assertFalse(self.proxy_server.pipe_response(src_socket, dest_socket, "GET"))
+        self.assertEqual(client_socket.recv(1024), response)
+        for sock in [client_socket, src_socket, dest_socket, origin_socket]:
+            sock.close()
 
 class ServerTest(unittest.TestCase):
     def setUp(self):
@@ -107,7 +256,7 @@ class ServerTest(unittest.TestCase):
     def tearDown(self):
         self.proxy_server.close()
 
-    @patch("zoxy.server.ProxyServer.pipe", return_value=Mock())
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
     @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
     def test_proxy_thread(self, mock_get_dest_socket, mock_pipe):
         mock_src_socket = Mock()
@@ -121,9 +270,9 @@ class ServerTest(unittest.TestCase):
             b'{"test": "value"}'
         ), socket.timeout])
         self.proxy_server.proxy_thread(mock_src_socket, src_address)
-        mock_get_dest_socket.assert_called_with("127.1.0.1", 80)
+        mock_get_dest_socket.assert_called_with("127.1.0.1", 80, dest_ip="127.1.0.1")
 
-    @patch("zoxy.server.ProxyServer.pipe", return_value=Mock())
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
     @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
     def test_proxy_thread_with_not_allowed_access(self, mock_get_dest_socket, mock_pipe):
         mock_src_socket = Mock()
@@ -139,7 +288,7 @@ class ServerTest(unittest.TestCase):
         self.proxy_server.proxy_thread(mock_src_socket, src_address)
         self.assertEqual(mock_get_dest_socket.call_count, 0)
 
-    @patch("zoxy.server.ProxyServer.pipe", return_value=Mock())
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
     @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
     def test_proxy_thread_with_blocked_access(self, mock_get_dest_socket, mock_pipe):
         mock_src_socket = Mock()
@@ -155,7 +304,7 @@ class ServerTest(unittest.TestCase):
         self.proxy_server.proxy_thread(mock_src_socket, src_address)
         self.assertEqual(mock_get_dest_socket.call_count, 0)
 
-    @patch("zoxy.server.ProxyServer.pipe", return_value=Mock())
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
     @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
     def test_proxy_thread_with_forwarding(self, mock_get_dest_socket, mock_pipe):
         mock_src_socket = Mock()
@@ -169,9 +318,9 @@ class ServerTest(unittest.TestCase):
             b'{"test": "value"}'
         ), socket.timeout])
         self.proxy_server.proxy_thread(mock_src_socket, src_address)
-        mock_get_dest_socket.assert_called_with("127.0.0.2", 80)
+        mock_get_dest_socket.assert_called_with("127.0.0.2", 80, dest_ip="127.0.0.2")
 
-    @patch("zoxy.server.ProxyServer.pipe", return_value=Mock())
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
     @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
     def test_proxy_thread_with_load_balancing(self, mock_get_dest_socket, mock_pipe):
         mock_src_socket = Mock()
@@ -185,7 +334,7 @@ class ServerTest(unittest.TestCase):
             b'{"test": "value"}'
         ), socket.timeout])
         self.proxy_server.proxy_thread(mock_src_socket, src_address)
-        mock_get_dest_socket.assert_called_with("127.0.0.1", 9090)
+        mock_get_dest_socket.assert_called_with("127.0.0.1", 9090, dest_ip="127.0.0.1")
 
         mock_src_socket.reset_mock()
         mock_get_dest_socket.reset_mock()
@@ -199,4 +348,433 @@ class ServerTest(unittest.TestCase):
             b'{"test": "value"}'
         ), socket.timeout])
         self.proxy_server.proxy_thread(mock_src_socket, src_address)
-        mock_get_dest_socket.assert_called_with("127.0.0.1", 9091)
\ No newline at end of file
+        mock_get_dest_socket.assert_called_with("127.0.0.1", 9091, dest_ip="127.0.0.1")
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_split_request(self, mock_get_dest_socket, mock_pipe):
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        request = (
+            b'POST http://127.1.0.1/ HTTP/1.1\r\n'
+            b'Host: 127.1.0.1\r\n'
+            b'Content-Length: 17\r\n'
+            b'\r\n'
+            b'{"test": "value"}'
+        )
+        # stop at the end of the body, keep extra data for the next request
+        mock_src_socket.recv.side_effect = iter([request[:10], socket.timeout, request[10:] + b"extra"])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        mock_get_dest_socket.assert_called_with("127.1.0.1", 80, dest_ip="127.1.0.1")
+        self.assertEqual(mock_src_socket.recv.call_count, 3)
+        mock_pipe.assert_called_with(mock_src_socket, request, mock_get_dest_socket.return_value, False, request_method="POST")
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_too_large_header(self, mock_get_dest_socket, mock_pipe):
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        mock_src_socket.recv.side_effect = iter([b"GET http://127.1.0.1/ HTTP/1.1\r\n" + b"a" * 1024 * 64])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        self.assertEqual(mock_get_dest_socket.call_count, 0)
+        self.assertTrue(mock_src_socket.sendall.call_args[0][0].startswith(b"HTTP/1.1 431 "))
+
+    def test_read_request_recv_size(self):
+        mock_src_socket = Mock()
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n"
+        mock_src_socket.recv.side_effect = iter([b"a" * 16 * 1024, b"b" * 100, request + b"\r\n"])
+        self.proxy_server.read_request(mock_src_socket)
+        # a read that filled its buffer asks for more next time, not 1 MiB from the start
+        self.assertListEqual([args[0][0] for args in mock_src_socket.recv.call_args_list], [16 * 1024, 32 * 1024, 32 * 1024])
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_resets_recv_size(self, mock_get_dest_socket, mock_pipe):
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        # a 76 byte head, with its body the request fills 16, 32 and 64 KiB reads
+        head = b"POST http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\nContent-Length: %d\r\n\r\n" % (112 * 1024 - 76)
+        first_src_socket = Mock()
+        first_src_socket.recv.side_effect = iter([head + b"a" * (16 * 1024 - len(head)), b"b" * 32 * 1024, b"c" * 64 * 1024])
+        self.assertTrue(self.proxy_server.read_request(first_src_socket).complete)
+        self.assertEqual(first_src_socket.recv.call_args[0][0], 64 * 1024)
+        # the next connection served by the same thread starts from the default again
+        second_src_socket = Mock()
+        second_src_socket.recv.side_effect = iter([request])
+        self.proxy_server.proxy_thread(second_src_socket, ("127.0.0.1", 8000))
+        self.assertEqual(second_src_socket.recv.call_args[0][0], 16 * 1024)
+
+    @patch("zoxy.server.ProxyServer.pipe", side_effect=[True, False])
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_keep_alive(self, mock_get_dest_socket, mock_pipe):
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        first_request = b"GET http://127.1.0.1/first HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        second_request = b"GET http://127.1.0.1/second HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        # pipelined requests arrive in one chunk
+        mock_src_socket.recv.side_effect = iter([first_request + second_request])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        self.assertEqual(mock_pipe.call_count, 2)
+        self.assertEqual(mock_pipe.call_args_list[0][0][1], first_request)
+        self.assertEqual(mock_pipe.call_args_list[1][0][1], second_request)
+        self.assertEqual(mock_src_socket.recv.call_count, 1)
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=True)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_max_keep_alive_requests(self, mock_get_dest_socket, mock_pipe):
+        self.proxy_server.max_keep_alive_requests = 2
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        mock_src_socket.recv.side_effect = iter([request * 3])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        self.assertEqual(mock_pipe.call_count, 2)
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=True)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_too_large_body(self, mock_get_dest_socket, mock_pipe):
+        self.proxy_server.max_request_body_len = 4
+        client_socket, src_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        client_socket.sendall(b"POST http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\nContent-Length: 5\r\n\r\n")
+        self.proxy_server.proxy_thread(src_socket, ("127.0.0.1", 8000))
+        self.assertTrue(client_socket.recv(1024).startswith(b"HTTP/1.1 413 Content Too Large\r\n"))
+        mock_pipe.assert_not_called()
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=True)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_incomplete_request(self, mock_get_dest_socket, mock_pipe):
+        self.proxy_server.keep_alive_timeout = 0.1
+        client_socket, src_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        src_socket.settimeout(0.05)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        # the body of the second request never completes
+        client_socket.sendall(request + b"POST http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\nContent-Length: 5\r\n\r\nte")
+        self.proxy_server.proxy_thread(src_socket, ("127.0.0.1", 8000))
+        self.assertTrue(client_socket.recv(1024).startswith(b"HTTP/1.1 408 Request Timeout\r\n"))
+        self.assertEqual(mock_pipe.call_count, 1)
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=True)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_connection_close(self, mock_get_dest_socket, mock_pipe):
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\nConnection: close\r\n\r\n"
+        mock_src_socket.recv.side_effect = iter([request * 2])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        self.assertEqual(mock_pipe.call_count, 1)
+
+    @patch("zoxy.server.ProxyServer.pipe", side_effect=[True, False])
+    @patch("zoxy.server.ProxyServer.get_dest_socket")
+    def test_proxy_thread_with_connection_pool(self, mock_get_dest_socket, mock_pipe):
+        dest_socket, origin_socket = socket.socketpair()
+        mock_get_dest_socket.return_value = dest_socket
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        mock_src_socket.recv.side_effect = iter([request * 2])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        # the second request reuses the dest connection of the first one
+        self.assertEqual(mock_get_dest_socket.call_count, 1)
+        self.assertIs(mock_pipe.call_args_list[1][0][2], dest_socket)
+        self.assertEqual(self.proxy_server.connection_pool.stats["hits"], 1)
+        self.assertEqual(self.proxy_server.connection_pool.stats["misses"], 1)
+        origin_socket.close()
+
+    def read_all(self, client_socket: socket.socket) -> bytes:
+        received = b""
+        while True:
+            data = client_socket.recv(1024)
+            if not data:
+                return received
+            received += data
+
+    @patch("zoxy.pool.ConnectionPool.is_usable", return_value=True)
+    @patch("zoxy.server.ProxyServer.get_dest_socket")
+    def test_proxy_thread_retries_closed_pooled_connection(self, mock_get_dest_socket, mock_is_usable):
+        client_socket, src_socket = socket.socketpair()
+        first_dest_socket, first_origin_socket = socket.socketpair()
+        second_dest_socket, second_origin_socket = socket.socketpair()
+        for sock in (client_socket, first_origin_socket, second_origin_socket):
+            self.addCleanup(sock.close)
+        mock_get_dest_socket.side_effect = [first_dest_socket, second_dest_socket]
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\ntest"
+        # the first origin closes its connection right after the first response
+        first_origin_socket.sendall(response)
+        first_origin_socket.shutdown(socket.SHUT_WR)
+        second_origin_socket.sendall(response)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        client_socket.sendall(request * 2)
+        client_socket.shutdown(socket.SHUT_WR)
+        self.proxy_server.proxy_thread(src_socket, ("127.0.0.1", 8000))
+
+        self.assertEqual(self.read_all(client_socket), response * 2)
+        self.assertEqual(mock_get_dest_socket.call_count, 2)
+        self.assertEqual(second_origin_socket.recv(1024), request)
+
+    @patch("zoxy.server.ProxyServer.get_dest_socket")
+    def test_proxy_thread_with_dest_closed_before_response(self, mock_get_dest_socket):
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        self.addCleanup(origin_socket.close)
+        mock_get_dest_socket.return_value = dest_socket
+        origin_socket.shutdown(socket.SHUT_WR)
+        client_socket.sendall(b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n")
+        client_socket.shutdown(socket.SHUT_WR)
+        self.proxy_server.proxy_thread(src_socket, ("127.0.0.1", 8000))
+
+        # a new connection is not retried
+        self.assertTrue(self.read_all(client_socket).startswith(b"HTTP/1.1 502 Bad Gateway\r\n"))
+        self.assertEqual(mock_get_dest_socket.call_count, 1)
+
+    @patch("zoxy.server.ProxyServer.get_dest_socket")
+    def test_proxy_thread_with_malformed_response(self, mock_get_dest_socket):
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        self.addCleanup(origin_socket.close)
+        mock_get_dest_socket.return_value = dest_socket
+        origin_socket.sendall(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nZZ\r\n")
+        client_socket.sendall(b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n")
+        client_socket.shutdown(socket.SHUT_WR)
+        self.proxy_server.proxy_thread(src_socket, ("127.0.0.1", 8000))
+
+        self.assertTrue(self.read_all(client_socket).startswith(b"HTTP/1.1 502 Bad Gateway\r\n"))
+        # the dest connection is closed, not kept out of the pool
+        self.assertEqual(self.proxy_server.connection_pool.active_count(), 0)
+        self.assertEqual(self.proxy_server.connection_pool.stats["idle"], 0)
+        self.assertEqual(origin_socket.recv(1024)[:3], b"GET")
+        self.assertEqual(origin_socket.recv(1024), b"")
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_resolves_once(self, mock_get_dest_socket, mock_pipe):
+        resolve_func = Mock(return_value="127.1.0.1")
+        self.proxy_server.resolver = Resolver(resolve_func=resolve_func)
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        mock_src_socket.recv.side_effect = iter([b"GET http://test.org/ HTTP/1.1\r\nHost: test.org\r\n\r\n"])
+        # forwarding and load balancing are both enabled, the name is still resolved once
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        resolve_func.assert_called_once_with("test.org")
+        mock_get_dest_socket.assert_called_with("test.org", 80, dest_ip="127.1.0.1")
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_load_balancing_policy(self, mock_get_dest_socket, mock_pipe):
+        self.proxy_server.load_balancing = dict(self.config["load_balancing"], policy="least_conn")
+        policy = self.proxy_server.routing.lb_policy
+        mock_pipe.side_effect = lambda *args, **kwargs: self.assertEqual(sum(policy.active), 1)
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        mock_src_socket.recv.side_effect = iter([b"GET http://127.0.0.1:8080/ HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        self.assertEqual(mock_pipe.call_count, 1)
+        # the backend connection is reported closed once the request is done
+        self.assertEqual(policy.active, [0, 0])
+
+    @patch("zoxy.server.ProxyServer.proxy_thread")
+    def test_admit_connection_per_ip_limit(self, mock_proxy_thread):
+        self.proxy_server.connection_limiter.max_connections_per_ip = 1
+        proxy_started = threading.Event()
+        proxy_release = threading.Event()
+        mock_proxy_thread.side_effect = lambda *args: (proxy_started.set(), proxy_release.wait(5))
+        self.addCleanup(proxy_release.set)
+        self.assertTrue(self.proxy_server.admit_connection(Mock(), ("127.0.0.1", 8000)))
+        self.assertTrue(proxy_started.wait(5))
+
+        refused_socket = Mock()
+        self.assertFalse(self.proxy_server.admit_connection(refused_socket, ("127.0.0.1", 8001)))
+        refused_socket.sendall.assert_called_once_with(b"HTTP/1.1 429 Too Many Requests\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+        refused_socket.close.assert_called_once_with()
+        stats = self.proxy_server.connection_stats
+        self.assertEqual(stats["active"], 1)
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["rejected"], 1)
+
+        # the slot is released once the connection is done
+        proxy_release.set()
+        for _ in range(500):
+            if not self.proxy_server.connection_limiter.connections:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(self.proxy_server.connection_limiter.connections, 0)
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=True)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_with_client_rate_limit(self, mock_get_dest_socket, mock_pipe):
+        self.proxy_server.client_rate_limits = [["127.0.0.0/24", "*", 1, "*"]]
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        mock_src_socket.recv.side_effect = iter([request * 2])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        # a second request within the same second is over the limit
+        self.assertEqual(mock_pipe.call_count, 1)
+        mock_src_socket.sendall.assert_called_with(b"HTTP/1.1 429 Too Many Requests\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+        self.assertEqual(self.proxy_server.rate_limit_stats["client_limited"], 1)
+
+    @patch("zoxy.server.ProxyServer.pipe", return_value=False)
+    @patch("zoxy.server.ProxyServer.get_dest_socket", return_value=Mock())
+    def test_proxy_thread_records_metrics(self, mock_get_dest_socket, mock_pipe):
+        mock_src_socket = Mock()
+        src_address = ("127.0.0.1", 8000)
+        request = b"GET http://127.0.0.1:8080/ HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"
+        mock_src_socket.recv.side_effect = iter([request])
+        self.proxy_server.proxy_thread(mock_src_socket, src_address)
+        metrics = self.proxy_server.metrics
+        self.assertEqual(metrics.requests.labels("http").value, 1)
+        self.assertEqual(metrics.client_bytes_received.value, len(request))
+        self.assertEqual(metrics.request_read_seconds.count, 1)
+        self.assertEqual(metrics.upstream_connect_seconds.count, 1)
+        self.assertRegex(metrics.registry.render(), r'zoxy_backend_selections_total\{backend="127\.0\.0\.1:909[01]"\} 1')
+
+    def test_apply_settings(self):
+        routing = self.proxy_server.routing
+        self.proxy_server.apply_settings({
+            "forwarding": [["196.168.0.0/24", "*", "127.0.0.3", "*"]],
+            "blocked_accesses": [],
+        })
+        new_routing = self.proxy_server.routing
+        self.assertIsNot(new_routing, routing)
+        self.assertEqual(self.proxy_server.forwarding, [["196.168.0.0/24", "*", "127.0.0.3", "*"]])
+        self.assertEqual(new_routing.settings["blocked_accesses"], [])
+        # settings not given keep their compiled parts
+        self.assertIs(new_routing.allowed_access_index, routing.allowed_access_index)
+        self.assertIs(new_routing.lb_policy, routing.lb_policy)
+        # a request that read the old snapshot still routes by it
+        self.assertEqual(self.proxy_server.get_forwarding_dest("196.168.0.1", 80, "196.168.0.1", routing), ("127.0.0.2", 80))
+        self.assertEqual(self.proxy_server.get_forwarding_dest("196.168.0.1", 80, "196.168.0.1"), ("127.0.0.3", 80))
+
+        with self.assertRaises(ValueError):
+            self.proxy_server.apply_settings({"forwarding": [], "unknown": []})
+        self.assertIs(self.proxy_server.routing, new_routing)
+
+    def test_proxy_thread_with_http_cache(self):
+        self.proxy_server.http_cache = HTTPCache()
+        client_socket, src_socket = socket.socketpair()
+        dest_socket, origin_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        self.addCleanup(origin_socket.close)
+        response = b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 4\r\n\r\ntest"
+        origin_socket.sendall(response)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        client_socket.sendall(request * 2)
+        client_socket.shutdown(socket.SHUT_WR)
+        with patch("zoxy.server.ProxyServer.get_dest_socket", return_value=dest_socket):
+            self.proxy_server.proxy_thread(src_socket, ("127.0.0.1", 8000))
+
+        received = b""
+        while True:
+            data = client_socket.recv(1024)
+            if not data:
+                break
+            received += data
+        # the second request is answered from the cache, the origin only got the first
+        self.assertEqual(received, response + b"HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: 4\r\nAge: 0\r\n\r\ntest")
+        self.assertEqual(origin_socket.recv(1024), request)
+        self.assertEqual(self.proxy_server.http_cache.stats["hits"], 1)
+        self.assertEqual(self.proxy_server.metrics.cache_requests.labels("hit").value, 1)
+        self.assertEqual(self.proxy_server.metrics.cache_requests.labels("miss").value, 1)
+
+    def test_proxy_thread_with_coalescer(self):
+        self.proxy_server.coalescer = RequestCoalescer()
+        dest_socket, origin_socket = socket.socketpair()
+        self.addCleanup(origin_socket.close)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\ntest"
+        client_sockets = []
+        proxy_threads = []
+        with patch("zoxy.server.ProxyServer.get_dest_socket", return_value=dest_socket) as mock_get_dest_socket:
+            for _ in range(3):
+                client_socket, src_socket = socket.socketpair()
+                self.addCleanup(client_socket.close)
+                client_socket.sendall(request)
+                client_socket.shutdown(socket.SHUT_WR)
+                client_sockets.append(client_socket)
+                proxy_threads.append(threading.Thread(target=self.proxy_server.proxy_thread, args=(src_socket, ("127.0.0.1", 8000))))
+                proxy_threads[-1].start()
+            # one request reaches the origin, the others wait for its response
+            self.assertEqual(origin_socket.recv(1024), request)
+            for _ in range(500):
+                if self.proxy_server.coalescer.stats["subscribers"] == 2:
+                    break
+                threading.Event().wait(0.01)
+            origin_socket.sendall(response)
+            for proxy_thread in proxy_threads:
+                proxy_thread.join(5)
+        self.assertEqual(mock_get_dest_socket.call_count, 1)
+        for client_socket in client_sockets:
+            self.assertEqual(client_socket.recv(1024), response)
+        self.assertEqual(self.proxy_server.metrics.coalesced_requests.labels("subscriber").value, 2)
+
+    def start_coalesced_request(self, request: bytes) -> Tuple[socket.socket, threading.Thread]:
+        client_socket, src_socket = socket.socketpair()
+        self.addCleanup(client_socket.close)
+        client_socket.sendall(request)
+        client_socket.shutdown(socket.SHUT_WR)
+        proxy_thread = threading.Thread(target=self.proxy_server.proxy_thread, args=(src_socket, ("127.0.0.1", 8000)))
+        proxy_thread.start()
+        return client_socket, proxy_thread
+
+    def wait_for_subscribers(self, subscribers: int):
+        for _ in range(500):
+            if self.proxy_server.coalescer.stats["subscribers"] == subscribers:
+                break
+            threading.Event().wait(0.01)
+
+    def test_coalesced_response_outlives_leader_client(self):
+        self.proxy_server.coalescer = RequestCoalescer()
+        dest_socket, origin_socket = socket.socketpair()
+        self.addCleanup(origin_socket.close)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\ntest"
+        with patch("zoxy.server.ProxyServer.get_dest_socket", return_value=dest_socket):
+            leader_socket, leader_thread = self.start_coalesced_request(request)
+            self.assertEqual(origin_socket.recv(1024), request)
+            subscribers = [self.start_coalesced_request(request) for _ in range(2)]
+            self.wait_for_subscribers(2)
+            # the leader's client goes away, the fetch goes on for the others
+            leader_socket.close()
+            origin_socket.sendall(response)
+            for _, proxy_thread in [(leader_socket, leader_thread)] + subscribers:
+                proxy_thread.join(5)
+        for client_socket, _ in subscribers:
+            self.assertEqual(client_socket.recv(1024), response)
+
+    def test_coalesced_request_rate_limited(self):
+        self.proxy_server.coalescer = RequestCoalescer()
+        self.proxy_server.client_rate_limits = [["127.0.0.0/24", "*", 1, "*"]]
+        dest_socket, origin_socket = socket.socketpair()
+        self.addCleanup(origin_socket.close)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        with patch("zoxy.server.ProxyServer.get_dest_socket", return_value=dest_socket):
+            _, leader_thread = self.start_coalesced_request(request)
+            self.assertEqual(origin_socket.recv(1024), request)
+            # the client used its one request of the second on the first request
+            subscriber_socket, subscriber_thread = self.start_coalesced_request(request)
+            subscriber_thread.join(5)
+            origin_socket.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\ntest")
+            leader_thread.join(5)
+        self.assertTrue(subscriber_socket.recv(1024).startswith(b"HTTP/1.1 429 "))
+
+    def test_private_response_not_coalesced(self):
+        self.proxy_server.coalescer = RequestCoalescer()
+        dest_socket, origin_socket = socket.socketpair()
+        self.addCleanup(origin_socket.close)
+        request = b"GET http://127.1.0.1/ HTTP/1.1\r\nHost: 127.1.0.1\r\n\r\n"
+        private_response = b"HTTP/1.1 200 OK\r\nSet-Cookie: id=1\r\nContent-Length: 4\r\n\r\ntest"
+        response = b"HTTP/1.1 200 OK\r\nSet-Cookie: id=2\r\nContent-Length: 4\r\n\r\ntest"
+        with patch("zoxy.server.ProxyServer.get_dest_socket", return_value=dest_socket):
+            leader_socket, leader_thread = self.start_coalesced_request(request)
+            self.assertEqual(origin_socket.recv(1024), request)
+            subscriber_socket, subscriber_thread = self.start_coalesced_request(request)
+            self.wait_for_subscribers(1)
+            origin_socket.sendall(private_response)
+            # the subscriber does not get the leader's cookie, it fetches on its own
+            self.assertEqual(origin_socket.recv(1024), request)
+            origin_socket.sendall(response)
+            leader_thread.join(5)
+            subscriber_thread.join(5)
+        self.assertEqual(leader_socket.recv(1024), private_response)
+        self.assertEqual(subscriber_socket.recv(1024), response)
@@ -0,0 +1,100 @@
+import os
+import signal
+import socket
+import threading
+import time
+import unittest
+
+from zoxy.workers import WorkerSupervisor
+
+from .test_aio import EchoServer
+
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork"), "worker processes need SO_REUSEPORT and fork")
+class WorkerSupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.echo_server = EchoServer()
+        self.supervisor = WorkerSupervisor(2, restart_delay=0.2, url="127.0.0.1", port=0)
+        self.supervisor.start()
+        self.supervise_thread = threading.Thread(target=self.supervisor.supervise, daemon=True)
+        self.supervise_thread.start()
+
+    def tearDown(self):
+        self.supervisor.close()
+        self.supervise_thread.join(5)
+        self.echo_server.close()
+
+    def tunnel(self) -> bytes:
+        # a CONNECT tunnel to the echo server through whichever worker accepts it, "" once refused
+        deadline = time.monotonic() + 5
+        while True:
+            try:
+                with socket.create_connection(("127.0.0.1", self.supervisor.port), timeout=5) as client_socket:
+                    client_socket.sendall(f"CONNECT 127.0.0.1:{self.echo_server.port} HTTP/1.1\r\n\r\n".encode())
+                    response = b""
+                    while b"\r\n\r\n" not in response:
+                        data = client_socket.recv(1024)
+                        if not data:
+                            return response
+                        response += data
+                    client_socket.sendall(b"ping")
+                    return client_socket.recv(1024)
+            except ConnectionResetError:
+                return b""
+            except ConnectionRefusedError:
+                # workers still starting
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def wait_for(self, condition, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def test_workers_share_port(self):
+        self.assertNotEqual(self.supervisor.port, 0)
+        self.assertEqual(len(set(self.supervisor.pids())), 2)
+        for _ in range(4):
+            self.assertEqual(self.tunnel(), b"ping")
+
+    def test_restart_dead_worker(self):
+        pids = self.supervisor.pids()
+        os.kill(pids[0], signal.SIGKILL)
+        self.wait_for(lambda: self.supervisor.restarts == 1)
+        new_pids = self.supervisor.pids()
+        self.assertNotIn(pids[0], new_pids)
+        self.assertIn(pids[1], new_pids)
+        self.assertEqual(len(new_pids), 2)
+        self.assertEqual(self.tunnel(), b"ping")
+
+    def test_settings_reach_every_worker(self):
+        self.assertEqual(self.tunnel(), b"ping")
+        self.supervisor.blocked_accesses = [["127.0.0.1/32", "*"]]
+        self.assertListEqual(self.supervisor.blocked_accesses, [["127.0.0.1/32", "*"]])
+        # every connection is refused, whichever worker takes it
+        self.wait_for(lambda: all(self.tunnel() == b"" for _ in range(8)))
+
+        # a restarted worker starts with the current settings
+        os.kill(self.supervisor.pids()[0], signal.SIGKILL)
+        self.wait_for(lambda: self.supervisor.restarts == 1)
+        for _ in range(8):
+            self.assertEqual(self.tunnel(), b"")
+
+    def test_apply_settings_reach_every_worker(self):
+        self.assertEqual(self.tunnel(), b"ping")
+        self.supervisor.apply_settings({"blocked_accesses": [["127.0.0.1/32", "*"]], "forwarding": []})
+        self.assertListEqual(self.supervisor.blocked_accesses, [["127.0.0.1/32", "*"]])
+        self.wait_for(lambda: all(self.tunnel() == b"" for _ in range(8)))
+
+    def test_invalid_settings_rejected(self):
+        with self.assertRaises(ValueError):
+            self.supervisor.apply_settings({"forwarding": [["not an ip", "*", "127.0.0.1", "*"]]})
+        with self.assertRaises(ValueError):
+            self.supervisor.apply_settings({"unknown": []})
+        with self.assertRaises(ValueError):
+            self.supervisor.blocked_accesses = [["127.0.0.1/8", "*"]]
+        self.assertNotIn("forwarding", self.supervisor.config)
+        self.assertListEqual(self.supervisor.blocked_accesses, [])
+        self.assertEqual(self.tunnel(), b"ping")
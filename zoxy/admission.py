@@ -0,0 +1,180 @@
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+OVERLOAD_POLICIES = ("queue", "reject")
+
+
+class ConnectionLimiter:
+    # open client connections, in total and per client ip
+    def __init__(self, max_connections: Optional[int] = None, max_connections_per_ip: Optional[int] = None):
+        self.max_connections = max_connections
+        self.max_connections_per_ip = max_connections_per_ip
+        self.rejected = 0
+        self.__connections = 0
+        self.__connections_per_ip = defaultdict(int) # type: Dict[str, int]
+        self.__lock = threading.Lock()
+
+    def admit(self, ip: str) -> Optional[str]:
+        # None when admitted, release it once closed, otherwise the limit it hit
+        with self.__lock:
+            if self.max_connections is not None and self.__connections >= self.max_connections:
+                self.rejected += 1
+                return "max_connections"
+            if self.max_connections_per_ip is not None and self.__connections_per_ip[ip] >= self.max_connections_per_ip:
+                self.rejected += 1
+                return "max_connections_per_ip"
+            self.__connections += 1
+            self.__connections_per_ip[ip] += 1
+            return None
+
+    def release(self, ip: str):
+        with self.__lock:
+            self.__connections -= 1
+            self.__connections_per_ip[ip] -= 1
+            if not self.__connections_per_ip[ip]:
+                del self.__connections_per_ip[ip]
+
+    @property
+    def connections(self) -> int:
+        return self.__connections
+
+    def connections_of(self, ip: str) -> int:
+        with self.__lock:
+            return self.__connections_per_ip.get(ip, 0)
+
+
+class ConnectionWorkerPool:
+    # at most max_workers threads serve connections, the rest wait in a bounded queue or are rejected at once
+    def __init__(
+        self,
+        handler: Callable[[socket.socket, tuple], None],
+        on_reject: Callable[[socket.socket, tuple], None],
+        max_workers: int = 512,
+        max_queue: int = 1024,
+        queue_timeout: float = 5,
+        overload_policy: str = "queue",
+    ):
+        if overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy: {overload_policy}, expected one of {', '.join(OVERLOAD_POLICIES)}")
+        self.handler = handler
+        # called for a connection that waited longer than queue_timeout
+        self.on_reject = on_reject
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.overload_policy = overload_policy
+        self.rejected = 0
+        self.queue_timeouts = 0
+        self.__queue = deque() # type: Deque[Optional[Tuple[float, socket.socket, tuple]]]
+        self.__threads = [] # type: List[threading.Thread]
+        # a worker stops being idle in the same step it takes a connection off the queue,
+        # so submit never counts a worker twice
+        self.__idle = 0
+        self.__busy = 0
+        self.__lock = threading.Lock()
+        self.__condition = threading.Condition(self.__lock)
+        # rejects timed out connections while every worker is busy, runs only as long as the queue does
+        self.__expiry_thread = None # type: Optional[threading.Thread]
+        self.__expiry_condition = threading.Condition(self.__lock)
+
+    def submit(self, client_socket: socket.socket, client_address: tuple) -> bool:
+        # False when the connection was not taken, the caller answers and closes it
+        with self.__condition:
+            # queued connections no idle worker is left for
+            waiting = len(self.__queue) - self.__idle
+            if waiting >= 0:
+                if len(self.__threads) < self.max_workers:
+                    self.__start_worker()
+                elif self.overload_policy == "reject" or waiting >= self.max_queue:
+                    self.rejected += 1
+                    return False
+                elif self.__expiry_thread is None:
+                    self.__start_expiry()
+            self.__queue.append((time.monotonic(), client_socket, client_address))
+            self.__condition.notify()
+        return True
+
+    def shutdown(self):
+        with self.__condition:
+            for _ in self.__threads:
+                self.__queue.append(None)
+            self.__threads = []
+            self.__condition.notify_all()
+            self.__expiry_condition.notify()
+
+    @property
+    def workers(self) -> int:
+        return len(self.__threads)
+
+    @property
+    def active(self) -> int:
+        return self.__busy
+
+    @property
+    def queued(self) -> int:
+        return len(self.__queue)
+
+    def __start_worker(self):
+        thread = threading.Thread(name=f"zoxy-connection-{len(self.__threads)}", target=self.__work, daemon=True)
+        self.__threads.append(thread)
+        self.__idle += 1
+        thread.start()
+
+    def __start_expiry(self):
+        self.__expiry_thread = threading.Thread(name="zoxy-connection-expiry", target=self.__expire, daemon=True)
+        self.__expiry_thread.start()
+
+    def __expire(self):
+        while True:
+            with self.__lock:
+                expired = []
+                now = time.monotonic()
+                # the oldest connection is first, a shutdown puts None after the queued ones
+                while self.__queue and self.__queue[0] is not None and now - self.__queue[0][0] > self.queue_timeout:
+                    expired.append(self.__queue.popleft())
+                if not expired:
+                    if not self.__queue or self.__queue[0] is None:
+                        self.__expiry_thread = None
+                        return
+                    self.__expiry_condition.wait(max(0, self.__queue[0][0] + self.queue_timeout - now))
+                    continue
+            for item in expired:
+                if item is not None:
+                    self.__reject(item[1], item[2])
+
+    def __reject(self, client_socket: socket.socket, client_address: tuple):
+        logger.warning(f"Connection waited over {self.queue_timeout}s for a worker: {client_address}")
+        self.queue_timeouts += 1
+        try:
+            self.on_reject(client_socket, client_address)
+        except Exception:
+            logger.exception(f"Connection reject error: {client_address}")
+
+    def __work(self):
+        while True:
+            with self.__condition:
+                while not self.__queue:
+                    self.__condition.wait()
+                item = self.__queue.popleft()
+                self.__idle -= 1
+                if item is None:
+                    return
+                self.__busy += 1
+            enqueued_time, client_socket, client_address = item
+            try:
+                if time.monotonic() - enqueued_time > self.queue_timeout:
+                    self.__reject(client_socket, client_address)
+                else:
+                    self.handler(client_socket, client_address)
+            except Exception:
+                logger.exception(f"Connection handler error: {client_address}")
+            finally:
+                with self.__lock:
+                    self.__busy -= 1
+                    self.__idle += 1
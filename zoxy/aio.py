@@ -0,0 +1,359 @@
+import asyncio
+import functools
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from .balancing import BackendLease
+from .http import HTTPBodyReader, HTTPParser, HTTPRequestReader, HTTPParseError, HTTPHeaderTooLarge, HTTPBodyTooLarge
+from .server import ProxyServer
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncProxyServer(ProxyServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__max_recv_len = 1024 * 1024 * 1
+        self.__max_header_len = 1024 * 64
+        self.__request_read_timeout = 10
+        self.__dest_connection_timeout = 1
+        self.__relay_idle_timeout = 60
+        self.__loop = None # type: Optional[asyncio.AbstractEventLoop]
+        self.__server = None # type: Optional[asyncio.AbstractServer]
+
+    def listen(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            super().close()
+
+    async def serve(self):
+        self.__loop = asyncio.get_event_loop()
+        self.__server = await asyncio.start_server(
+            self.proxy_connection,
+            sock=self.server_socket,
+            limit=self.__max_recv_len,
+        )
+        try:
+            await self.__server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.__server.close()
+            await self.__server.wait_closed()
+
+    def close(self):
+        if self.__loop is not None and self.__server is not None and not self.__loop.is_closed():
+            self.__loop.call_soon_threadsafe(self.__server.close)
+        else:
+            super().close()
+
+    async def proxy_connection(self, src_reader: asyncio.StreamReader, src_writer: asyncio.StreamWriter):
+        src_address = src_writer.get_extra_info("peername")[:2]
+        if self.is_client_refused(src_address):
+            src_writer.close()
+            return
+        self.metrics.connections_accepted.inc()
+
+        # the loop takes every connection, only the connection limits apply
+        limit = self.connection_limiter.admit(src_address[0])
+        if limit is not None:
+            logger.warning(f"Connection refused by {limit}: {src_address}")
+            self.metrics.connections_rejected.labels(limit).inc()
+            await self._write_error(src_writer, b"429 Too Many Requests" if limit == "max_connections_per_ip" else b"503 Service Unavailable")
+            return
+        try:
+            await self._serve_connection(src_reader, src_writer, src_address)
+        finally:
+            self.connection_limiter.release(src_address[0])
+
+    async def _serve_connection(self, src_reader: asyncio.StreamReader, src_writer: asyncio.StreamWriter, src_address: tuple):
+        extra_data = b""
+        request_count = 0
+        keep_alive = True
+        while keep_alive:
+            read_timeout = self.__request_read_timeout if request_count == 0 else self.keep_alive_timeout
+            try:
+                request_reader = await self._read_request(src_reader, extra_data, read_timeout)
+            except HTTPHeaderTooLarge as err:
+                logger.warning(f"Request header too large: {src_address}: {err}")
+                await self._write_error(src_writer, b"431 Request Header Fields Too Large")
+                return
+            except HTTPBodyTooLarge as err:
+                logger.warning(f"Request body too large: {src_address}: {err}")
+                await self._write_error(src_writer, b"413 Content Too Large")
+                return
+            except HTTPParseError as err:
+                logger.warning(f"Bad request: {src_address}: {err}")
+                await self._write_error(src_writer, b"400 Bad Request")
+                return
+            except asyncio.TimeoutError:
+                logger.warning(f"Request read timeout: {src_address}")
+                await self._write_error(src_writer, b"408 Request Timeout")
+                return
+            if not request_reader.complete:
+                logger.debug(f"Incomplete request: {src_address}")
+                break
+            request, extra_data = request_reader.pop()
+            request_count += 1
+            keep_alive = await self._proxy_request(src_reader, src_writer, src_address, request_reader, request, extra_data)
+            if request_count >= self.max_keep_alive_requests:
+                keep_alive = False
+
+        logger.debug("Close src stream")
+        src_writer.close()
+
+    async def _proxy_request(
+        self,
+        src_reader: asyncio.StreamReader,
+        src_writer: asyncio.StreamWriter,
+        src_address: tuple,
+        request_reader: HTTPRequestReader,
+        request: bytes,
+        extra_data: bytes,
+    ) -> bool:
+        logger.debug(request)
+        http_request = request_reader.get_http_request()
+        dest_url = http_request.request_target
+        logger.info(f"{src_address[0]}:{src_address[1]} -> {dest_url}")
+
+        logger.debug(f"HTTP request: {http_request}")
+        is_https_tunnel = False
+        if http_request.method == "CONNECT":
+            is_https_tunnel = True
+        self.metrics.requests.labels("tunnel" if is_https_tunnel else "http").inc()
+
+        # parse url
+        dest_domain, dest_port = self._parse_dest_url(dest_url)
+        org_dest_domain, org_dest_port = dest_domain, dest_port
+
+        # name lookups block, keep them off the loop
+        loop = asyncio.get_event_loop()
+        # the request finishes on these rules even when a reload publishes new ones
+        routing = self.routing
+        lb_lease = None # type: Optional[BackendLease]
+        try:
+            dest_domain, dest_port, dest_ip, lb_lease = await loop.run_in_executor(None, self.get_routing_dest, dest_domain, dest_port, src_address[0], routing)
+            allowed, throttle = self.acquire_rate_limits(src_address[0], dest_ip, dest_port, routing)
+            if not allowed:
+                logger.warning(f"Rate limited: {src_address[0]} -> {dest_domain}:{dest_port}")
+                await self._write_error(src_writer, b"429 Too Many Requests")
+                if lb_lease is not None:
+                    lb_lease.close()
+                return False
+            logger.info(f"Get dest {dest_domain}:{dest_port}")
+            start_time = loop.time()
+            dest_reader, dest_writer = await asyncio.wait_for(
+                asyncio.open_connection(dest_ip, dest_port, limit=self.__max_recv_len),
+                self.__dest_connection_timeout,
+            )
+            latency = loop.time() - start_time
+            self.metrics.upstream_connect_seconds.observe(latency)
+            if lb_lease is not None:
+                lb_lease.on_connect(latency)
+        except (OSError, UnicodeError, asyncio.TimeoutError) as err:
+            logger.warning(f"Connect dest warning: {err}")
+            await self._write_error(src_writer, b"502 Bad Gateway")
+            if lb_lease is not None:
+                # routing closes its own lease on errors, one left here failed to connect
+                lb_lease.on_connect_error()
+                self.metrics.backend_errors.labels(lb_lease.backend_name).inc()
+                lb_lease.close()
+            return False
+
+        on_dest_data = None
+        if self.response_capture is not None:
+            on_dest_data = functools.partial(self.response_capture, src_address)
+
+        keep_alive = False
+        try:
+            if is_https_tunnel:
+                src_writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+                dest_writer.write(extra_data)
+                start_time = loop.time()
+                await self._relay_both(src_reader, src_writer, dest_reader, dest_writer, on_dest_data, throttle)
+                self.metrics.tunnel_duration_seconds.observe(loop.time() - start_time)
+            else:
+                request = request.replace(f"{org_dest_domain}:{org_dest_port}".encode(), f"{dest_domain}:{dest_port}".encode())
+                logger.debug(f"Request: {str(request)}")
+                dest_writer.write(request)
+                keep_alive = await self._pipe_response(src_reader, src_writer, dest_reader, dest_writer, http_request.method, on_dest_data, throttle)
+                keep_alive = keep_alive and request_reader.parser.keep_alive
+        except (OSError, asyncio.TimeoutError) as err:
+            logger.debug(f"Pipe warning: {err}")
+        finally:
+            if lb_lease is not None:
+                lb_lease.close()
+
+        logger.debug("Close dest stream")
+        dest_writer.close()
+        return keep_alive
+
+    async def _pipe_response(
+        self,
+        src_reader: asyncio.StreamReader,
+        src_writer: asyncio.StreamWriter,
+        dest_reader: asyncio.StreamReader,
+        dest_writer: asyncio.StreamWriter,
+        request_method: str,
+        on_data: Optional[Callable[[bytes], None]] = None,
+        throttle: Optional[Callable[[int], float]] = None,
+    ) -> bool:
+        # forward exactly one response, returns whether the client connection may be reused
+        loop = asyncio.get_event_loop()
+        # the request was written right before
+        request_time = loop.time() # type: Optional[float]
+        data = b""
+        while True:
+            parser = HTTPParser(self.__max_header_len, is_response=True, request_method=request_method)
+            header_len = None # type: Optional[int]
+            while header_len is None:
+                if not data:
+                    data = await self._read_dest(dest_reader, throttle)
+                    if not data:
+                        return False
+                    if request_time is not None:
+                        self.metrics.time_to_first_byte_seconds.observe(loop.time() - request_time)
+                        request_time = None
+                header_len = parser.feed(data)
+                if header_len is None:
+                    await self._write_response(src_writer, data, on_data)
+                    data = b""
+
+            if parser.status_code == "101":
+                # switching protocols, e.g. websocket, nothing is HTTP after this
+                await self._write_response(src_writer, data, on_data)
+                await self._relay_both(src_reader, src_writer, dest_reader, dest_writer, on_data, throttle)
+                return False
+
+            body_reader = HTTPBodyReader(parser.framing, parser.content_length)
+            response_end = header_len + body_reader.feed(data, header_len)
+            await self._write_response(src_writer, data[:response_end], on_data)
+            data = data[response_end:]
+            while not body_reader.complete:
+                data = await self._read_dest(dest_reader, throttle)
+                if not data:
+                    body_reader.feed_eof()
+                    break
+                response_end = body_reader.feed(data)
+                await self._write_response(src_writer, data[:response_end], on_data)
+                data = data[response_end:]
+
+            if parser.status_code.startswith("1"):
+                # interim response, the final one follows
+                continue
+            return body_reader.complete and parser.keep_alive
+
+    async def _read_dest(self, dest_reader: asyncio.StreamReader, throttle: Optional[Callable[[int], float]] = None) -> bytes:
+        data = await asyncio.wait_for(dest_reader.read(self.__max_recv_len), self.__relay_idle_timeout)
+        await self._throttle(throttle, len(data))
+        return data
+
+    async def _throttle(self, throttle: Optional[Callable[[int], float]], received: int):
+        if throttle is None or not received:
+            return
+        pause = throttle(received)
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    async def _write_response(self, src_writer: asyncio.StreamWriter, data: bytes, on_data: Optional[Callable[[bytes], None]]):
+        if not data:
+            return
+        if on_data is not None:
+            on_data(data)
+        src_writer.write(data)
+        self.metrics.client_bytes_sent.inc(len(data))
+        await src_writer.drain()
+
+    async def _read_request(self, src_reader: asyncio.StreamReader, data: bytes = b"", timeout: Optional[float] = None) -> HTTPRequestReader:
+        # raises asyncio.TimeoutError once a started request is not complete in time
+        request_reader = HTTPRequestReader(self.__max_header_len, self.max_request_body_len)
+        if data:
+            request_reader.feed(data)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + (self.__request_read_timeout if timeout is None else timeout)
+        # from the first byte, a keep-alive connection may be idle long before it
+        start_time = loop.time() if data else None
+        while not request_reader.complete:
+            try:
+                data = await asyncio.wait_for(src_reader.read(self.__max_recv_len), deadline - loop.time())
+            except asyncio.TimeoutError:
+                logger.debug("Read request timeout")
+                if start_time is not None:
+                    raise
+                break
+            if not data:
+                break
+            self.metrics.client_bytes_received.inc(len(data))
+            if start_time is None:
+                start_time = loop.time()
+            request_reader.feed(data)
+        if request_reader.complete and start_time is not None:
+            self.metrics.request_read_seconds.observe(loop.time() - start_time)
+        return request_reader
+
+    async def _write_error(self, src_writer: asyncio.StreamWriter, status: bytes):
+        try:
+            src_writer.write(b"HTTP/1.1 " + status + b"\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+            await src_writer.drain()
+        except OSError:
+            pass
+        src_writer.close()
+
+    async def _relay_both(
+        self,
+        src_reader: asyncio.StreamReader,
+        src_writer: asyncio.StreamWriter,
+        dest_reader: asyncio.StreamReader,
+        dest_writer: asyncio.StreamWriter,
+        on_dest_data: Optional[Callable[[bytes], None]] = None,
+        throttle: Optional[Callable[[int], float]] = None,
+    ):
+        # like Relay, the idle timeout counts from the last data in either direction
+        last_activity = [asyncio.get_event_loop().time()]
+        received_len, sent_len = await asyncio.gather(
+            self._relay(src_reader, dest_writer, throttle=throttle, last_activity=last_activity),
+            self._relay(dest_reader, src_writer, on_dest_data, throttle, last_activity),
+        )
+        self.metrics.client_bytes_received.inc(received_len)
+        self.metrics.client_bytes_sent.inc(sent_len)
+
+    async def _relay(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        on_data: Optional[Callable[[bytes], None]] = None,
+        throttle: Optional[Callable[[int], float]] = None,
+        last_activity: Optional[List[float]] = None,
+    ) -> int:
+        # returns the bytes relayed, last_activity holds the loop time of the last data, shared with the other direction
+        loop = asyncio.get_event_loop()
+        if last_activity is None:
+            last_activity = [loop.time()]
+        relayed_len = 0
+        try:
+            while True:
+                timeout = last_activity[0] + self.__relay_idle_timeout - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    data = await asyncio.wait_for(reader.read(self.__max_recv_len), timeout)
+                except asyncio.TimeoutError:
+                    # the other direction may have had data meanwhile
+                    continue
+                if not data:
+                    break
+                last_activity[0] = loop.time()
+                if on_data is not None:
+                    on_data(data)
+                writer.write(data)
+                await writer.drain()
+                relayed_len += len(data)
+                await self._throttle(throttle, len(data))
+                # a throttled tunnel is not idle while it pauses
+                last_activity[0] = loop.time()
+            if writer.can_write_eof() and not writer.is_closing():
+                writer.write_eof()
+        except (OSError, asyncio.IncompleteReadError) as err:
+            logger.warning(f"Relay data warning: {err}")
+        return relayed_len
@@ -0,0 +1,307 @@
+import bisect
+import hashlib
+import itertools
+import math
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Sequence, Type
+
+if TYPE_CHECKING:
+    from .health import HealthChecker
+
+
+def distribute_backend(backend_access_count: Sequence[int], backend_access_rate: Sequence[float], backend_available: Optional[Sequence[bool]] = None) -> int:
+    # the backend furthest below its access rate, a backend never accessed goes first, an unavailable one never
+    total_backend_access = sum(backend_access_count)
+    min_rate_diff = float("-inf")
+    min_rate_diff_index = -1
+    for index, (current_backend_access_count, current_backend_access_rate) in enumerate(zip(backend_access_count, backend_access_rate)):
+        if backend_available is not None and not backend_available[index]:
+            continue
+        if total_backend_access != 0 and current_backend_access_count != 0:
+            rate = current_backend_access_count / total_backend_access
+            rate_diff = current_backend_access_rate - rate
+        else:
+            rate_diff = float("inf")
+        if rate_diff > min_rate_diff:
+            min_rate_diff = rate_diff
+            min_rate_diff_index = index
+
+    return min_rate_diff_index
+
+
+def get_schedule(backend_access_rate: Sequence[float], backend_available: Optional[Sequence[bool]] = None) -> List[int]:
+    # one period of distribute_backend choices, after it every available backend got exactly its share
+    if backend_available is not None and not any(backend_available):
+        backend_available = None
+    weights = [
+        round(access_rate * 100) if backend_available is None or backend_available[index] else 0
+        for index, access_rate in enumerate(backend_access_rate)
+    ]
+    weight_gcd = 0
+    for weight in weights:
+        weight_gcd = math.gcd(weight_gcd, weight)
+    period = sum(weights) // weight_gcd if weight_gcd else len(weights)
+
+    backend_access_count = [0] * len(weights)
+    schedule = []
+    for _ in range(period):
+        backend_index = distribute_backend(backend_access_count, backend_access_rate, backend_available)
+        backend_access_count[backend_index] += 1
+        schedule.append(backend_index)
+    return schedule
+
+
+class WeightedSchedule:
+    # O(1) selection without a lock: next() of itertools.count is atomic under the GIL
+    def __init__(self, backend_access_rate: Sequence[float], backend_available: Optional[Sequence[bool]] = None):
+        self.schedule = tuple(get_schedule(backend_access_rate, backend_available))
+        self.__counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.schedule)
+
+    def select(self) -> int:
+        return self.schedule[next(self.__counter) % len(self.schedule)]
+
+
+class BalancingPolicy:
+    # picks a backend index, told when a connection to a backend opens and closes
+    name = ""
+
+    def __init__(self, backend_access_rate: Sequence[float], clock: Callable[[], float] = time.monotonic, backend_names: Optional[Sequence[str]] = None):
+        self.weights = [access_rate if access_rate > 0 else 0.01 for access_rate in backend_access_rate]
+        self.clock = clock
+        # stable identities of the backends, e.g. "ip:port", independent of their order
+        self.backend_names = list(backend_names) if backend_names is not None else [str(index) for index in range(len(self.weights))]
+        self.active = [0] * len(self.weights)
+        self.available = [True] * len(self.weights)
+        # indexes select picks from: the available backends, all of them once none is left
+        self._candidates = tuple(range(len(self.weights)))
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.weights)
+
+    def set_available(self, backend_index: int, available: bool):
+        with self._lock:
+            self.available[backend_index] = available
+            candidates = tuple(index for index, backend_available in enumerate(self.available) if backend_available)
+            self._candidates = candidates or tuple(range(len(self.weights)))
+            self._on_available_changed()
+
+    def _on_available_changed(self):
+        pass
+
+    def select(self, key: Optional[str] = None) -> int:
+        # key is only used by policies that map a request attribute to a backend
+        raise NotImplementedError
+
+    def on_open(self, backend_index: int):
+        with self._lock:
+            self.active[backend_index] += 1
+
+    def on_close(self, backend_index: int):
+        with self._lock:
+            self.active[backend_index] -= 1
+
+    def on_latency(self, backend_index: int, latency: float):
+        pass
+
+
+class RatePolicy(BalancingPolicy):
+    # the access_rate split, see WeightedSchedule
+    name = "rate"
+
+    def __init__(self, backend_access_rate: Sequence[float], clock: Callable[[], float] = time.monotonic, backend_names: Optional[Sequence[str]] = None):
+        super().__init__(backend_access_rate, clock, backend_names)
+        self.backend_access_rate = list(backend_access_rate)
+        self.schedule = WeightedSchedule(backend_access_rate)
+
+    def _on_available_changed(self):
+        # a new schedule over the available backends, swapped whole so select stays lock-free
+        self.schedule = WeightedSchedule(self.backend_access_rate, self.available)
+
+    def select(self, key: Optional[str] = None) -> int:
+        return self.schedule.select()
+
+
+class LeastConnectionsPolicy(BalancingPolicy):
+    # fewest active connections relative to access_rate
+    name = "least_conn"
+
+    def select(self, key: Optional[str] = None) -> int:
+        with self._lock:
+            return min(self._candidates, key=lambda index: (self.active[index] + 1) / self.weights[index])
+
+
+class PeakEWMAPolicy(BalancingPolicy):
+    # lowest peak-EWMA latency times outstanding connections, a slow sample counts at once, a fast one decays in
+    name = "peak_ewma"
+
+    def __init__(
+        self,
+        backend_access_rate: Sequence[float],
+        clock: Callable[[], float] = time.monotonic,
+        backend_names: Optional[Sequence[str]] = None,
+        decay_time: float = 10,
+        default_latency: float = 0.001,
+    ):
+        super().__init__(backend_access_rate, clock, backend_names)
+        self.decay_time = decay_time
+        # the latency of a backend without samples yet, so its active connections still count
+        self.default_latency = default_latency
+        self.ewma = [0.0] * len(self.weights)
+        self.__stamp = [clock()] * len(self.weights)
+
+    def on_latency(self, backend_index: int, latency: float):
+        with self._lock:
+            now = self.clock()
+            ewma = self.ewma[backend_index]
+            if latency > ewma:
+                ewma = latency
+            else:
+                weight = math.exp(-max(now - self.__stamp[backend_index], 0) / self.decay_time)
+                ewma = ewma * weight + latency * (1 - weight)
+            self.ewma[backend_index] = ewma
+            self.__stamp[backend_index] = now
+
+    def latency(self, backend_index: int, now: Optional[float] = None) -> float:
+        # the EWMA decays toward default_latency while no samples come in, so a backend that was
+        # slow once and then got no more requests is tried again
+        ewma = self.ewma[backend_index]
+        if not ewma:
+            return self.default_latency
+        if now is None:
+            now = self.clock()
+        weight = math.exp(-max(now - self.__stamp[backend_index], 0) / self.decay_time)
+        return self.default_latency + (ewma - self.default_latency) * weight
+
+    def cost(self, backend_index: int, now: Optional[float] = None) -> float:
+        return self.latency(backend_index, now) * (self.active[backend_index] + 1) / self.weights[backend_index]
+
+    def select(self, key: Optional[str] = None) -> int:
+        with self._lock:
+            now = self.clock()
+            return min(self._candidates, key=lambda index: self.cost(index, now))
+
+
+class PowerOfTwoChoicesPolicy(LeastConnectionsPolicy):
+    # two random backends weighted by access_rate, the one with fewer active connections
+    name = "p2c"
+
+    def __init__(
+        self,
+        backend_access_rate: Sequence[float],
+        clock: Callable[[], float] = time.monotonic,
+        backend_names: Optional[Sequence[str]] = None,
+        rng: Optional[random.Random] = None,
+    ):
+        super().__init__(backend_access_rate, clock, backend_names)
+        self.rng = rng if rng is not None else random.Random()
+        self.__choices = (self._candidates, list(itertools.accumulate(self.weights)))
+
+    def _on_available_changed(self):
+        # the candidates with their weights, swapped as one tuple so select never pairs old and new
+        candidates = self._candidates
+        self.__choices = (candidates, list(itertools.accumulate(self.weights[index] for index in candidates)))
+
+    def select(self, key: Optional[str] = None) -> int:
+        candidates, cum_weights = self.__choices
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = self.rng.choices(candidates, cum_weights=cum_weights, k=2)
+        with self._lock:
+            if (self.active[second] + 1) / self.weights[second] < (self.active[first] + 1) / self.weights[first]:
+                return second
+            return first
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class ConsistentHashPolicy(BalancingPolicy):
+    # a hash ring with virtual nodes per backend name in proportion to access_rate, the same key maps to the
+    # same backend and adding or removing one backend moves about 1/N of the keys
+    name = "hash"
+
+    def __init__(
+        self,
+        backend_access_rate: Sequence[float],
+        clock: Callable[[], float] = time.monotonic,
+        backend_names: Optional[Sequence[str]] = None,
+        virtual_nodes: int = 160,
+    ):
+        super().__init__(backend_access_rate, clock, backend_names)
+        # a request without a key is split by access_rate over the available backends
+        self.backend_access_rate = list(backend_access_rate)
+        self.schedule = WeightedSchedule(backend_access_rate)
+        max_weight = max(self.weights, default=1)
+        ring = []
+        for index, (backend_name, weight) in enumerate(zip(self.backend_names, self.weights)):
+            for virtual_node in range(max(1, round(virtual_nodes * weight / max_weight))):
+                ring.append((hash_key(f"{backend_name}#{virtual_node}"), index))
+        ring.sort()
+        self.ring_hashes = [ring_hash for ring_hash, _ in ring]
+        self.ring_backends = [index for _, index in ring]
+
+    def _on_available_changed(self):
+        self.schedule = WeightedSchedule(self.backend_access_rate, self.available)
+
+    def select(self, key: Optional[str] = None) -> int:
+        if key is None or not self.ring_hashes:
+            return self.schedule.select()
+        position = bisect.bisect(self.ring_hashes, hash_key(key))
+        ring_size = len(self.ring_backends)
+        available = self.available
+        # the next virtual node clockwise whose backend is available, an ejected backend only moves its own keys
+        for offset in range(ring_size):
+            backend_index = self.ring_backends[(position + offset) % ring_size]
+            if available[backend_index]:
+                return backend_index
+        return self.ring_backends[position % ring_size]
+
+
+BALANCING_POLICIES = {
+    policy.name: policy
+    for policy in [RatePolicy, LeastConnectionsPolicy, PeakEWMAPolicy, PowerOfTwoChoicesPolicy, ConsistentHashPolicy]
+} # type: Dict[str, Type[BalancingPolicy]]
+
+
+def get_balancing_policy(name: str, backend_access_rate: Sequence[float], backend_names: Optional[Sequence[str]] = None) -> BalancingPolicy:
+    if name not in BALANCING_POLICIES:
+        raise ValueError(f"Unknown load balancing policy: {name}, expected one of {', '.join(BALANCING_POLICIES)}")
+    return BALANCING_POLICIES[name](backend_access_rate, backend_names=backend_names)
+
+
+class BackendLease:
+    # one request on a backend, the policy sees it open on creation and close once
+    def __init__(self, policy: BalancingPolicy, backend_index: int, health_checker: Optional["HealthChecker"] = None):
+        self.policy = policy
+        self.backend_index = backend_index
+        self.health_checker = health_checker
+        self.closed = False
+        policy.on_open(backend_index)
+
+    @property
+    def backend_name(self) -> str:
+        return self.policy.backend_names[self.backend_index]
+
+    def on_latency(self, latency: float):
+        self.policy.on_latency(self.backend_index, latency)
+
+    def on_connect(self, latency: float):
+        self.on_latency(latency)
+        if self.health_checker is not None:
+            self.health_checker.on_connect_success(self.backend_index)
+
+    def on_connect_error(self):
+        if self.health_checker is not None:
+            self.health_checker.on_connect_error(self.backend_index)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.policy.on_close(self.backend_index)
@@ -0,0 +1,617 @@
+import email.utils
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+from .http import FRAMING_CLOSE, HTTPHeaders, HTTPParser
+
+logger = logging.getLogger(__name__)
+
+# status codes stored without an explicit freshness lifetime too, RFC 9110 section 15.1
+CACHEABLE_STATUS_CODES = ("200", "203", "204", "300", "301", "308", "404", "405", "410", "414", "501")
+# methods that change the resource, their requests drop the stored responses of the url
+UNSAFE_METHODS = ("POST", "PUT", "DELETE", "PATCH")
+# fields of one connection, never stored or served from the cache
+HOP_BY_HOP_FIELDS = ("connection", "keep-alive", "proxy-connection", "proxy-authenticate", "proxy-authorization", "upgrade")
+# fields a 304 response to a client carries, RFC 9110 section 15.4.5
+NOT_MODIFIED_FIELDS = ("cache-control", "content-location", "date", "etag", "expires", "vary")
+# with only Last-Modified a response is fresh for this part of its age, at most a day
+HEURISTIC_FRESHNESS_RATE = 0.1
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+DISK_FILE_SUFFIX = ".zoxy-cache"
+
+CacheData = Union[bytes, mmap.mmap]
+
+
+def parse_cache_control(field_values: List[str]) -> Dict[str, Optional[str]]:
+    directives = {} # type: Dict[str, Optional[str]]
+    for field_value in field_values:
+        for directive in field_value.split(","):
+            name, has_value, value = directive.strip().partition("=")
+            if name:
+                directives[name.lower()] = value.strip("\"") if has_value else None
+    return directives
+
+
+def get_seconds(directives: Dict[str, Optional[str]], name: str) -> Optional[int]:
+    try:
+        return max(0, int(directives[name] or ""))
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def get_freshness_lifetime(headers: HTTPHeaders, cache_control: Dict[str, Optional[str]], status_code: str, response_time: float) -> float:
+    # a shared cache prefers s-maxage, then max-age, then Expires, then the Last-Modified heuristic
+    for name in ("s-maxage", "max-age"):
+        seconds = get_seconds(cache_control, name)
+        if seconds is not None:
+            return seconds
+    date = parse_http_date(headers.get("Date")) or response_time
+    if "Expires" in headers:
+        # an invalid date, e.g. "0", means already expired
+        expires = parse_http_date(headers.get("Expires"))
+        return max(0.0, expires - date) if expires is not None else 0.0
+    last_modified = parse_http_date(headers.get("Last-Modified"))
+    if last_modified is not None and status_code in CACHEABLE_STATUS_CODES:
+        return min(MAX_HEURISTIC_FRESHNESS, max(0.0, date - last_modified) * HEURISTIC_FRESHNESS_RATE)
+    return 0.0
+
+
+def get_initial_age(headers: HTTPHeaders, response_time: float) -> float:
+    # the larger of the Age the response came with and how old its Date says it is
+    try:
+        age = max(0, int(headers.get("Age") or 0))
+    except ValueError:
+        age = 0
+    date = parse_http_date(headers.get("Date"))
+    apparent_age = max(0.0, response_time - date) if date is not None else 0.0
+    return max(float(age), apparent_age)
+
+
+class CacheEntry(NamedTuple):
+    # a stored response, never changed in place: a revalidation stores a new one
+    key: str
+    url: str
+    # status line and fields, each ending with CRLF, then CRLF and the body as the origin framed it
+    data: CacheData
+    header_len: int
+    etag: Optional[str]
+    response_time: float
+    initial_age: float
+    freshness_lifetime: float
+    # served only after a revalidation, for no-cache responses
+    always_revalidate: bool
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def get_age(self, now: float) -> float:
+        return self.initial_age + max(0.0, now - self.response_time)
+
+    def is_fresh(self, now: float) -> bool:
+        return not self.always_revalidate and self.freshness_lifetime > self.get_age(now)
+
+    def get_headers(self) -> Tuple[bytes, HTTPHeaders]:
+        head = bytes(self.data[:self.header_len])
+        parser = HTTPParser(len(head) + 2, is_response=True)
+        parser.feed(head + b"\r\n")
+        return head[:head.find(b"\r\n")], parser.headers
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # still sent from somewhere, unmapped once nothing uses it
+                pass
+
+
+def build_head(status_line: bytes, headers: HTTPHeaders) -> bytes:
+    return status_line + b"\r\n" + b"".join(
+        f"{field_name}: {field_value}\r\n".encode("latin-1") for field_name, field_value in headers.items()
+    )
+
+
+class MemoryCacheTier:
+    # least recently used entries are evicted once they take more than max_bytes
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.__entries = OrderedDict() # type: OrderedDict[str, CacheEntry]
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.__entries
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self.__entries.get(key)
+        if entry is not None:
+            self.__entries.move_to_end(key)
+        return entry
+
+    def put(self, entry: CacheEntry) -> List[CacheEntry]:
+        # returns the evicted entries
+        self.pop(entry.key)
+        self.__entries[entry.key] = entry
+        self.bytes += entry.size
+        evicted = []
+        while self.bytes > self.max_bytes and self.__entries:
+            _, evicted_entry = self.__entries.popitem(last=False)
+            self.bytes -= evicted_entry.size
+            evicted.append(evicted_entry)
+        return evicted
+
+    def pop(self, key: str) -> Optional[CacheEntry]:
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        return entry
+
+
+class DiskCacheTier:
+    # one file per entry, served through mmap so a hit is sent from the page cache without reading it into Python
+    # the index is in memory, files of an earlier process are removed at start
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # entries without their data, and the size of it
+        self.__entries = OrderedDict() # type: OrderedDict[str, Tuple[CacheEntry, int]]
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for file_name in os.listdir(directory):
+            if file_name.endswith(DISK_FILE_SUFFIX):
+                self.__remove(os.path.join(directory, file_name))
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.__entries
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + DISK_FILE_SUFFIX)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self.__lock:
+            indexed = self.__entries.get(key)
+            if indexed is None:
+                return None
+            self.__entries.move_to_end(key)
+            entry = indexed[0]
+            try:
+                with open(self.get_path(key), "rb") as fh:
+                    data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as err:
+                logger.warning(f"Cache file of {entry.url} not readable: {err}")
+                self.__pop(key)
+                return None
+        return entry._replace(data=data)
+
+    def put(self, entry: CacheEntry) -> List[CacheEntry]:
+        # returns the evicted entries, or the entry itself when it was not written
+        path = self.get_path(entry.key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as fh:
+                fh.write(entry.data)
+            os.replace(temp_path, path)
+        except OSError as err:
+            logger.warning(f"Cache file of {entry.url} not written: {err}")
+            self.__remove(temp_path)
+            return [entry]
+        evicted = []
+        with self.__lock:
+            self.__pop(entry.key, remove=False)
+            self.__entries[entry.key] = (entry._replace(data=b""), entry.size)
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes and self.__entries:
+                evicted_entry = self.__pop(next(iter(self.__entries)))
+                if evicted_entry is not None:
+                    evicted.append(evicted_entry)
+        return evicted
+
+    def pop(self, key: str) -> Optional[CacheEntry]:
+        with self.__lock:
+            return self.__pop(key)
+
+    def __pop(self, key: str, remove: bool = True) -> Optional[CacheEntry]:
+        indexed = self.__entries.pop(key, None)
+        if indexed is None:
+            return None
+        self.bytes -= indexed[1]
+        if remove:
+            # a mapped file stays readable after it is removed
+            self.__remove(self.get_path(key))
+        return indexed[0]
+
+    @staticmethod
+    def __remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def get_key(url: str, vary_names: Tuple[str, ...], headers: HTTPHeaders) -> str:
+    # a response with Vary is stored per value of those request fields
+    if not vary_names:
+        return url
+    return url + "".join(f"\n{name}: {', '.join(headers.getall(name))}" for name in vary_names)
+
+
+def etag_matches(etag: Optional[str], if_none_match: List[str]) -> bool:
+    # weak comparison, RFC 9110 section 13.1.2
+    if etag is None:
+        return False
+    etag = etag[2:] if etag.startswith("W/") else etag
+    for field_value in if_none_match:
+        for candidate in field_value.split(","):
+            candidate = candidate.strip()
+            if candidate == "*" or (candidate[2:] if candidate.startswith("W/") else candidate) == etag:
+                return True
+    return False
+
+
+class _Fill:
+    # one in-flight fetch of a key, the same requests at once wait for it instead of fetching it too
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class CacheLookup:
+    # one GET through the cache: a fresh entry to serve, or a fetch that revalidates or stores one,
+    # ProxyServer.pipe_response records the response through on_head, on_body and on_end
+    def __init__(
+        self,
+        cache: "HTTPCache",
+        url: str,
+        headers: HTTPHeaders,
+        key: str,
+        entry: Optional[CacheEntry],
+        now: float,
+    ):
+        self.cache = cache
+        self.url = url
+        self.headers = headers
+        self.key = key
+        self.entry = entry
+        cache_control = parse_cache_control(headers.getall("Cache-Control"))
+        no_cache = "no-cache" in cache_control or "no-cache" in (headers.get("Pragma") or "").lower()
+        max_age = get_seconds(cache_control, "max-age")
+        self.fresh = (
+            entry is not None
+            and not no_cache
+            and entry.is_fresh(now)
+            and (max_age is None or entry.get_age(now) <= max_age)
+        )
+        # the If-None-Match sent for a stale entry, its 304 is answered from the entry
+        self.validator = None # type: Optional[str]
+        self.not_modified = False
+        self.fill = None # type: Optional[_Fill]
+        self.__entries = [entry] if entry is not None else [] # type: List[CacheEntry]
+        self.__parser = None # type: Optional[HTTPParser]
+        self.__body = [] # type: List[bytes]
+        self.__body_len = 0
+
+    def __enter__(self) -> "CacheLookup":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_upstream_request(self, request: bytes, header_len: int) -> bytes:
+        # a stale entry with an ETag is revalidated, unless the client sent a validator of its own
+        if self.entry is None or self.fresh or self.entry.etag is None or "If-None-Match" in self.headers:
+            return request
+        self.validator = self.entry.etag
+        return request[:header_len - 2] + f"If-None-Match: {self.validator}\r\n\r\n".encode("latin-1") + request[header_len:]
+
+    def get_response(self, keep_alive: bool) -> Tuple[bytes, memoryview]:
+        # the head and body sent to the client for the entry, a 304 when the client has it already
+        entry = self.entry
+        if entry is None:
+            raise ValueError(f"No stored response of {self.url}")
+        extra_fields = f"Age: {int(entry.get_age(self.cache.clock()))}\r\n"
+        if not keep_alive:
+            extra_fields += "Connection: close\r\n"
+        if etag_matches(entry.etag, self.headers.getall("If-None-Match")):
+            _, headers = entry.get_headers()
+            not_modified_headers = HTTPHeaders([
+                (field_name, field_value) for field_name, field_value in headers.items()
+                if field_name.lower() in NOT_MODIFIED_FIELDS
+            ])
+            head = build_head(b"HTTP/1.1 304 Not Modified", not_modified_headers)
+            return head + extra_fields.encode("latin-1") + b"\r\n", memoryview(b"")
+        data = memoryview(entry.data) # type: ignore[arg-type]
+        return bytes(data[:entry.header_len]) + extra_fields.encode("latin-1") + b"\r\n", data[entry.header_len + 2:]
+
+    def on_head(self, parser: HTTPParser) -> bool:
+        # returns whether the response goes on to the client
+        response_time = self.cache.clock()
+        if parser.status_code == "304" and self.entry is not None:
+            if self.validator is not None or etag_matches(self.entry.etag, parser.headers.getall("ETag")):
+                self.entry = self.cache.refresh(self.entry, parser.headers, response_time)
+                self.__entries.append(self.entry)
+                self.__end_fill()
+            if self.validator is not None:
+                self.not_modified = True
+                return False
+            return True
+        if self.cache.is_storable(parser):
+            self.__parser = parser
+        else:
+            self.cache.remove(self.url, self.key)
+            # nothing to wait for, the requests waiting for this fetch fetch on their own
+            self.__end_fill()
+        return True
+
+    def on_body(self, data: Union[bytes, memoryview]):
+        if self.__parser is None or not data:
+            return
+        self.__body_len += len(data)
+        if self.__body_len > self.cache.max_entry_bytes:
+            logger.debug(f"Response of {self.url} is too large for the cache")
+            self.__parser = None
+            self.__body = []
+            self.__end_fill()
+            return
+        self.__body.append(bytes(data))
+
+    def on_end(self, complete: bool):
+        parser, self.__parser = self.__parser, None
+        if parser is not None and complete:
+            self.cache.store(self.url, self.headers, parser, b"".join(self.__body), self.cache.clock())
+        self.__body = []
+        self.__end_fill()
+
+    def close(self):
+        self.__end_fill()
+        for entry in self.__entries:
+            entry.close()
+        self.__entries = []
+
+    def __end_fill(self):
+        fill, self.fill = self.fill, None
+        if fill is not None:
+            self.cache.end_fill(self.key, fill)
+
+
+class HTTPCache:
+    # shared cache of GET responses, RFC 9111: entries in a memory LRU by bytes, the least recently used
+    # of them move to the optional disk tier, which evicts by bytes too
+    def __init__(
+        self,
+        max_memory_bytes: int = 1024 * 1024 * 64,
+        max_entry_bytes: int = 1024 * 1024 * 16,
+        disk_directory: Optional[str] = None,
+        max_disk_bytes: int = 1024 * 1024 * 1024,
+        fill_timeout: float = 10,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.max_entry_bytes = max_entry_bytes
+        # seconds a miss waits for the same fetch of another request before fetching itself
+        self.fill_timeout = fill_timeout
+        # wall clock, freshness is counted from Date and Expires
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.stores = 0
+        self.evictions = 0
+        self.collapsed = 0
+        self.__memory = MemoryCacheTier(max_memory_bytes)
+        self.__disk = DiskCacheTier(disk_directory, max_disk_bytes) if disk_directory is not None else None
+        # url: (Vary field names of its last response, keys stored)
+        self.__urls = {} # type: Dict[str, Tuple[Tuple[str, ...], Set[str]]]
+        self.__fills = {} # type: Dict[str, _Fill]
+        self.__lock = threading.Lock()
+
+    def open(self, method: str, url: str, headers: HTTPHeaders, collapse: bool = True) -> Optional[CacheLookup]:
+        # None when the request bypasses the cache, without collapse every miss fetches
+        if method in UNSAFE_METHODS:
+            self.invalidate(url)
+            return None
+        if method != "GET" or not url.startswith("http://"):
+            return None
+        if any(field_name in headers for field_name in ("Authorization", "Range", "Upgrade")):
+            return None
+        if "no-store" in parse_cache_control(headers.getall("Cache-Control")):
+            return None
+
+        waited = False
+        while True:
+            with self.__lock:
+                vary_names = self.__urls.get(url, ((), set()))[0]
+                key = get_key(url, vary_names, headers)
+                entry = self.__memory.get(key)
+                if entry is None and self.__disk is not None:
+                    entry = self.__disk.get(key)
+                lookup = CacheLookup(self, url, headers, key, entry, self.clock())
+                if lookup.fresh:
+                    self.hits += 1
+                    if waited:
+                        self.collapsed += 1
+                    return lookup
+                fill = self.__fills.get(key) if collapse else None
+                if fill is None or waited:
+                    if fill is None and collapse:
+                        lookup.fill = self.__fills[key] = _Fill()
+                    self.misses += 1
+                    return lookup
+            # another request fetches it right now
+            lookup.close()
+            fill.done.wait(self.fill_timeout)
+            waited = True
+
+    def end_fill(self, key: str, fill: _Fill):
+        with self.__lock:
+            if self.__fills.get(key) is fill:
+                del self.__fills[key]
+        fill.done.set()
+
+    def is_storable(self, parser: HTTPParser) -> bool:
+        headers = parser.headers
+        cache_control = parse_cache_control(headers.getall("Cache-Control"))
+        if "no-store" in cache_control or "private" in cache_control:
+            return False
+        if any(name.strip() == "*" for field_value in headers.getall("Vary") for name in field_value.split(",")):
+            return False
+        if parser.status_code in CACHEABLE_STATUS_CODES:
+            return True
+        # other status codes only with an explicit lifetime
+        return any(name in cache_control for name in ("s-maxage", "max-age", "public")) or "Expires" in headers
+
+    def store(self, url: str, request_headers: HTTPHeaders, parser: HTTPParser, body: bytes, response_time: float):
+        headers = HTTPHeaders([
+            (field_name, field_value) for field_name, field_value in parser.headers.items()
+            if field_name.lower() not in HOP_BY_HOP_FIELDS + ("age",)
+            and field_name.lower() not in parser.connection_tokens
+        ])
+        if parser.framing == FRAMING_CLOSE:
+            # served on kept-alive connections, so the body needs a length
+            headers["Content-Length"] = str(len(body))
+        cache_control = parse_cache_control(headers.getall("Cache-Control"))
+        freshness_lifetime = get_freshness_lifetime(headers, cache_control, parser.status_code, response_time)
+        etag = headers.get("ETag")
+        if freshness_lifetime <= 0 and etag is None:
+            # stale at once and nothing to revalidate it with
+            return
+        vary_names = tuple(sorted({
+            name.strip().lower() for field_value in headers.getall("Vary") for name in field_value.split(",") if name.strip()
+        }))
+        key = get_key(url, vary_names, request_headers)
+        head = build_head(f"HTTP/1.1 {parser.status_code} {parser.status_msg}".encode("latin-1"), headers)
+        entry = CacheEntry(
+            key=key,
+            url=url,
+            data=head + b"\r\n" + body,
+            header_len=len(head),
+            etag=etag,
+            response_time=response_time,
+            initial_age=get_initial_age(parser.headers, response_time),
+            freshness_lifetime=freshness_lifetime,
+            always_revalidate="no-cache" in cache_control,
+        )
+        self.put(entry, vary_names)
+
+    def refresh(self, entry: CacheEntry, not_modified_headers: HTTPHeaders, response_time: float) -> CacheEntry:
+        # a 304 updates the stored fields, RFC 9111 section 4.3.4, the body stays
+        status_line, stored_headers = entry.get_headers()
+        updates = {} # type: Dict[str, Tuple[str, str]]
+        for field_name, field_value in not_modified_headers.items():
+            lower_name = field_name.lower()
+            if lower_name not in HOP_BY_HOP_FIELDS and lower_name not in ("age", "content-length", "transfer-encoding"):
+                updates[lower_name] = (field_name, field_value)
+        # updated fields keep their place
+        headers = HTTPHeaders()
+        for field_name, field_value in stored_headers.items():
+            lower_name = field_name.lower()
+            if lower_name not in updates:
+                headers.add(field_name, field_value)
+            elif lower_name not in headers:
+                headers.add(*updates[lower_name])
+        for lower_name, field in updates.items():
+            if field[0] not in headers:
+                headers.add(*field)
+        cache_control = parse_cache_control(headers.getall("Cache-Control"))
+        head = build_head(status_line, headers)
+        refreshed = entry._replace(
+            data=head + bytes(entry.data[entry.header_len:]),
+            header_len=len(head),
+            etag=headers.get("ETag"),
+            response_time=response_time,
+            initial_age=get_initial_age(not_modified_headers, response_time),
+            freshness_lifetime=get_freshness_lifetime(headers, cache_control, status_line.split(b" ")[1].decode("latin-1"), response_time),
+        )
+        with self.__lock:
+            self.revalidations += 1
+            vary_names = self.__urls.get(entry.url, ((), set()))[0]
+        self.put(refreshed, vary_names)
+        return refreshed
+
+    def put(self, entry: CacheEntry, vary_names: Tuple[str, ...] = ()):
+        if entry.size > self.max_entry_bytes:
+            return
+        with self.__lock:
+            self.stores += 1
+            keys = self.__urls.setdefault(entry.url, (vary_names, set()))[1]
+            self.__urls[entry.url] = (vary_names, keys)
+            keys.add(entry.key)
+            # large entries go to disk at once instead of pushing many small ones out of memory
+            if self.__disk is not None and entry.size > self.__memory.max_bytes // 8:
+                self.__memory.pop(entry.key)
+                demoted = [entry]
+            else:
+                demoted = self.__memory.put(entry)
+        dropped = [] # type: List[CacheEntry]
+        if self.__disk is not None:
+            if all(demoted_entry is not entry for demoted_entry in demoted):
+                # the disk copy is older than the one in memory now
+                self.__disk.pop(entry.key)
+            for demoted_entry in demoted:
+                dropped += self.__disk.put(demoted_entry)
+        else:
+            dropped = demoted
+        if dropped:
+            with self.__lock:
+                for dropped_entry in dropped:
+                    self.evictions += 1
+                    self.__forget(dropped_entry.key, dropped_entry.url)
+
+    def remove(self, url: str, key: str):
+        if self.__disk is not None:
+            self.__disk.pop(key)
+        with self.__lock:
+            self.__memory.pop(key)
+            self.__forget(key, url)
+
+    def invalidate(self, url: str):
+        with self.__lock:
+            _, keys = self.__urls.pop(url, ((), set()))
+            for key in keys:
+                self.__memory.pop(key)
+        if self.__disk is not None:
+            for key in keys:
+                self.__disk.pop(key)
+
+    def __forget(self, key: str, url: str):
+        # the entry is in no tier any more
+        if key in self.__memory or (self.__disk is not None and key in self.__disk):
+            return
+        keys = self.__urls.get(url, ((), set()))[1]
+        keys.discard(key)
+        if not keys:
+            self.__urls.pop(url, None)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "collapsed": self.collapsed,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "memory_entries": len(self.__memory),
+            "memory_bytes": self.__memory.bytes,
+            "disk_entries": len(self.__disk) if self.__disk is not None else 0,
+            "disk_bytes": self.__disk.bytes if self.__disk is not None else 0,
+        }
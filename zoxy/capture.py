@@ -0,0 +1,37 @@
+import threading
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+
+# Keep only the latest max_len bytes of responses, usable as ProxyServer(response_capture=...)
+class ResponseRingBuffer:
+    def __init__(self, max_len: int = 1024 * 1024 * 1):
+        self.max_len = max_len
+        self.__len = 0
+        self.__chunks = deque() # type: Deque[Tuple[tuple, bytes]]
+        self.__lock = threading.Lock()
+
+    def __call__(self, src_address: tuple, data: bytes):
+        if len(data) > self.max_len:
+            data = data[-self.max_len:]
+        with self.__lock:
+            self.__chunks.append((src_address, data))
+            self.__len += len(data)
+            while self.__len > self.max_len:
+                _, dropped = self.__chunks.popleft()
+                self.__len -= len(dropped)
+
+    def __len__(self) -> int:
+        return self.__len
+
+    def getvalue(self, src_address: Optional[tuple] = None) -> bytes:
+        with self.__lock:
+            return b"".join(
+                data for address, data in self.__chunks
+                if src_address is None or address == src_address
+            )
+
+    def clear(self):
+        with self.__lock:
+            self.__chunks.clear()
+            self.__len = 0
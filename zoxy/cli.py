@@ -1,7 +1,20 @@
 import argparse
 import logging
+import signal
+from typing import Union
 
-from .server import ProxyServer
+from .aio import AsyncProxyServer
+from .balancing import BALANCING_POLICIES
+from .cache import HTTPCache
+from .coalesce import RequestCoalescer
+from .config import ConfigWatcher, load_config
+from .h2c import H2cPool, h2
+from .health import HEALTH_PROBES
+from .metrics import MetricsServer
+from .pool import ConnectionPool
+from .resolver import Resolver
+from .server import LOAD_BALANCING_HASH_KEYS, ProxyServer
+from .workers import WorkerSupervisor
 
 logger = logging.getLogger(__name__)
 
@@ -10,6 +23,19 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-u", "--url", help="url", default="127.0.0.1", type=str)
     parser.add_argument("-p", "--port", help="Bind port", default=8080, type=int)
+    parser.add_argument(
+        "--config",
+        help="YAML, JSON or TOML file of routing settings, reloaded on SIGHUP or when it changes. "
+             "its settings replace the ones of the command line",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--config_watch_interval",
+        help="Seconds between checks of the config file for changes, 0 only reloads on SIGHUP",
+        default=1,
+        type=float,
+    )
     parser.add_argument(
         "--allowed_access",
         help="if using it, could only access what you set. "
@@ -37,6 +63,24 @@ def main():
         metavar=("original ip/mask", "original port", "destination ip", "destination port"),
         default=[],
     )
+    parser.add_argument(
+        "--client_rate_limit",
+        help="Limit every client ip in ip/mask, on the dest port, to requests and bytes per second. "
+             "for all ports or no limit, please input '*'",
+        action="append",
+        nargs=4,
+        metavar=("client ip/mask", "port", "requests per second", "bytes per second"),
+        default=[],
+    )
+    parser.add_argument(
+        "--dest_rate_limit",
+        help="Limit every dest ip in ip/mask, on the port, to requests and bytes per second. "
+             "for all ports or no limit, please input '*'",
+        action="append",
+        nargs=4,
+        metavar=("dest ip/mask", "port", "requests per second", "bytes per second"),
+        default=[],
+    )
     parser.add_argument(
         "--lb_frontend",
         help="Load balancing frontend",
@@ -52,8 +96,244 @@ def main():
         metavar=("backend ip/mask", "backend port", "access rate"),
         default=[],
     )
+    parser.add_argument(
+        "--lb_policy",
+        help="Load balancing policy: access rate split, least connections, peak EWMA latency, power of two choices or consistent hash",
+        choices=list(BALANCING_POLICIES),
+        default="rate",
+    )
+    parser.add_argument(
+        "--lb_hash_key",
+        help="What the hash policy keeps on one backend: the client ip, or the requested host",
+        choices=list(LOAD_BALANCING_HASH_KEYS),
+        default=None,
+    )
+    parser.add_argument(
+        "--lb_health_check",
+        help="Probe every load balancing backend in the background with a TCP connect or an HTTP GET",
+        choices=list(HEALTH_PROBES),
+        default=None,
+    )
+    parser.add_argument(
+        "--lb_health_check_interval",
+        help="Seconds between health checks of a backend",
+        default=5,
+        type=float,
+    )
+    parser.add_argument(
+        "--lb_health_check_path",
+        help="Path the HTTP health check requests, 2xx and 3xx responses are healthy",
+        default="/",
+        type=str,
+    )
+    parser.add_argument(
+        "--lb_unhealthy_threshold",
+        help="Failed health checks in a row that eject a backend",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--lb_healthy_threshold",
+        help="Passed health checks in a row that re-admit a backend",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--lb_consecutive_errors",
+        help="Connect errors in a row that eject a backend",
+        default=5,
+        type=int,
+    )
+    parser.add_argument(
+        "--lb_ejection_time",
+        help="Seconds a backend is ejected for after connect errors, longer for every ejection in a row",
+        default=30,
+        type=float,
+    )
+
+    parser.add_argument(
+        "--engine",
+        help="Connection handling engine: a thread per connection, or one asyncio event loop",
+        choices=["thread", "asyncio"],
+        default="thread",
+    )
+    parser.add_argument(
+        "--workers",
+        help="Worker processes sharing the port through SO_REUSEPORT, restarted when they die",
+        default=1,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--metrics_port",
+        help="Serve Prometheus metrics at http://127.0.0.1:<port>/metrics",
+        default=None,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--max_workers",
+        help="Threads serving client connections of the thread engine",
+        default=512,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_queued_connections",
+        help="Accepted connections waiting for a free worker thread",
+        default=1024,
+        type=int,
+    )
+    parser.add_argument(
+        "--queue_timeout",
+        help="Seconds a queued connection waits for a free worker, after that it gets 503 right away",
+        default=5,
+        type=float,
+    )
+    parser.add_argument(
+        "--overload_policy",
+        help="With every worker busy: queue connections, or reject them with 503 at once",
+        choices=["queue", "reject"],
+        default="queue",
+    )
+    parser.add_argument(
+        "--max_connections",
+        help="Open client connections, more get 503",
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_connections_per_ip",
+        help="Open client connections per client ip, more get 429",
+        default=None,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--keep_alive_timeout",
+        help="Seconds an idle client connection is kept open for the next request",
+        default=15,
+        type=float,
+    )
+    parser.add_argument(
+        "--max_keep_alive_requests",
+        help="Requests served on one client connection before it is closed",
+        default=100,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_request_body_len",
+        help="Bytes of a request body, a larger one gets 413",
+        default=1024 * 1024 * 10,
+        type=int,
+    )
+    parser.add_argument(
+        "--pool_max_idle_per_host",
+        help="Idle dest connections kept per host and port for reuse, 0 disables reuse",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "--pool_max_per_host",
+        help="Dest connections opened at once per host and port",
+        default=100,
+        type=int,
+    )
+    parser.add_argument(
+        "--pool_idle_timeout",
+        help="Seconds an idle dest connection is kept for reuse",
+        default=30,
+        type=float,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Cache GET responses of plain HTTP requests by Cache-Control, Expires and ETag, thread engine only",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache_max_memory",
+        help="Bytes of responses cached in memory",
+        default=1024 * 1024 * 64,
+        type=int,
+    )
+    parser.add_argument(
+        "--cache_max_entry",
+        help="Bytes of the largest response cached",
+        default=1024 * 1024 * 16,
+        type=int,
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Directory of the disk cache, responses pushed out of memory go there",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--cache_max_disk",
+        help="Bytes of responses cached on disk",
+        default=1024 * 1024 * 1024,
+        type=int,
+    )
+    parser.add_argument(
+        "--coalesce",
+        help="The same plain HTTP GETs at once share one dest fetch, the others stream its response, thread engine only",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--coalesce_max_buffer",
+        help="Bytes of a fetch after which no more requests join it",
+        default=1024 * 1024 * 8,
+        type=int,
+    )
+    parser.add_argument(
+        "--coalesce_max_lag",
+        help="Bytes a joined request may fall behind the fetch before it is dropped",
+        default=1024 * 1024 * 8,
+        type=int,
+    )
+    parser.add_argument(
+        "--upstream_h2c",
+        help="Send plain HTTP requests to forwarding and load-balancing backends as HTTP/2 streams in cleartext, "
+        "the backends must speak h2c, needs the h2 package, thread engine only",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--h2c_max_connections",
+        help="HTTP/2 connections per backend",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--h2c_max_streams",
+        help="Concurrent streams per HTTP/2 connection, the backend may allow fewer",
+        default=100,
+        type=int,
+    )
+    parser.add_argument(
+        "--dns_ttl",
+        help="Seconds a resolved name is cached",
+        default=60,
+        type=float,
+    )
+    parser.add_argument(
+        "--dns_negative_ttl",
+        help="Seconds a failed name lookup is cached",
+        default=5,
+        type=float,
+    )
 
     args = parser.parse_args()
+    if args.metrics_port is not None and args.workers > 1:
+        parser.error("--metrics_port needs a single worker process, every worker has its own metrics")
+    if args.cache and args.engine == "asyncio":
+        parser.error("--cache needs the thread engine")
+    if args.coalesce and args.engine == "asyncio":
+        parser.error("--coalesce needs the thread engine")
+    if args.upstream_h2c and args.engine == "asyncio":
+        parser.error("--upstream_h2c needs the thread engine")
+    if args.upstream_h2c and h2 is None:
+        parser.error("--upstream_h2c needs the h2 package")
+    if args.cache_dir is not None and args.workers > 1:
+        parser.error("--cache_dir needs a single worker process, every worker has its own cache")
 
     config = {
         "url": args.url,
@@ -61,11 +341,74 @@ def main():
         "allowed_accesses": args.allowed_access,
         "blocked_accesses": args.blocked_access,
         "forwarding": args.forwarding,
+        "client_rate_limits": args.client_rate_limit,
+        "dest_rate_limits": args.dest_rate_limit,
         "load_balancing": {
             "frontend": args.lb_frontend,
             "backend": args.lb_backend,
-        }
+            "policy": args.lb_policy,
+            "hash_key": args.lb_hash_key,
+            "health_check": {
+                "probe": args.lb_health_check,
+                "interval": args.lb_health_check_interval,
+                "path": args.lb_health_check_path,
+                "unhealthy_threshold": args.lb_unhealthy_threshold,
+                "healthy_threshold": args.lb_healthy_threshold,
+                "consecutive_errors": args.lb_consecutive_errors,
+                "ejection_time": args.lb_ejection_time,
+            },
+        },
+        "max_workers": args.max_workers,
+        "max_queued_connections": args.max_queued_connections,
+        "queue_timeout": args.queue_timeout,
+        "overload_policy": args.overload_policy,
+        "max_connections": args.max_connections,
+        "max_connections_per_ip": args.max_connections_per_ip,
+        "keep_alive_timeout": args.keep_alive_timeout,
+        "max_keep_alive_requests": args.max_keep_alive_requests,
+        "max_request_body_len": args.max_request_body_len,
+        "connection_pool": ConnectionPool(
+            max_idle_per_host=args.pool_max_idle_per_host,
+            max_per_host=args.pool_max_per_host,
+            idle_timeout=args.pool_idle_timeout,
+        ),
+        "resolver": Resolver(ttl=args.dns_ttl, negative_ttl=args.dns_negative_ttl),
+        "http_cache": HTTPCache(
+            max_memory_bytes=args.cache_max_memory,
+            max_entry_bytes=args.cache_max_entry,
+            disk_directory=args.cache_dir,
+            max_disk_bytes=args.cache_max_disk,
+        ) if args.cache else None,
+        "coalescer": RequestCoalescer(
+            max_buffer_len=args.coalesce_max_buffer,
+            max_lag_len=args.coalesce_max_lag,
+        ) if args.coalesce else None,
+        "h2c_pool": H2cPool(
+            max_connections_per_host=args.h2c_max_connections,
+            max_concurrent_streams=args.h2c_max_streams,
+            idle_timeout=args.pool_idle_timeout,
+        ) if args.upstream_h2c else None,
     }
+    file_settings = None
+    if args.config is not None:
+        try:
+            file_settings = load_config(args.config)
+        except (OSError, ValueError) as err:
+            parser.error(f"--config: {err}")
+        config.update(file_settings)
     logger.debug(f"Proxy setting: {config}")
-    ProxyServer(**config).listen()
+    server_class = AsyncProxyServer if args.engine == "asyncio" else ProxyServer
+    if args.workers > 1:
+        server = WorkerSupervisor(args.workers, server_class, **config) # type: Union[ProxyServer, WorkerSupervisor]
+    else:
+        proxy_server = server_class(**config)
+        if args.metrics_port is not None:
+            MetricsServer(proxy_server.metrics.registry, port=args.metrics_port).start()
+        server = proxy_server
+    if args.config is not None:
+        watcher = ConfigWatcher(args.config, server.apply_settings, args.config_watch_interval, file_settings)
+        watcher.start()
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: watcher.request_reload())
+    server.listen()
 
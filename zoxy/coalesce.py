@@ -0,0 +1,200 @@
+import logging
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from .cache import get_key, parse_cache_control
+from .http import BytesLike, HTTPHeaders, HTTPParser
+
+logger = logging.getLogger(__name__)
+
+# requests that differ in these usually get different responses, they do not share a fetch
+COALESCING_VARY_FIELDS = ("accept", "accept-encoding", "accept-language")
+# requests with these get a response of their own
+NOT_COALESCED_FIELDS = ("Authorization", "Cookie", "Range", "Upgrade", "If-None-Match", "If-Modified-Since", "If-Match", "If-Unmodified-Since", "If-Range")
+
+
+def get_coalescing_key(method: str, http_version: str, url: str, headers: HTTPHeaders) -> Optional[str]:
+    # None when the request fetches on its own
+    if method != "GET" or http_version != "HTTP/1.1" or not url.startswith("http://"):
+        return None
+    if any(field_name in headers for field_name in NOT_COALESCED_FIELDS):
+        return None
+    return get_key(url, COALESCING_VARY_FIELDS, headers)
+
+
+def is_shareable(parser: HTTPParser) -> bool:
+    # whether a response head may go to other clients than the one whose request fetched it
+    if parser.status_code.startswith("1") or "Set-Cookie" in parser.headers:
+        return False
+    directives = parse_cache_control(parser.headers.getall("Cache-Control"))
+    return "private" not in directives and "no-store" not in directives
+
+
+class FanoutLagError(OSError):
+    pass
+
+
+class FanoutReader:
+    def __init__(self, buffer: "FanoutBuffer"):
+        self.buffer = buffer
+        # bytes of the stream read so far
+        self.offset = 0
+        self.dropped = False
+
+    def read(self, timeout: Optional[float] = None) -> bytes:
+        return self.buffer.read(self, timeout)
+
+    def close(self):
+        self.buffer.close_reader(self)
+
+
+class FanoutBuffer:
+    # one writer appends and never waits, every reader reads the whole stream at its own pace.
+    # readers join until the stream outgrows max_buffer_len, from then on chunks every reader has
+    # passed are dropped, and a reader more than max_lag_len behind the writer is cut off
+    def __init__(self, max_buffer_len: int = 1024 * 1024 * 8, max_lag_len: int = 1024 * 1024 * 8):
+        self.max_buffer_len = max_buffer_len
+        self.max_lag_len = max_lag_len
+        self.done = False
+        self.joinable = True
+        # whether the response may go to other readers than the first one
+        self.shared = True
+        self.__chunks = deque() # type: Deque[Tuple[int, bytes]]
+        self.__end = 0
+        self.__readers = set() # type: Set[FanoutReader]
+        self.__condition = threading.Condition()
+
+    @property
+    def len(self) -> int:
+        return self.__end
+
+    def subscribe(self) -> Optional[FanoutReader]:
+        with self.__condition:
+            if not self.joinable or self.done:
+                return None
+            reader = FanoutReader(self)
+            self.__readers.add(reader)
+            return reader
+
+    def append(self, data: bytes):
+        if not data:
+            return
+        with self.__condition:
+            self.__chunks.append((self.__end, data))
+            self.__end += len(data)
+            if self.__end > self.max_buffer_len:
+                self.joinable = False
+            if not self.joinable:
+                for reader in list(self.__readers):
+                    if self.__end - reader.offset > self.max_lag_len:
+                        logger.debug(f"Fanout reader {self.__end - reader.offset} bytes behind, dropped")
+                        reader.dropped = True
+                        self.__readers.discard(reader)
+                self.__trim()
+            self.__condition.notify_all()
+
+    def make_private(self):
+        # the readers that joined already stop at the head, see shared
+        with self.__condition:
+            self.shared = False
+            self.joinable = False
+
+    def finish(self):
+        with self.__condition:
+            self.done = True
+            self.joinable = False
+            self.__condition.notify_all()
+
+    def read(self, reader: FanoutReader, timeout: Optional[float] = None) -> bytes:
+        # what the writer appended since the last read, b"" once it finished, waits for it otherwise
+        with self.__condition:
+            while True:
+                if reader.dropped:
+                    raise FanoutLagError("Too far behind the stream")
+                if reader.offset < self.__end:
+                    data = b"".join(
+                        chunk[max(0, reader.offset - offset):] for offset, chunk in self.__chunks
+                        if offset + len(chunk) > reader.offset
+                    )
+                    reader.offset = self.__end
+                    if not self.joinable:
+                        self.__trim()
+                    return data
+                if self.done:
+                    return b""
+                if not self.__condition.wait(timeout):
+                    raise TimeoutError("No stream data in time")
+
+    def close_reader(self, reader: FanoutReader):
+        with self.__condition:
+            self.__readers.discard(reader)
+            if not self.joinable:
+                self.__trim()
+
+    def __trim(self):
+        # keeps what the slowest reader has not read yet
+        offset = min((reader.offset for reader in self.__readers), default=self.__end)
+        while self.__chunks and self.__chunks[0][0] + len(self.__chunks[0][1]) <= offset:
+            self.__chunks.popleft()
+
+
+class FanoutSink:
+    # the client socket of a fetch: what the fetch sends goes into the buffer, an error status
+    # is kept for the leader's client only, the others then fetch on their own
+    def __init__(self, buffer: FanoutBuffer, max_header_len: int = 1024 * 64):
+        self.buffer = buffer
+        self.error = None # type: Optional[bytes]
+        self.__parser = HTTPParser(max_header_len, is_response=True, request_method="GET") # type: Optional[HTTPParser]
+
+    def sendall(self, data: BytesLike):
+        data = bytes(data)
+        if self.__parser is not None and self.__parser.feed(data) is not None:
+            # decided before the head reaches any reader
+            if not is_shareable(self.__parser):
+                self.buffer.make_private()
+            self.__parser = None
+        self.buffer.append(data)
+
+    def getpeername(self) -> tuple:
+        raise OSError("A fetch has no peer")
+
+
+class RequestCoalescer:
+    # single flight: while one request fetches a key, the same requests stream its response instead of fetching it too
+    def __init__(self, max_buffer_len: int = 1024 * 1024 * 8, max_lag_len: int = 1024 * 1024 * 8):
+        self.max_buffer_len = max_buffer_len
+        self.max_lag_len = max_lag_len
+        self.leaders = 0
+        self.subscribers = 0
+        self.__flights = {} # type: Dict[str, FanoutBuffer]
+        self.__lock = threading.Lock()
+
+    def join(self, key: str) -> Tuple[FanoutBuffer, Optional[FanoutReader]]:
+        # a reader of the fetch in flight, or no reader and a new buffer to fetch into, see finish()
+        with self.__lock:
+            flight = self.__flights.get(key)
+            if flight is not None:
+                reader = flight.subscribe()
+                if reader is not None:
+                    self.subscribers += 1
+                    return flight, reader
+            # none in flight, or too far along to join
+            flight = FanoutBuffer(self.max_buffer_len, self.max_lag_len)
+            self.__flights[key] = flight
+            self.leaders += 1
+            return flight, None
+
+    def finish(self, key: str, flight: FanoutBuffer):
+        with self.__lock:
+            if self.__flights.get(key) is flight:
+                del self.__flights[key]
+        flight.finish()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "leaders": self.leaders,
+            "subscribers": self.subscribers,
+            "in_flight": len(self.__flights),
+        }
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .snapshot import ROUTING_SETTINGS
+
+try:
+    import tomllib # type: ignore[import]
+except ImportError: # before Python 3.11
+    try:
+        import tomli as tomllib # type: ignore[import, no-redef]
+    except ImportError:
+        tomllib = None # type: ignore[assignment]
+
+try:
+    import yaml # type: ignore[import]
+except ImportError:
+    yaml = None # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+FileSignature = Tuple[int, int, int]
+
+
+def load_config(path: str) -> Dict[str, Any]:
+    # settings by name in ROUTING_SETTINGS, in the format of the ProxyServer properties
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".json":
+        with open(path, "r", encoding="utf-8") as fh:
+            settings = json.load(fh)
+    elif extension == ".toml":
+        if tomllib is None:
+            raise ValueError(f"Config {path} is TOML, which needs Python 3.11 or the tomli package")
+        with open(path, "rb") as fh:
+            settings = tomllib.load(fh)
+    elif extension in (".yaml", ".yml"):
+        if yaml is None:
+            raise ValueError(f"Config {path} is YAML, which needs the PyYAML package")
+        with open(path, "r", encoding="utf-8") as fh:
+            settings = yaml.safe_load(fh) or {}
+    else:
+        raise ValueError(f"Config {path} is not .json, .toml, .yaml or .yml")
+
+    if not isinstance(settings, dict):
+        raise ValueError(f"Config {path} is not a mapping of settings")
+    unknown_settings = set(settings) - set(ROUTING_SETTINGS)
+    if unknown_settings:
+        raise ValueError(f"Config {path} has unknown settings: {', '.join(sorted(unknown_settings))}")
+    return settings
+
+
+def get_file_signature(path: str) -> Optional[FileSignature]:
+    # an atomic rename changes the inode, an edit in place the mtime or size
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class ConfigWatcher:
+    # reloads a config file on change or on request, and applies only the settings that changed,
+    # so rate limit buckets and backend health of unchanged settings are kept
+    # a setting removed from the file keeps its last value, a file that fails to load keeps all of them
+    def __init__(
+        self,
+        path: str,
+        apply: Callable[[Dict[str, Any]], None],
+        interval: float = 1,
+        settings: Optional[Dict[str, Any]] = None,
+    ):
+        self.path = path
+        self.apply = apply
+        # seconds between file checks, 0 only reloads on request
+        self.interval = interval
+        self.reloads = 0
+        self.errors = 0
+        # what the file set at the last load, settings were applied from it already when given
+        self.__settings = dict(settings) if settings is not None else {} # type: Dict[str, Any]
+        self.__signature = get_file_signature(path)
+        self.__lock = threading.Lock()
+        self.__reload_event = threading.Event()
+        self.__reload_requested = False
+        self.__stop_flag = False
+        self.__thread = None # type: Optional[threading.Thread]
+
+    def reload(self) -> bool:
+        with self.__lock:
+            self.__signature = get_file_signature(self.path)
+            try:
+                settings = load_config(self.path)
+                changes = {name: value for name, value in settings.items() if self.__settings.get(name) != value}
+                if changes:
+                    self.apply(changes)
+            except Exception as err:
+                self.errors += 1
+                logger.error(f"Config {self.path} not reloaded, keeping the running settings: {err}")
+                return False
+            self.__settings.update(settings)
+            self.reloads += 1
+        logger.info(f"Config {self.path} reloaded: {', '.join(sorted(changes)) or 'no changes'}")
+        return True
+
+    def request_reload(self):
+        # safe from a signal handler, the watcher thread does the reload
+        self.__reload_requested = True
+        self.__reload_event.set()
+
+    def start(self):
+        self.__stop_flag = False
+        self.__thread = threading.Thread(name="zoxy-config-watcher", target=self.__watch, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_flag = True
+        self.__reload_event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __watch(self):
+        while not self.__stop_flag:
+            self.__reload_event.wait(self.interval if self.interval > 0 else None)
+            self.__reload_event.clear()
+            if self.__stop_flag:
+                break
+            if self.__reload_requested:
+                self.__reload_requested = False
+                self.reload()
+            elif self.interval > 0:
+                signature = get_file_signature(self.path)
+                if signature is not None and signature != self.__signature:
+                    self.reload()
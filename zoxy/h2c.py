@@ -0,0 +1,512 @@
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from http import HTTPStatus
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .http import HTTPParseError, HTTPParser
+from .pool import ConnectionPoolFull, DestClosedError
+
+try:
+    import h2.config # type: ignore[import]
+    import h2.connection # type: ignore[import]
+    import h2.errors # type: ignore[import]
+    import h2.events # type: ignore[import]
+    import h2.exceptions # type: ignore[import]
+    import h2.settings # type: ignore[import]
+except ImportError:
+    h2 = None # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+# connection-specific fields, HTTP/2 does not carry them
+HOP_BY_HOP_FIELDS = (b"connection", b"keep-alive", b"proxy-connection", b"transfer-encoding", b"upgrade", b"host")
+# responses without a body whatever their fields say
+NO_BODY_STATUSES = (b"204", b"304")
+
+
+def get_h2_request_headers(request: bytes) -> Tuple[List[Tuple[bytes, bytes]], bytes]:
+    # an HTTP/1.1 request with its whole body as HTTP/2 headers and body
+    parser = HTTPParser(max_header_len=len(request) + 1)
+    header_len = parser.feed(request)
+    if header_len is None:
+        raise ValueError("Incomplete request head")
+    target = parser.request_target
+    authority = parser.headers.get("Host") or ""
+    path = target
+    if target.startswith("http://"):
+        authority, _, path = target[len("http://"):].partition("/")
+        path = "/" + path
+    elif not target.startswith("/"):
+        raise ValueError(f"Request target {target} has no http:// URL or path")
+
+    headers = [
+        (b":method", parser.method.encode("latin-1")),
+        (b":scheme", b"http"),
+        (b":authority", authority.encode("latin-1")),
+        (b":path", path.encode("latin-1")),
+    ]
+    connection_tokens = [token.encode("latin-1") for token in parser.connection_tokens]
+    for field_name, field_value in parser.raw_headers:
+        lower_name = bytes(field_name).lower()
+        if lower_name in HOP_BY_HOP_FIELDS or lower_name in connection_tokens:
+            continue
+        if lower_name == b"te" and bytes(field_value).strip().lower() != b"trailers":
+            continue
+        headers.append((lower_name, bytes(field_value)))
+    return headers, request[header_len:]
+
+
+def get_http1_response_head(headers: List[Tuple[bytes, bytes]], request_method: str) -> Tuple[bytes, bool]:
+    # the HTTP/1.1 head of an HTTP/2 response, and whether its body is sent chunked
+    status = b""
+    fields = []
+    has_content_length = False
+    for field_name, field_value in headers:
+        if field_name == b":status":
+            status = field_value
+        elif not field_name.startswith(b":"):
+            has_content_length = has_content_length or field_name == b"content-length"
+            fields.append(b"%s: %s\r\n" % (field_name, field_value))
+    try:
+        reason = HTTPStatus(int(status)).phrase.encode()
+    except ValueError:
+        reason = b""
+    is_chunked = not (
+        has_content_length
+        or request_method == "HEAD"
+        or status in NO_BODY_STATUSES
+        or status.startswith(b"1")
+    )
+    if is_chunked:
+        fields.append(b"transfer-encoding: chunked\r\n")
+    return b"HTTP/1.1 %s %s\r\n%s\r\n" % (status, reason, b"".join(fields)), is_chunked
+
+
+class H2cStreamRefused(DestClosedError):
+    # the server did not process the request of the stream, it may be sent again on another stream
+    pass
+
+
+class H2cStream:
+    # one request on an h2c connection, for the proxy it is a dest socket:
+    # sendall() takes the HTTP/1.1 request, recv() gives back the HTTP/1.1 response
+    def __init__(self, connection: "H2cConnection", timeout: Optional[float]):
+        self.connection = connection
+        self.stream_id = None # type: Optional[int]
+        self.request_method = ""
+        self.is_chunked = False
+        self.ended = False
+        self.error = None # type: Optional[OSError]
+        self.__timeout = timeout
+        self.__data = bytearray()
+        # flow-controlled bytes received but not read yet
+        self.__unacknowledged_len = 0
+        self.__closed = False
+
+    def sendall(self, data: bytes):
+        if self.stream_id is not None:
+            raise OSError("The request of the stream was sent already")
+        try:
+            headers, body = get_h2_request_headers(data)
+        except (ValueError, HTTPParseError) as err:
+            raise OSError(f"Request not sent over HTTP/2: {err}")
+        self.request_method = headers[0][1].decode("latin-1")
+        self.connection.send_request(self, headers, body)
+
+    def recv(self, buffer_size: int) -> bytes:
+        return self.connection.read_stream(self, buffer_size, self.__timeout)
+
+    def settimeout(self, timeout: Optional[float]):
+        self.__timeout = timeout
+
+    def gettimeout(self) -> Optional[float]:
+        return self.__timeout
+
+    def getpeername(self) -> tuple:
+        return self.connection.sock.getpeername()
+
+    def shutdown(self, how: int):
+        pass
+
+    def close(self):
+        if not self.__closed:
+            self.__closed = True
+            self.connection.close_stream(self)
+
+    # the connection calls these with its lock held
+
+    def _feed(self, data: bytes, flow_controlled_len: int = 0):
+        self.__data += data
+        self.__unacknowledged_len += flow_controlled_len
+
+    def _take(self, buffer_size: Optional[int] = None) -> Tuple[bytes, int]:
+        # data, and the flow-controlled bytes to acknowledge, all of them once the buffer is drained,
+        # so a stream holds at most its window of unread data
+        if buffer_size is None:
+            buffer_size = len(self.__data)
+        data = bytes(self.__data[:buffer_size])
+        del self.__data[:buffer_size]
+        acknowledged_len = 0
+        if not self.__data:
+            acknowledged_len, self.__unacknowledged_len = self.__unacknowledged_len, 0
+        return data, acknowledged_len
+
+
+class H2cConnection:
+    # one multiplexed HTTP/2 connection in cleartext (prior knowledge, no upgrade), a reader thread
+    # receives the frames of every stream, the h2 state is only touched with the lock held
+    def __init__(
+        self,
+        sock: socket.socket,
+        max_concurrent_streams: int = 100,
+        stream_window_len: int = 1024 * 1024,
+        on_stream_closed: Optional[Callable[["H2cConnection"], None]] = None,
+        on_broken: Optional[Callable[["H2cConnection"], None]] = None,
+    ):
+        if h2 is None:
+            raise RuntimeError("Upstream HTTP/2 needs the h2 package")
+        self.sock = sock
+        # frames of many streams are small and interleaved, none should wait for the ack of another
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.max_concurrent_streams = max_concurrent_streams
+        self.on_stream_closed = on_stream_closed
+        self.on_broken = on_broken
+        # no new streams once closed, streams in progress still finish unless the connection broke
+        self.closed = False
+        self.broken = False
+        # streams handed out by the pool and not closed yet
+        self.reserved_streams = 0
+        self.last_used_time = time.monotonic()
+        self.__streams = {} # type: Dict[int, H2cStream]
+        self.__condition = threading.Condition()
+
+        config = h2.config.H2Configuration(client_side=True, header_encoding=None)
+        self.__h2 = h2.connection.H2Connection(config=config)
+        self.__h2.local_settings = h2.settings.Settings(
+            client=True,
+            initial_values={
+                h2.settings.SettingCodes.ENABLE_PUSH: 0,
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: max_concurrent_streams,
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: stream_window_len,
+            },
+        )
+        self.__h2.initiate_connection()
+        # a stalled stream must not hold up the others, the connection window fits every stream window
+        self.__h2.increment_flow_control_window(min(max_concurrent_streams * stream_window_len, 2 ** 31 - 1 - 65535))
+        self.sock.sendall(self.__h2.data_to_send())
+
+        self.__thread = threading.Thread(name="zoxy-h2c-reader", target=self.__read_frames, daemon=True)
+        self.__thread.start()
+
+    @property
+    def stream_limit(self) -> int:
+        # the lower of ours and what the server allows
+        with self.__condition:
+            return min(self.max_concurrent_streams, self.__h2.remote_settings.max_concurrent_streams)
+
+    def send_request(self, stream: H2cStream, headers: List[Tuple[bytes, bytes]], body: bytes):
+        with self.__condition:
+            if self.broken:
+                raise ConnectionAbortedError("HTTP/2 connection closed")
+            try:
+                stream_id = self.__h2.get_next_available_stream_id()
+                self.__h2.send_headers(stream_id, headers, end_stream=not body)
+            except h2.exceptions.TooManyStreamsError as err:
+                # the server lowered its limit, the other streams are fine
+                raise H2cStreamRefused(f"HTTP/2 stream refused: {err!r}")
+            except h2.exceptions.ProtocolError as err:
+                raise self.__fail(ConnectionResetError(f"HTTP/2 request not sent: {err!r}"))
+            stream.stream_id = stream_id
+            self.__streams[stream_id] = stream
+            self.__flush()
+            self.last_used_time = time.monotonic()
+
+            body_view = memoryview(body)
+            while body_view:
+                if stream.error is not None:
+                    raise stream.error
+                # the request body goes out as fast as the stream and connection windows let it
+                window_len = min(self.__h2.local_flow_control_window(stream_id), self.__h2.max_outbound_frame_size)
+                if window_len <= 0:
+                    if not self.__condition.wait(stream.gettimeout()):
+                        raise socket.timeout("No HTTP/2 window update in time")
+                    continue
+                chunk, body_view = body_view[:window_len], body_view[window_len:]
+                try:
+                    self.__h2.send_data(stream_id, chunk.tobytes(), end_stream=not body_view)
+                except h2.exceptions.ProtocolError as err:
+                    raise self.__fail(ConnectionResetError(f"HTTP/2 request body not sent: {err!r}"))
+                self.__flush()
+
+    def read_stream(self, stream: H2cStream, buffer_size: int, timeout: Optional[float]) -> bytes:
+        # response bytes as HTTP/1.1, b"" after the end of the response
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.__condition:
+            while True:
+                data, acknowledged_len = stream._take(buffer_size)
+                if acknowledged_len and stream.stream_id is not None:
+                    self.__acknowledge(acknowledged_len, stream.stream_id)
+                if data:
+                    return data
+                if stream.error is not None:
+                    raise stream.error
+                if stream.ended:
+                    return b""
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout("No HTTP/2 response data in time")
+                self.__condition.wait(remaining)
+
+    def close_stream(self, stream: H2cStream):
+        with self.__condition:
+            if stream.stream_id is not None and self.__streams.pop(stream.stream_id, None) is not None:
+                # unread data still counts against the connection window
+                _, acknowledged_len = stream._take()
+                if acknowledged_len:
+                    self.__acknowledge(acknowledged_len, stream.stream_id)
+                if not stream.ended and not self.broken:
+                    # the client went away before the end of the response
+                    try:
+                        self.__h2.reset_stream(stream.stream_id, h2.errors.ErrorCodes.CANCEL)
+                        self.__flush()
+                    except (h2.exceptions.ProtocolError, OSError) as err:
+                        logger.debug(f"HTTP/2 stream reset not sent: {err!r}")
+            self.last_used_time = time.monotonic()
+        if self.on_stream_closed is not None:
+            self.on_stream_closed(self)
+
+    def close(self):
+        with self.__condition:
+            if not self.broken:
+                try:
+                    self.__h2.close_connection()
+                    self.__flush()
+                except (h2.exceptions.ProtocolError, OSError):
+                    pass
+            self.__fail(ConnectionAbortedError("HTTP/2 connection closed"))
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def __read_frames(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError as err:
+                with self.__condition:
+                    self.__fail(ConnectionResetError(f"HTTP/2 connection lost: {err}"))
+                break
+            with self.__condition:
+                if not data:
+                    self.__fail(ConnectionResetError("HTTP/2 connection closed by the server"))
+                    break
+                try:
+                    for event in self.__h2.receive_data(data):
+                        self.__handle_event(event)
+                    # settings and ping acknowledgements
+                    self.__flush()
+                except (h2.exceptions.ProtocolError, OSError) as err:
+                    self.__fail(ConnectionResetError(f"HTTP/2 connection failed: {err!r}"))
+                    break
+                self.__condition.notify_all()
+        if self.on_broken is not None:
+            self.on_broken(self)
+
+    def __handle_event(self, event):
+        if isinstance(event, h2.events.ConnectionTerminated):
+            # GOAWAY: streams after the last one the server processes get no response
+            self.closed = True
+            error = H2cStreamRefused(f"HTTP/2 connection ended by the server: {event.error_code!r}")
+            for stream_id, stream in self.__streams.items():
+                if event.last_stream_id is None or stream_id > event.last_stream_id:
+                    stream.error = error
+            return
+
+        stream = self.__streams.get(getattr(event, "stream_id", None))
+        if stream is None:
+            if isinstance(event, h2.events.DataReceived):
+                # data of a stream closed here, the connection window still needs it back
+                self.__acknowledge(event.flow_controlled_length, event.stream_id)
+            return
+        if isinstance(event, (h2.events.ResponseReceived, h2.events.InformationalResponseReceived)):
+            head, is_chunked = get_http1_response_head(event.headers, stream.request_method)
+            if isinstance(event, h2.events.ResponseReceived):
+                stream.is_chunked = is_chunked
+            stream._feed(head)
+        elif isinstance(event, h2.events.DataReceived):
+            if stream.is_chunked and event.data:
+                stream._feed(b"%x\r\n%s\r\n" % (len(event.data), event.data), event.flow_controlled_length)
+            else:
+                stream._feed(event.data, event.flow_controlled_length)
+        elif isinstance(event, h2.events.StreamEnded):
+            if stream.is_chunked:
+                stream._feed(b"0\r\n\r\n")
+            stream.ended = True
+        elif isinstance(event, h2.events.StreamReset):
+            if event.error_code == h2.errors.ErrorCodes.REFUSED_STREAM:
+                stream.error = H2cStreamRefused("HTTP/2 stream refused by the server")
+            else:
+                stream.error = ConnectionResetError(f"HTTP/2 stream reset by the server: {event.error_code!r}")
+
+    def __acknowledge(self, acknowledged_len: int, stream_id: int):
+        if self.broken:
+            return
+        try:
+            self.__h2.acknowledge_received_data(acknowledged_len, stream_id)
+            self.__flush()
+        except (h2.exceptions.ProtocolError, OSError) as err:
+            logger.debug(f"HTTP/2 window update not sent: {err!r}")
+
+    def __flush(self):
+        data = self.__h2.data_to_send()
+        if data:
+            try:
+                self.sock.sendall(data)
+            except OSError as err:
+                # part of a frame may be out, nothing else can go on this connection
+                raise self.__fail(ConnectionResetError(f"HTTP/2 connection lost: {err}"))
+
+    def __fail(self, error: OSError) -> OSError:
+        # with the lock held: every stream without a complete response gets the error
+        self.closed = True
+        self.broken = True
+        for stream in self.__streams.values():
+            if not stream.ended and stream.error is None:
+                stream.error = error
+        self.__condition.notify_all()
+        return error
+
+
+class H2cPool:
+    # a few multiplexed h2c connections per (host, port), each carrying up to its stream limit of requests at once
+    def __init__(
+        self,
+        max_connections_per_host: int = 2,
+        max_concurrent_streams: int = 100,
+        stream_window_len: int = 1024 * 1024,
+        idle_timeout: float = 30,
+        wait_timeout: float = 1,
+    ):
+        if h2 is None:
+            raise RuntimeError("Upstream HTTP/2 needs the h2 package")
+        self.max_connections_per_host = max_connections_per_host
+        self.max_concurrent_streams = max_concurrent_streams
+        self.stream_window_len = stream_window_len
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.connects = 0
+        self.streams = 0
+        self.__connections = defaultdict(list) # type: Dict[Tuple[str, int], List[H2cConnection]]
+        self.__connecting = defaultdict(int) # type: Dict[Tuple[str, int], int]
+        self.__condition = threading.Condition()
+
+    def open_stream(self, host: str, port: int, connect: Callable[[str, int], socket.socket]) -> H2cStream:
+        key = (host, port)
+        deadline = time.monotonic() + self.wait_timeout
+        self.evict_expired()
+        with self.__condition:
+            while True:
+                connections = self.__connections[key]
+                connections[:] = [connection for connection in connections if not connection.closed]
+                # the busiest connection with room, so the others go idle and expire
+                connection = max(
+                    (connection for connection in connections if connection.reserved_streams < connection.stream_limit),
+                    key=lambda connection: connection.reserved_streams,
+                    default=None,
+                )
+                if connection is not None:
+                    connection.reserved_streams += 1
+                    self.streams += 1
+                    return H2cStream(connection, connection.sock.gettimeout())
+                if len(connections) + self.__connecting[key] < self.max_connections_per_host:
+                    self.__connecting[key] += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionPoolFull(f"Too many HTTP/2 streams to {host}:{port}")
+                self.__condition.wait(remaining)
+
+        connection = None
+        try:
+            sock = connect(host, port)
+            try:
+                connection = H2cConnection(
+                    sock,
+                    self.max_concurrent_streams,
+                    self.stream_window_len,
+                    on_stream_closed=self.__on_stream_closed,
+                    on_broken=self.__on_broken,
+                )
+            except BaseException:
+                sock.close()
+                raise
+        finally:
+            with self.__condition:
+                self.__connecting[key] -= 1
+                if connection is not None:
+                    connection.reserved_streams += 1
+                    self.__connections[key].append(connection)
+                    self.connects += 1
+                    self.streams += 1
+                self.__condition.notify_all()
+        return H2cStream(connection, sock.gettimeout())
+
+    def evict_expired(self):
+        expired = []
+        expired_time = time.monotonic() - self.idle_timeout
+        with self.__condition:
+            for connections in self.__connections.values():
+                for connection in list(connections):
+                    if connection.reserved_streams == 0 and connection.last_used_time < expired_time:
+                        connections.remove(connection)
+                        expired.append(connection)
+        for connection in expired:
+            connection.close()
+
+    def clear(self):
+        with self.__condition:
+            connections = [connection for connections in self.__connections.values() for connection in connections]
+            self.__connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def connection_count(self, host: Optional[str] = None, port: int = 0) -> int:
+        with self.__condition:
+            if host is not None:
+                return len(self.__connections.get((host, port), ()))
+            return sum(len(connections) for connections in self.__connections.values())
+
+    @property
+    def stats(self) -> dict:
+        with self.__condition:
+            connections = [connection for connections in self.__connections.values() for connection in connections]
+        return {
+            "connects": self.connects,
+            "streams": self.streams,
+            "connections": len(connections),
+            "active_streams": sum(connection.reserved_streams for connection in connections),
+        }
+
+    def __on_stream_closed(self, connection: H2cConnection):
+        with self.__condition:
+            connection.reserved_streams -= 1
+            self.__condition.notify_all()
+            # a connection that stopped taking streams is closed after its last one
+            is_done = connection.closed and connection.reserved_streams == 0
+        if is_done:
+            connection.close()
+
+    def __on_broken(self, connection: H2cConnection):
+        with self.__condition:
+            # waiting requests may open a new connection instead
+            self.__condition.notify_all()
+            is_done = connection.reserved_streams == 0
+        if is_done:
+            connection.close()
@@ -0,0 +1,184 @@
+import logging
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .balancing import BalancingPolicy
+
+logger = logging.getLogger(__name__)
+
+
+def tcp_probe(host: str, port: int, timeout: float, path: str = "/") -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def http_probe(host: str, port: int, timeout: float, path: str = "/") -> bool:
+    # a 2xx or 3xx status line is healthy
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nConnection: close\r\n\r\n".encode())
+            status_line = b""
+            while b"\r\n" not in status_line and len(status_line) < 1024:
+                data = sock.recv(1024)
+                if not data:
+                    break
+                status_line += data
+    except OSError:
+        return False
+    parts = status_line.split(b"\r\n", 1)[0].split(b" ", 2)
+    return len(parts) >= 2 and parts[0].startswith(b"HTTP/") and parts[1][:1] in (b"2", b"3")
+
+
+HEALTH_PROBES = {
+    "tcp": tcp_probe,
+    "http": http_probe,
+} # type: Dict[str, Callable[..., bool]]
+
+
+class BackendHealth:
+    def __init__(self):
+        # active probes
+        self.probe_down = False
+        self.probe_failures = 0
+        self.probe_successes = 0
+        # passive outlier detection
+        self.connect_errors = 0
+        self.ejections = 0
+        self.ejected_until = None # type: Optional[float]
+
+    @property
+    def available(self) -> bool:
+        return not self.probe_down and self.ejected_until is None
+
+
+class HealthChecker:
+    # marks load-balancing backends unavailable on the policy, from background probes and from connect errors
+    def __init__(
+        self,
+        policy: BalancingPolicy,
+        backends: Sequence[Tuple[str, Optional[int]]],
+        probe: Optional[str] = None,
+        interval: float = 5,
+        timeout: float = 1,
+        path: str = "/",
+        healthy_threshold: int = 2,
+        unhealthy_threshold: int = 3,
+        consecutive_errors: int = 5,
+        ejection_time: float = 30,
+        max_ejection_time: float = 300,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if probe is not None and probe not in HEALTH_PROBES:
+            raise ValueError(f"Unknown health check probe: {probe}, expected one of {', '.join(HEALTH_PROBES)}")
+        self.policy = policy
+        # a backend port of "*" is None, it has no fixed port to probe
+        self.backends = list(backends)
+        self.probe = HEALTH_PROBES[probe] if probe is not None else None
+        self.interval = interval
+        self.timeout = timeout
+        self.path = path
+        self.healthy_threshold = healthy_threshold
+        self.unhealthy_threshold = unhealthy_threshold
+        self.consecutive_errors = consecutive_errors
+        self.ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.clock = clock
+        self.health = [BackendHealth() for _ in self.backends] # type: List[BackendHealth]
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None # type: Optional[threading.Thread]
+
+    def start(self):
+        self.__thread = threading.Thread(name="zoxy-health-check", target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.check()
+
+    def check(self):
+        # one round: re-admit backends whose ejection ran out, then probe every backend with a port
+        now = self.clock()
+        with self.__lock:
+            for backend_index, health in enumerate(self.health):
+                if health.ejected_until is not None and health.ejected_until <= now:
+                    health.ejected_until = None
+                    # half open: the next connect error ejects it again
+                    health.connect_errors = max(self.consecutive_errors - 1, 0)
+                    self.__update(backend_index, "ejection time ended")
+
+        if self.probe is None:
+            return
+        for backend_index, (host, port) in enumerate(self.backends):
+            if port is None or self.__stop.is_set():
+                continue
+            self.on_probe(backend_index, self.probe(host, port, self.timeout, self.path))
+
+    def on_probe(self, backend_index: int, healthy: bool):
+        with self.__lock:
+            health = self.health[backend_index]
+            if healthy:
+                health.probe_failures = 0
+                health.probe_successes += 1
+                if health.probe_down and health.probe_successes >= self.healthy_threshold:
+                    health.probe_down = False
+                    self.__update(backend_index, f"{health.probe_successes} health checks passed")
+            else:
+                health.probe_successes = 0
+                health.probe_failures += 1
+                if not health.probe_down and health.probe_failures >= self.unhealthy_threshold:
+                    health.probe_down = True
+                    self.__update(backend_index, f"{health.probe_failures} health checks failed")
+
+    def on_connect_success(self, backend_index: int):
+        health = self.health[backend_index]
+        if health.connect_errors or health.ejections:
+            with self.__lock:
+                health.connect_errors = 0
+                health.ejections = 0
+
+    def on_connect_error(self, backend_index: int):
+        with self.__lock:
+            health = self.health[backend_index]
+            health.connect_errors += 1
+            if health.ejected_until is None and health.connect_errors >= self.consecutive_errors:
+                # every ejection in a row lasts longer
+                health.ejections += 1
+                health.ejected_until = self.clock() + min(self.ejection_time * health.ejections, self.max_ejection_time)
+                self.__update(backend_index, f"{health.connect_errors} connect errors in a row")
+
+    def is_available(self, backend_index: int) -> bool:
+        return self.health[backend_index].available
+
+    @property
+    def states(self) -> List[dict]:
+        with self.__lock:
+            return [
+                {
+                    "backend": f"{host}:{port if port is not None else '*'}",
+                    "available": health.available,
+                    "probe_down": health.probe_down,
+                    "ejected": health.ejected_until is not None,
+                    "ejections": health.ejections,
+                }
+                for (host, port), health in zip(self.backends, self.health)
+            ]
+
+    def __update(self, backend_index: int, reason: str):
+        available = self.health[backend_index].available
+        if available == self.policy.available[backend_index]:
+            return
+        host, port = self.backends[backend_index]
+        if available:
+            logger.info(f"Backend {host}:{port if port is not None else '*'} re-admitted: {reason}")
+        else:
+            logger.warning(f"Backend {host}:{port if port is not None else '*'} ejected: {reason}")
+        self.policy.set_available(backend_index, available)
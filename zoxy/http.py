@@ -1,3 +1,15 @@
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+BytesLike = Union[bytes, bytearray]
+
+# body framing
+FRAMING_NONE = "none"
+FRAMING_CONTENT_LENGTH = "content-length"
+FRAMING_CHUNKED = "chunked"
+FRAMING_CLOSE = "close"
+
+HEX_DIGITS = b"0123456789abcdefABCDEF"
+
 
 def http_request_parse(request):
     http_request = HTTPRequest()
@@ -10,40 +22,423 @@ def http_response_parse(response):
     return http_response
 
 
-class Header:
+class HTTPParseError(Exception):
     pass
 
 
+class HTTPHeaderTooLarge(HTTPParseError):
+    pass
+
+
+class HTTPBodyTooLarge(HTTPParseError):
+    pass
+
+
+# Case-insensitive multidict, keeps the original field order and name case
+class HTTPHeaders:
+    def __init__(self, fields: Optional[List[Tuple[str, str]]] = None):
+        self.__fields = [] # type: List[Tuple[str, str]]
+        self.__index = {} # type: Dict[str, List[str]]
+        for field_name, field_value in fields or []:
+            self.add(field_name, field_value)
+
+    def add(self, field_name: str, field_value: str):
+        self.__fields.append((field_name, field_value))
+        self.__index.setdefault(field_name.lower(), []).append(field_value)
+
+    def get(self, field_name: str, default: Optional[str] = None) -> Optional[str]:
+        field_values = self.__index.get(field_name.lower())
+        if not field_values:
+            return default
+        return field_values[0]
+
+    def getall(self, field_name: str) -> List[str]:
+        return list(self.__index.get(field_name.lower(), []))
+
+    def items(self) -> List[Tuple[str, str]]:
+        return list(self.__fields)
+
+    def __getitem__(self, field_name: str) -> str:
+        field_values = self.__index.get(field_name.lower())
+        if not field_values:
+            raise KeyError(field_name)
+        return field_values[0]
+
+    def __setitem__(self, field_name: str, field_value: str):
+        del self[field_name]
+        self.add(field_name, field_value)
+
+    def __delitem__(self, field_name: str):
+        lower_name = field_name.lower()
+        if self.__index.pop(lower_name, None) is not None:
+            self.__fields = [field for field in self.__fields if field[0].lower() != lower_name]
+
+    def __contains__(self, field_name: object) -> bool:
+        return isinstance(field_name, str) and field_name.lower() in self.__index
+
+    def __iter__(self) -> Iterator[str]:
+        return (field_name for field_name, _ in self.__fields)
+
+    def __len__(self) -> int:
+        return len(self.__fields)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, HTTPHeaders):
+            return self.items() == other.items()
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"HTTPHeaders({self.__fields!r})"
+
+
+# Incremental start line and header parser. Feed it received chunks until it returns
+# the number of bytes of the last chunk that belong to the header block. Field names
+# and values are kept as memoryview slices of the received data, only decoded on demand.
+class HTTPParser:
+    def __init__(self, max_header_len: int = 1024 * 64, is_response: bool = False, request_method: str = ""):
+        self.max_header_len = max_header_len
+        self.is_response = is_response
+        self.request_method = request_method
+        self.header_len = None # type: Optional[int]
+
+        self.method = ""
+        self.request_target = ""
+        self.http_version = ""
+        self.status_code = ""
+        self.status_msg = ""
+        self.framing = FRAMING_NONE
+        self.content_length = 0
+        self.connection_tokens = [] # type: List[str]
+
+        self.__buffer = bytearray()
+        self.__data = None # type: Optional[bytes]
+        self.__head = None # type: Optional[memoryview]
+        self.__fields_start = 0
+        self.__fields_end = 0
+        self.__raw_headers = None # type: Optional[List[Tuple[memoryview, memoryview]]]
+        self.__headers = None # type: Optional[HTTPHeaders]
+
+    @property
+    def complete(self) -> bool:
+        return self.header_len is not None
+
+    @property
+    def keep_alive(self) -> bool:
+        if self.is_response and self.framing == FRAMING_CLOSE:
+            return False
+        if "close" in self.connection_tokens:
+            return False
+        if self.http_version == "HTTP/1.1":
+            return True
+        return "keep-alive" in self.connection_tokens
+
+    @property
+    def head(self) -> memoryview:
+        if self.__head is None:
+            raise HTTPParseError("Header is not complete")
+        return self.__head
+
+    @property
+    def headers(self) -> HTTPHeaders:
+        if self.__headers is None:
+            headers = HTTPHeaders()
+            for field_line in self.__field_lines():
+                field_name, _, field_value = field_line.decode("latin-1").partition(":")
+                headers.add(field_name, field_value.strip(" \t"))
+            self.__headers = headers
+        return self.__headers
+
+    def feed(self, data: BytesLike, offset: int = 0) -> Optional[int]:
+        # returns how many bytes of data, from offset, belong to the header block
+        if self.complete:
+            return 0
+        buffer_len = len(self.__buffer)
+        if buffer_len == 0 and isinstance(data, bytes):
+            # the whole header block is usually in the first chunk, parse it in place
+            header_end = data.find(b"\r\n\r\n", offset)
+            if header_end != -1:
+                self.__parse_head(data, offset, header_end + 4)
+                return header_end + 4 - offset
+        self.__buffer += memoryview(data)[offset:]
+        header_end = self.__buffer.find(b"\r\n\r\n", max(0, buffer_len - 3))
+        if header_end == -1:
+            if len(self.__buffer) > self.max_header_len:
+                raise HTTPHeaderTooLarge(f"Header is larger than {self.max_header_len} bytes")
+            return None
+        head = bytes(self.__buffer[:header_end + 4])
+        self.__buffer = bytearray()
+        self.__parse_head(head, 0, len(head))
+        return header_end + 4 - buffer_len
+
+    def __parse_head(self, data: bytes, start: int, end: int):
+        if end - start > self.max_header_len:
+            raise HTTPHeaderTooLarge(f"Header is larger than {self.max_header_len} bytes")
+        self.__data = data
+        self.__head = memoryview(data)[start:end]
+        line_end = data.find(b"\r\n", start, end)
+        self.__parse_start_line(data[start:line_end])
+        self.__fields_start = line_end + 2
+        self.__fields_end = end - 2
+
+        # framing only needs a few fields, find them in one lowered copy instead of walking every field
+        lower_fields = data[line_end:end].lower()
+        content_length = None # type: Optional[int]
+        for field_value in self.__find_field_values(data, lower_fields, line_end, b"\r\ncontent-length:"):
+            # int() would take signs, underscores and spaces, another hop may read those differently
+            if not field_value.isdigit():
+                raise HTTPParseError(f"Invalid Content-Length: {field_value!r}")
+            if content_length is not None and int(field_value) != content_length:
+                raise HTTPParseError("Conflicting Content-Length values")
+            content_length = int(field_value)
+        transfer_codings = [] # type: List[bytes]
+        for field_value in self.__find_field_values(data, lower_fields, line_end, b"\r\ntransfer-encoding:"):
+            transfer_codings.extend(coding.strip(b" \t") for coding in field_value.lower().split(b","))
+        is_chunked = bool(transfer_codings) and transfer_codings[-1] == b"chunked"
+        if transfer_codings and not self.is_response:
+            # a request framed two ways, or by a coding without an end, is read differently by each hop
+            if content_length is not None:
+                raise HTTPParseError("Request has both Transfer-Encoding and Content-Length")
+            if not is_chunked:
+                raise HTTPParseError(f"Request Transfer-Encoding does not end with chunked: {b', '.join(transfer_codings)!r}")
+        if transfer_codings:
+            # a response with other codings than chunked last ends with the connection
+            content_length = None
+        for field_value in self.__find_field_values(data, lower_fields, line_end, b"\r\nconnection:"):
+            self.connection_tokens.extend(
+                token.strip() for token in field_value.lower().decode("latin-1").split(",")
+            )
+
+        self.__detect_framing(is_chunked, content_length)
+        self.header_len = end - start
+
+    def __find_field_values(self, data: bytes, lower_fields: bytes, offset: int, field_prefix: bytes) -> Iterator[bytes]:
+        position = lower_fields.find(field_prefix)
+        while position != -1:
+            value_start = position + len(field_prefix)
+            value_end = lower_fields.find(b"\r\n", value_start)
+            yield data[offset + value_start:offset + value_end].strip(b" \t")
+            position = lower_fields.find(field_prefix, value_end)
+
+    @property
+    def raw_headers(self) -> List[Tuple[memoryview, memoryview]]:
+        # (field name, field value) slices of the received data
+        if self.__raw_headers is None:
+            view = memoryview(self.__data or b"")
+            raw_headers = []
+            position = self.__fields_start
+            for field_line in self.__field_lines():
+                colon = field_line.find(b":")
+                field_value = field_line[colon + 1:]
+                value_start = position + colon + 1 + len(field_value) - len(field_value.lstrip(b" \t"))
+                value_end = max(value_start, position + len(field_line.rstrip(b" \t")))
+                raw_headers.append((view[position:position + colon], view[value_start:value_end]))
+                position += len(field_line) + 2
+            self.__raw_headers = raw_headers
+        return self.__raw_headers
+
+    def __field_lines(self) -> List[bytes]:
+        if self.__data is None or self.__fields_end <= self.__fields_start:
+            return []
+        field_lines = self.__data[self.__fields_start:self.__fields_end - 2].split(b"\r\n")
+        for field_line in field_lines:
+            colon = field_line.find(b":")
+            if colon <= 0 or field_line[colon - 1] in b" \t" or field_line[0] in b" \t":
+                raise HTTPParseError(f"Invalid header field: {field_line!r}")
+        return field_lines
+
+    def __parse_start_line(self, start_line: bytes):
+        try:
+            if self.is_response:
+                http_version, status_code, *status_msg = start_line.decode("latin-1").split(" ", 2)
+                self.http_version = http_version
+                self.status_code = status_code
+                self.status_msg = status_msg[0] if status_msg else ""
+                int(self.status_code)
+            else:
+                self.method, self.request_target, self.http_version = start_line.decode("latin-1").split(" ")
+        except ValueError:
+            raise HTTPParseError(f"Invalid start line: {start_line!r}")
+
+    def __detect_framing(self, is_chunked: bool, content_length: Optional[int]):
+        if self.is_response:
+            status_code = int(self.status_code)
+            if self.request_method == "HEAD" or status_code < 200 or status_code in (204, 304):
+                self.framing = FRAMING_NONE
+                return
+        if is_chunked:
+            self.framing = FRAMING_CHUNKED
+        elif content_length is not None:
+            self.framing = FRAMING_CONTENT_LENGTH
+            self.content_length = content_length
+        elif self.is_response:
+            self.framing = FRAMING_CLOSE
+        else:
+            self.framing = FRAMING_NONE
+
+
+# Tracks where a message body ends while the bytes stream past, without keeping them.
+class HTTPBodyReader:
+    def __init__(self, framing: str, content_length: int = 0, max_line_len: int = 1024 * 8):
+        self.framing = framing
+        self.max_line_len = max_line_len
+        self.complete = framing == FRAMING_NONE or (framing == FRAMING_CONTENT_LENGTH and content_length == 0)
+        self.__remaining = content_length
+        self.__state = "size"
+        self.__line = bytearray()
+
+    def feed(self, data: BytesLike, offset: int = 0) -> int:
+        # returns how many bytes of data, from offset, belong to the body
+        if self.complete:
+            return 0
+        data_len = len(data)
+        if self.framing == FRAMING_CLOSE:
+            return data_len - offset
+        if self.framing == FRAMING_CONTENT_LENGTH:
+            body_len = min(self.__remaining, data_len - offset)
+            self.__remaining -= body_len
+            self.complete = self.__remaining == 0
+            return body_len
+
+        position = offset
+        while position < data_len and not self.complete:
+            if self.__state in ("data", "data_end"):
+                body_len = min(self.__remaining, data_len - position)
+                position += body_len
+                self.__remaining -= body_len
+                if self.__remaining == 0:
+                    if self.__state == "data":
+                        self.__state, self.__remaining = "data_end", 2
+                    else:
+                        self.__state = "size"
+                continue
+
+            line_end = data.find(b"\n", position)
+            if line_end == -1:
+                self.__line += memoryview(data)[position:]
+                position = data_len
+            else:
+                self.__line += memoryview(data)[position:line_end + 1]
+                position = line_end + 1
+                self.__parse_line(bytes(self.__line).strip())
+                self.__line = bytearray()
+            if len(self.__line) > self.max_line_len:
+                raise HTTPParseError("Chunk size line is too long")
+        return position - offset
+
+    def feed_eof(self):
+        if self.framing == FRAMING_CLOSE:
+            self.complete = True
+
+    def __parse_line(self, line: bytes):
+        if self.__state == "trailer":
+            if not line:
+                self.complete = True
+            return
+        size = line.split(b";")[0].strip(b" \t")
+        # int(size, 16) would also take 0x, signs and underscores
+        if not size or size.strip(HEX_DIGITS):
+            raise HTTPParseError(f"Invalid chunk size: {line!r}")
+        chunk_size = int(size, 16)
+        if chunk_size == 0:
+            self.__state = "trailer"
+        else:
+            self.__state, self.__remaining = "data", chunk_size
+
+
+# Collect one request from received chunks: stop at the end of the header block,
+# then read exactly the body described by Content-Length or chunked framing.
+class HTTPRequestReader:
+    def __init__(self, max_header_len: int = 1024 * 64, max_body_len: Optional[int] = None):
+        self.parser = HTTPParser(max_header_len)
+        # the whole request is buffered, a larger body raises HTTPBodyTooLarge
+        self.max_body_len = max_body_len
+        self.body_reader = None # type: Optional[HTTPBodyReader]
+        self.request_len = None # type: Optional[int]
+        self.__chunks = [] # type: List[bytes]
+        self.__received_len = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.request_len is not None
+
+    def feed(self, data: bytes) -> bool:
+        offset = self.__received_len
+        self.__chunks.append(data)
+        self.__received_len += len(data)
+        if self.complete:
+            return True
+        body_offset = 0
+        if self.body_reader is None:
+            header_len = self.parser.feed(data)
+            if header_len is None:
+                return False
+            if self.max_body_len is not None and (self.parser.content_length or 0) > self.max_body_len:
+                raise HTTPBodyTooLarge(f"Content-Length {self.parser.content_length} is over {self.max_body_len} bytes")
+            self.body_reader = HTTPBodyReader(self.parser.framing, self.parser.content_length)
+            body_offset = header_len
+        body_len = self.body_reader.feed(data, body_offset)
+        if self.body_reader.complete:
+            self.request_len = offset + body_offset + body_len
+        if self.max_body_len is not None:
+            # a chunked body only tells its length as it arrives
+            received_body_len = (self.request_len or self.__received_len) - (self.parser.header_len or 0)
+            if received_body_len > self.max_body_len:
+                raise HTTPBodyTooLarge(f"Body is over {self.max_body_len} bytes")
+        return self.complete
+
+    def pop(self) -> Tuple[bytes, bytes]:
+        # returns the request and any bytes received after it
+        received = self.__chunks[0] if len(self.__chunks) == 1 else b"".join(self.__chunks)
+        if self.request_len is None or self.request_len == len(received):
+            return received, b""
+        return received[:self.request_len], received[self.request_len:]
+
+    def get_http_request(self) -> "HTTPRequest":
+        http_request = HTTPRequest()
+        if self.parser.complete:
+            request, _ = self.pop()
+            http_request.load(self.parser, request[self.parser.header_len:])
+        return http_request
+
+
 class HTTPRequest:
     def __init__(self):
         self.method = ""
         self.request_target = ""
         self.http_version = ""
-        self.header = Header()
         self.body = b""
+        self.__header = None # type: Optional[HTTPHeaders]
+        self.__parser = None # type: Optional[HTTPParser]
 
-    def parse(self, request):
-        request_block = request.split(b"\r\n")
-        request_block.reverse()
+    @property
+    def header(self) -> HTTPHeaders:
+        # decoded on first use, forwarding only needs the start line
+        if self.__header is None:
+            self.__header = self.__parser.headers if self.__parser is not None else HTTPHeaders()
+        return self.__header
 
-        # start line
-        start_line = request_block.pop().decode(errors="ignore")
-        self.method, self.request_target, self.http_version = start_line.split(" ")
+    @header.setter
+    def header(self, header: HTTPHeaders):
+        self.__header = header
 
-        # header
-        header_field = request_block.pop().decode(errors="ignore")
-        while header_field != "":
-            field_name, field_value = header_field.split(": ")
-            self.header.__setattr__(field_name, field_value)
-            header_field = request_block.pop().decode(errors="ignore")
+    def parse(self, request: bytes):
+        parser = HTTPParser(max_header_len=len(request))
+        if parser.feed(request) is None:
+            raise HTTPParseError("Header is not complete")
+        self.load(parser, request[parser.header_len:])
 
-        # body
-        self.body = request_block.pop()
+    def load(self, parser: HTTPParser, body: bytes):
+        self.method = parser.method
+        self.request_target = parser.request_target
+        self.http_version = parser.http_version
+        self.__header = None
+        self.__parser = parser
+        self.body = body
 
     def __str__(self):
         http_request = []
         http_request.append(f"{self.method} {self.request_target} {self.http_version}")
-        for field_name, field_value in self.header.__dict__.items():
+        for field_name, field_value in self.header.items():
             http_request.append(f"{field_name}: {field_value}")
         http_request.append("")
         http_request.append(str(self.body))
@@ -55,35 +450,39 @@ class HTTPResponse:
         self.http_version = ""
         self.status_code = ""
         self.status_msg = ""
-        self.header = Header()
         self.body = b""
+        self.__header = None # type: Optional[HTTPHeaders]
+        self.__parser = None # type: Optional[HTTPParser]
 
-    def parse(self, response):
-        response_block = response.split(b"\r\n")
-        response_block.reverse()
+    @property
+    def header(self) -> HTTPHeaders:
+        if self.__header is None:
+            self.__header = self.__parser.headers if self.__parser is not None else HTTPHeaders()
+        return self.__header
 
-        # start line
-        start_line = response_block.pop().decode(errors="ignore")
-        start_line_block = start_line.split(" ")
-        self.http_version = start_line_block[0]
-        self.status_code = start_line_block[1]
-        self.status_msg = " ".join(start_line_block[2:])
+    @header.setter
+    def header(self, header: HTTPHeaders):
+        self.__header = header
 
-        # header
-        header_field = response_block.pop().decode(errors="ignore")
-        while header_field != "":
-            field_name, field_value = header_field.split(": ")
-            self.header.__setattr__(field_name, field_value)
-            header_field = response_block.pop().decode(errors="ignore")
+    def parse(self, response: bytes, request_method: str = ""):
+        parser = HTTPParser(max_header_len=len(response), is_response=True, request_method=request_method)
+        if parser.feed(response) is None:
+            raise HTTPParseError("Header is not complete")
+        self.load(parser, response[parser.header_len:])
 
-        # body
-        self.body = response_block.pop()
+    def load(self, parser: HTTPParser, body: bytes):
+        self.http_version = parser.http_version
+        self.status_code = parser.status_code
+        self.status_msg = parser.status_msg
+        self.__header = None
+        self.__parser = parser
+        self.body = body
 
     def __str__(self):
         http_response = []
         http_response.append(f"{self.http_version} {self.status_code} {self.status_msg}")
-        for field_name, field_value in self.header.__dict__.items():
+        for field_name, field_value in self.header.items():
             http_response.append(f"{field_name}: {field_value}")
         http_response.append("")
         http_response.append(str(self.body))
-        return "\r\n".join(http_response)
\ No newline at end of file
+        return "\r\n".join(http_response)
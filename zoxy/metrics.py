@@ -0,0 +1,250 @@
+import bisect
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a cached dest connection to a slow origin
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# seconds, tunnels live from a request to a long download
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metric:
+    # a metric with labelnames holds one child per label values, recording goes to a child from labels()
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self.__children = {} # type: Dict[Tuple[str, ...], Metric]
+
+    def labels(self, *values: str):
+        # keep the child when recording often, the lookup is a dict get
+        child = self.__children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} has labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self.__children.setdefault(values, self._child())
+        return child
+
+    def _child(self) -> "Metric":
+        raise NotImplementedError
+
+    def _samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+    def samples(self) -> Iterator[Sample]:
+        if not self.labelnames:
+            yield from self._samples()
+            return
+        for values, child in list(self.__children.items()):
+            labels = dict(zip(self.labelnames, values))
+            for suffix, sample_labels, value in child._samples():
+                yield suffix, dict(labels, **sample_labels), value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def _child(self) -> "Counter":
+        return Counter(self.name, self.help)
+
+    def _samples(self) -> Iterator[Sample]:
+        yield "", {}, self.value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+        # read at collection time instead, for values something else already counts
+        self.function = function
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function: Optional[Callable[[], float]]):
+        self.function = function
+
+    def _child(self) -> "Gauge":
+        return Gauge(self.name, self.help)
+
+    def _samples(self) -> Iterator[Sample]:
+        yield "", {}, self.function() if self.function is not None else self.value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = sorted(buckets)
+        # one count per bucket and one over the last, made cumulative on collection
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def _child(self) -> "Histogram":
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def _samples(self) -> Iterator[Sample]:
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets + [math.inf], counts):
+            cumulative += bucket_count
+            yield "_bucket", {"le": format_value(upper_bound)}, cumulative
+        yield "_sum", {}, total
+        yield "_count", {}, count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.__metrics = {} # type: Dict[str, Metric]
+        self.__lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.__lock:
+            if metric.name in self.__metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self.__metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames)) # type: ignore[return-value]
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = (), function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, help, labelnames, function)) # type: ignore[return-value]
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets)) # type: ignore[return-value]
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self.__metrics.get(name)
+
+    def render(self) -> str:
+        # Prometheus text exposition format 0.0.4
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = [] # type: List[str]
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f"{name}=\"{escape_label_value(label)}\"" for name, label in labels.items())
+                    lines.append(f"{metric.name}{suffix}{{{label_text}}} {format_value(value)}")
+                else:
+                    lines.append(f"{metric.name}{suffix} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class ProxyMetrics:
+    # what a proxy server records, every proxy server has one and records always
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        registry = self.registry
+        self.connections_accepted = registry.counter("zoxy_connections_accepted_total", "Client connections accepted")
+        self.connections_rejected = registry.counter("zoxy_connections_rejected_total", "Client connections refused by connection limits", ["reason"])
+        self.connections_open = registry.gauge("zoxy_connections_open", "Client connections admitted and not closed yet")
+        self.connections_queued = registry.gauge("zoxy_connections_queued", "Client connections waiting for a worker thread")
+        self.workers_active = registry.gauge("zoxy_workers_active", "Worker threads serving a client connection")
+        self.requests = registry.counter("zoxy_requests_total", "Requests read from clients", ["kind"])
+        self.client_bytes_received = registry.counter("zoxy_client_bytes_received_total", "Bytes read from clients")
+        self.client_bytes_sent = registry.counter("zoxy_client_bytes_sent_total", "Bytes sent to clients")
+        self.request_read_seconds = registry.histogram("zoxy_request_read_seconds", "Seconds from the first byte of a request to its end")
+        self.upstream_connect_seconds = registry.histogram("zoxy_upstream_connect_seconds", "Seconds to open a dest connection")
+        self.time_to_first_byte_seconds = registry.histogram("zoxy_time_to_first_byte_seconds", "Seconds from sending a request to the first byte of its response")
+        self.tunnel_duration_seconds = registry.histogram("zoxy_tunnel_duration_seconds", "Seconds a CONNECT tunnel was open", buckets=DURATION_BUCKETS)
+        self.backend_selections = registry.counter("zoxy_backend_selections_total", "Requests sent to a load-balancing backend", ["backend"])
+        self.backend_errors = registry.counter("zoxy_backend_connect_errors_total", "Connect errors of a load-balancing backend", ["backend"])
+        self.coalesced_requests = registry.counter("zoxy_coalesced_requests_total", "Coalesced GETs, by leader fetching, subscriber streaming it, or subscriber dropped for lagging", ["role"])
+        self.cache_requests = registry.counter("zoxy_cache_requests_total", "Requests through the HTTP cache, by hit, miss or revalidated", ["result"])
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode() # type: ignore[attr-defined]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        logger.debug(f"Metrics request: {format % args}")
+
+
+class MetricsServer:
+    # serves a registry at /metrics for Prometheus to scrape, from a daemon thread
+    def __init__(self, registry: MetricsRegistry, url: str = "127.0.0.1", port: int = 9100):
+        self.registry = registry
+        self.url = url
+        self.__port = port
+        self.__http_server = None # type: Optional[ThreadingHTTPServer]
+
+    @property
+    def port(self) -> int:
+        return self.__http_server.server_address[1] if self.__http_server is not None else self.__port
+
+    def start(self):
+        self.__http_server = ThreadingHTTPServer((self.url, self.__port), MetricsRequestHandler)
+        self.__http_server.daemon_threads = True
+        self.__http_server.registry = self.registry # type: ignore[attr-defined]
+        threading.Thread(name="zoxy-metrics", target=self.__http_server.serve_forever, daemon=True).start()
+        logger.info(f"Metrics server: http://{self.url}:{self.port}/metrics")
+
+    def stop(self):
+        if self.__http_server is not None:
+            self.__http_server.shutdown()
+            self.__http_server.server_close()
+            self.__http_server = None
@@ -0,0 +1,183 @@
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPoolFull(OSError):
+    pass
+
+
+class DestClosedError(ConnectionError):
+    # the dest closed the connection before sending any byte of the response
+    pass
+
+
+class ConnectionPool:
+    # idle keep-alive upstream connections per (host, port)
+    def __init__(
+        self,
+        max_idle_per_host: int = 8,
+        max_per_host: int = 100,
+        idle_timeout: float = 30,
+        wait_timeout: float = 1,
+    ):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__idle = defaultdict(deque) # type: Dict[Tuple[str, int], Deque[Tuple[float, socket.socket]]]
+        self.__active = defaultdict(int) # type: Dict[Tuple[str, int], int]
+        self.__condition = threading.Condition()
+        self.__evict_time = time.monotonic()
+
+    def acquire(self, host: str, port: int, connect: Callable[[str, int], socket.socket]) -> socket.socket:
+        return self.checkout(host, port, connect)[0]
+
+    def checkout(self, host: str, port: int, connect: Callable[[str, int], socket.socket]) -> Tuple[socket.socket, bool]:
+        # a connection and whether it was reused, the server may still have closed a reused one meanwhile
+        key = (host, port)
+        deadline = time.monotonic() + self.wait_timeout
+        with self.__condition:
+            while True:
+                self.__evict_expired(key)
+                idle = self.__idle[key]
+                while idle:
+                    # newest first, it is the least likely to be closed by the server
+                    _, sock = idle.pop()
+                    if self.is_usable(sock):
+                        self.__active[key] += 1
+                        self.hits += 1
+                        return sock, True
+                    logger.debug(f"Drop closed pooled connection to {host}:{port}")
+                    self.evictions += 1
+                    self._close(sock)
+                if self.__active[key] < self.max_per_host:
+                    self.__active[key] += 1
+                    self.misses += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionPoolFull(f"Too many connections to {host}:{port}")
+                self.__condition.wait(remaining)
+
+        try:
+            return connect(host, port), False
+        except BaseException:
+            self.__release_slot(key)
+            raise
+
+    def release(self, host: str, port: int, sock: socket.socket, reusable: bool):
+        key = (host, port)
+        now = time.monotonic()
+        with self.__condition:
+            self.__active[key] -= 1
+            pooled = reusable and len(self.__idle[key]) < self.max_idle_per_host
+            if pooled:
+                self.__idle[key].append((now, sock))
+            self.__forget_unused(key)
+            self.__condition.notify()
+            # hosts that get no more requests are swept here, at most once per idle timeout
+            evict = now - self.__evict_time >= self.idle_timeout
+        if not pooled:
+            self._close(sock)
+        if evict:
+            self.evict_expired()
+
+    def evict_expired(self):
+        with self.__condition:
+            self.__evict_time = time.monotonic()
+            for key in list(self.__idle):
+                self.__evict_expired(key)
+                self.__forget_unused(key)
+
+    def clear(self):
+        with self.__condition:
+            idle = [sock for connections in self.__idle.values() for _, sock in connections]
+            self.__idle.clear()
+        for sock in idle:
+            self._close(sock)
+
+    def idle_count(self, host: Optional[str] = None, port: int = 0) -> int:
+        with self.__condition:
+            if host is not None:
+                return len(self.__idle.get((host, port), ()))
+            return sum(len(connections) for connections in self.__idle.values())
+
+    def active_count(self, host: Optional[str] = None, port: int = 0) -> int:
+        with self.__condition:
+            if host is not None:
+                return self.__active.get((host, port), 0)
+            return sum(self.__active.values())
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "idle": self.idle_count(),
+            "active": self.active_count(),
+            "hosts": self.host_count(),
+        }
+
+    def host_count(self) -> int:
+        with self.__condition:
+            return len(self.__idle.keys() | self.__active.keys())
+
+    @staticmethod
+    def is_usable(sock: socket.socket) -> bool:
+        # an idle connection must have nothing to read, data or EOF means the server gave up on it
+        timeout = sock.gettimeout()
+        try:
+            sock.setblocking(False)
+            sock.recv(1, socket.MSG_PEEK)
+            return False
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        finally:
+            try:
+                sock.settimeout(timeout)
+            except OSError:
+                pass
+
+    def __evict_expired(self, key: Tuple[str, int]):
+        idle = self.__idle[key]
+        expired_time = time.monotonic() - self.idle_timeout
+        # oldest first
+        while idle and idle[0][0] < expired_time:
+            _, sock = idle.popleft()
+            self.evictions += 1
+            self._close(sock)
+
+    def __forget_unused(self, key: Tuple[str, int]):
+        # the per-host entries go with the last connection, one-off hosts do not pile up
+        if not self.__idle.get(key) and not self.__active.get(key):
+            self.__idle.pop(key, None)
+            self.__active.pop(key, None)
+
+    def __release_slot(self, key: Tuple[str, int]):
+        with self.__condition:
+            self.__active[key] -= 1
+            self.__forget_unused(key)
+            self.__condition.notify()
+
+    @staticmethod
+    def _close(sock: socket.socket):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
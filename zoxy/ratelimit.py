@@ -0,0 +1,178 @@
+import ipaddress
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+from .routing import FirstMatchTable, IPNetwork
+
+
+class TokenBucket:
+    # refilled lazily on use, a bucket costs nothing while nobody takes from it
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def try_take(self, amount: float, now: float) -> bool:
+        self.refill(now)
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def take(self, amount: float, now: float) -> float:
+        # always takes, an overdrawn bucket returns the seconds until it is paid back
+        self.refill(now)
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+def parse_rate(rate: Union[str, float, None]) -> Optional[float]:
+    # "*" is no limit
+    if rate is None or rate == "*":
+        return None
+    rate = float(rate)
+    if rate <= 0:
+        raise ValueError(f"Rate limit must be positive or '*': {rate}")
+    return rate
+
+
+class RateLimitRule:
+    def __init__(self, index: int, network: IPNetwork, port: str, requests_per_second: Optional[float], bytes_per_second: Optional[float]):
+        self.index = index
+        self.network = network
+        self.port = port
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+
+    def to_list(self) -> List:
+        return [
+            str(self.network),
+            self.port,
+            self.requests_per_second if self.requests_per_second is not None else "*",
+            self.bytes_per_second if self.bytes_per_second is not None else "*",
+        ]
+
+
+class RateLimitBuckets:
+    # the buckets of one key, a burst of one second of its rate
+    __slots__ = ("requests", "bytes", "last_used")
+
+    def __init__(self, rule: RateLimitRule, now: float):
+        self.requests = None # type: Optional[TokenBucket]
+        self.bytes = None # type: Optional[TokenBucket]
+        if rule.requests_per_second is not None:
+            self.requests = TokenBucket(rule.requests_per_second, max(rule.requests_per_second, 1), now)
+        if rule.bytes_per_second is not None:
+            self.bytes = TokenBucket(rule.bytes_per_second, rule.bytes_per_second, now)
+        self.last_used = now
+
+
+class ByteLimit:
+    # the byte bucket of one key, whoever moves its bytes takes them here and pauses for the returned seconds
+    def __init__(self, table: "RateLimitTable", key: Tuple[int, str], buckets: RateLimitBuckets):
+        self.table = table
+        self.key = key
+        self.buckets = buckets
+
+    def take(self, amount: int) -> float:
+        return self.table.take_bytes(self.key, self.buckets, amount)
+
+    @property
+    def burst(self) -> float:
+        return self.buckets.bytes.burst if self.buckets.bytes is not None else math.inf
+
+
+class ByteThrottle:
+    # bytes of one request count against every byte limit it matched, the slowest one sets the pause
+    def __init__(self, limits: Sequence[ByteLimit]):
+        self.limits = list(limits)
+
+    def __call__(self, amount: int) -> float:
+        return max(limit.take(amount) for limit in self.limits)
+
+    def read_len(self, amount: int) -> int:
+        # a read of at most the smallest burst overdraws no bucket by more than its burst, a second of its rate
+        return max(1, int(min([amount] + [limit.burst for limit in self.limits])))
+
+
+class RateLimitTable:
+    # ordered [ip/mask, port, requests per second, bytes per second] rules like the access tables,
+    # every ip matching a rule gets its own buckets, idle ones are evicted oldest first
+    def __init__(
+        self,
+        rules: Sequence[Sequence] = (),
+        idle_timeout: float = 60,
+        max_keys: int = 65536,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rules = [
+            RateLimitRule(index, ipaddress.ip_network(ip_adr), str(port), parse_rate(requests_per_second), parse_rate(bytes_per_second))
+            for index, (ip_adr, port, requests_per_second, bytes_per_second) in enumerate(rules)
+        ]
+        # a bucket idle for a second is full again, dropping it later loses nothing
+        self.idle_timeout = max(idle_timeout, 1)
+        self.max_keys = max_keys
+        self.clock = clock
+        self.limited = 0
+        self.evictions = 0
+        self.__index = FirstMatchTable((rule.network, rule.port, rule) for rule in self.rules) # type: FirstMatchTable[RateLimitRule]
+        # least recently used first
+        self.__buckets = OrderedDict() # type: OrderedDict[Tuple[int, str], RateLimitBuckets]
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    @property
+    def keys(self) -> int:
+        return len(self.__buckets)
+
+    def to_list(self) -> List[List]:
+        return [rule.to_list() for rule in self.rules]
+
+    def acquire(self, ip: str, port: Union[int, str]) -> Tuple[bool, Optional[ByteLimit]]:
+        # one request of ip on port: whether its request rate allows it, and the byte limit its data goes through
+        rule = self.__index.lookup(ip, port)
+        if rule is None:
+            return True, None
+        key = (rule.index, ip)
+        now = self.clock()
+        with self.__lock:
+            buckets = self.__buckets.get(key)
+            if buckets is None:
+                self.__evict(now)
+                buckets = self.__buckets[key] = RateLimitBuckets(rule, now)
+            else:
+                self.__buckets.move_to_end(key)
+            buckets.last_used = now
+            if buckets.requests is not None and not buckets.requests.try_take(1, now):
+                self.limited += 1
+                return False, None
+        return True, ByteLimit(self, key, buckets) if buckets.bytes is not None else None
+
+    def take_bytes(self, key: Tuple[int, str], buckets: RateLimitBuckets, amount: int) -> float:
+        now = self.clock()
+        with self.__lock:
+            buckets.last_used = now
+            if self.__buckets.get(key) is buckets:
+                self.__buckets.move_to_end(key)
+            return buckets.bytes.take(amount, now) if buckets.bytes is not None else 0.0
+
+    def __evict(self, now: float):
+        while self.__buckets:
+            key, buckets = next(iter(self.__buckets.items()))
+            if len(self.__buckets) < self.max_keys and now - buckets.last_used < self.idle_timeout:
+                break
+            del self.__buckets[key]
+            self.evictions += 1
@@ -0,0 +1,308 @@
+import logging
+import os
+import selectors
+import socket
+import time
+from typing import Callable, Dict, Optional, Type
+
+try:
+    import fcntl
+except ImportError: # not on Windows
+    fcntl = None # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Linux, Python 3.10+
+SPLICE_SUPPORTED = hasattr(os, "splice")
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+
+class AdaptiveBufferSize:
+    # doubles while reads fill the buffer, halves after a run of reads that use less than a quarter of it
+    def __init__(self, min_len: int = 16 * 1024, max_len: int = 1024 * 1024, shrink_after: int = 16):
+        self.min_len = min(min_len, max_len)
+        self.max_len = max_len
+        self.shrink_after = shrink_after
+        self.len = self.min_len
+        self.__small_reads = 0
+
+    def observe(self, received: int, requested: int):
+        if received >= requested:
+            self.__small_reads = 0
+            self.len = min(self.len * 2, self.max_len)
+        elif received < self.len // 4:
+            self.__small_reads += 1
+            if self.__small_reads >= self.shrink_after:
+                self.__small_reads = 0
+                self.len = max(self.len // 2, self.min_len)
+        else:
+            self.__small_reads = 0
+
+
+class Channel:
+    # one direction of a relay, bytes read and not yet written wait in a reused buffer sized by its throughput
+    def __init__(self, name: str, reader: socket.socket, writer: socket.socket, on_data: Optional[Callable[[bytes], None]] = None, buffer_len: int = 65536):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.on_data = on_data
+        self.buffer_size = AdaptiveBufferSize(max_len=buffer_len)
+        self.buffer = bytearray(self.buffer_size.len)
+        self.view = memoryview(self.buffer)
+        # pending bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        self.transferred_len = 0
+        self.eof = False
+        self.closed = False
+        # monotonic time reading resumes at, after a throttle asked for a pause
+        self.paused_until = 0.0
+
+    @property
+    def pending_len(self) -> int:
+        return self.end - self.start
+
+    def has_room(self) -> bool:
+        return self.end < len(self.buffer)
+
+    def drained(self):
+        # the whole buffer is free again, the time to give it the size its throughput asks for
+        self.start = self.end = 0
+        if len(self.buffer) != self.buffer_size.len:
+            self.view.release()
+            self.buffer = bytearray(self.buffer_size.len)
+            self.view = memoryview(self.buffer)
+
+    def release(self):
+        self.view.release()
+
+    def close_writer(self):
+        self.closed = True
+        try:
+            self.writer.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class Relay:
+    channel_class = Channel # type: Type[Channel]
+
+    def __init__(
+        self,
+        src_socket: socket.socket,
+        dest_socket: socket.socket,
+        recv_len: int,
+        max_pending_len: int,
+        idle_timeout: Optional[float] = None,
+        on_dest_data: Optional[Callable[[bytes], None]] = None,
+        throttle: Optional[Callable[[int], float]] = None,
+    ):
+        self.src_socket = src_socket
+        self.dest_socket = dest_socket
+        self.recv_len = recv_len
+        self.max_pending_len = max_pending_len
+        self.idle_timeout = idle_timeout
+        # takes the bytes read in either direction, returns the seconds to pause reading, e.g. zoxy.ratelimit.ByteThrottle
+        self.throttle = throttle
+        self.s_to_d = self.channel_class("src->dest", src_socket, dest_socket, buffer_len=max_pending_len)
+        self.d_to_s = self.channel_class("dest->src", dest_socket, src_socket, on_dest_data, buffer_len=max_pending_len)
+
+    def run(self):
+        src_timeout = self.src_socket.gettimeout()
+        dest_timeout = self.dest_socket.gettimeout()
+        self.src_socket.setblocking(False)
+        self.dest_socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        try:
+            self._run(selector)
+        finally:
+            selector.close()
+            self.s_to_d.release()
+            self.d_to_s.release()
+            self.src_socket.settimeout(src_timeout)
+            self.dest_socket.settimeout(dest_timeout)
+
+    def _run(self, selector: selectors.BaseSelector):
+        registered = {} # type: Dict[socket.socket, int]
+        channels = (self.s_to_d, self.d_to_s)
+        while not (self.s_to_d.closed and self.d_to_s.closed):
+            # only read when there is room to buffer it, only write when there is something to send
+            interests = {self.src_socket: 0, self.dest_socket: 0}
+            now = time.monotonic()
+            resume_time = None # type: Optional[float]
+            for channel in channels:
+                if not channel.eof and channel.has_room():
+                    if channel.paused_until > now:
+                        resume_time = channel.paused_until if resume_time is None else min(resume_time, channel.paused_until)
+                    else:
+                        interests[channel.reader] |= selectors.EVENT_READ
+                if channel.pending_len:
+                    interests[channel.writer] |= selectors.EVENT_WRITE
+            for sock, events in interests.items():
+                if events == registered.get(sock, 0):
+                    continue
+                if not events:
+                    selector.unregister(sock)
+                    del registered[sock]
+                elif sock in registered:
+                    selector.modify(sock, events)
+                    registered[sock] = events
+                else:
+                    selector.register(sock, events)
+                    registered[sock] = events
+
+            # a paused channel is throttled, not idle, wake up when it resumes
+            timeout = self.idle_timeout
+            if resume_time is not None:
+                timeout = resume_time - now
+            ready = selector.select(timeout)
+            if not ready:
+                if resume_time is not None:
+                    continue
+                logger.debug("Relay idle timeout")
+                return
+
+            for key, mask in ready:
+                for channel in channels:
+                    if mask & selectors.EVENT_READ and key.fileobj is channel.reader:
+                        if not self._recv(channel):
+                            return
+                    if mask & selectors.EVENT_WRITE and key.fileobj is channel.writer:
+                        if not self._send(channel):
+                            return
+
+            for channel in channels:
+                if channel.eof and not channel.pending_len and not channel.closed:
+                    logger.debug(f"Relay {channel.name} half-closed")
+                    channel.close_writer()
+
+    def _recv(self, channel: Channel) -> bool:
+        end = channel.end
+        requested = min(self.recv_len, len(channel.buffer) - end)
+        try:
+            received = channel.reader.recv_into(channel.view[end:end + requested])
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as err:
+            logger.debug(f"Relay {channel.name} recv error: {err}")
+            return False
+        if not received:
+            channel.eof = True
+            return True
+        channel.end += received
+        self._throttle(channel, received)
+        # only a read that could have filled the whole buffer tells whether it is too small
+        channel.buffer_size.observe(received, requested if end == 0 else len(channel.buffer))
+        if channel.on_data is not None:
+            channel.on_data(bytes(channel.view[end:end + received]))
+        return True
+
+    def _throttle(self, channel: Channel, received: int):
+        if self.throttle is None:
+            return
+        pause = self.throttle(received)
+        if pause > 0:
+            channel.paused_until = time.monotonic() + pause
+
+    def _send(self, channel: Channel) -> bool:
+        try:
+            sent = channel.writer.send(channel.view[channel.start:channel.end])
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as err:
+            logger.debug(f"Relay {channel.name} send error: {err}")
+            return False
+        channel.start += sent
+        channel.transferred_len += sent
+        if channel.start == channel.end:
+            channel.drained()
+        return True
+
+
+class SpliceChannel(Channel):
+    # pending bytes wait in a kernel pipe instead, they never enter Python
+    def __init__(self, name: str, reader: socket.socket, writer: socket.socket, on_data: Optional[Callable[[bytes], None]] = None, buffer_len: int = 65536):
+        super().__init__(name, reader, writer, on_data, buffer_len=0)
+        self.pipe_read, self.pipe_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.pipe_len = 65536
+        if fcntl is not None:
+            try:
+                self.pipe_len = fcntl.fcntl(self.pipe_write, F_SETPIPE_SZ, buffer_len)
+            except OSError:
+                # above /proc/sys/fs/pipe-max-size for an unprivileged process, keep the default size
+                pass
+        self.pending = 0
+
+    @property
+    def pending_len(self) -> int:
+        return self.pending
+
+    def has_room(self) -> bool:
+        return self.pending < self.pipe_len
+
+    def release(self):
+        super().release()
+        os.close(self.pipe_read)
+        os.close(self.pipe_write)
+
+
+class SpliceRelay(Relay):
+    # socket -> pipe -> socket with os.splice, for tunnels whose bytes nobody inspects
+    channel_class = SpliceChannel
+
+    def __init__(
+        self,
+        src_socket: socket.socket,
+        dest_socket: socket.socket,
+        recv_len: int,
+        max_pending_len: int,
+        idle_timeout: Optional[float] = None,
+        on_dest_data: Optional[Callable[[bytes], None]] = None,
+        throttle: Optional[Callable[[int], float]] = None,
+    ):
+        if on_dest_data is not None:
+            raise ValueError("SpliceRelay can not hand data to a callback, use Relay")
+        try:
+            super().__init__(src_socket, dest_socket, recv_len, max_pending_len, idle_timeout, throttle=throttle)
+        except OSError:
+            # the pipes of the first channel when the second could not get its own
+            if hasattr(self, "s_to_d"):
+                self.s_to_d.release()
+            raise
+
+    def _recv(self, channel: SpliceChannel) -> bool: # type: ignore[override]
+        try:
+            received = os.splice(
+                channel.reader.fileno(),
+                channel.pipe_write,
+                min(self.recv_len, channel.pipe_len - channel.pending),
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+            )
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as err:
+            logger.debug(f"Relay {channel.name} splice from socket error: {err}")
+            return False
+        if not received:
+            channel.eof = True
+            return True
+        channel.pending += received
+        self._throttle(channel, received)
+        return True
+
+    def _send(self, channel: SpliceChannel) -> bool: # type: ignore[override]
+        try:
+            sent = os.splice(
+                channel.pipe_read,
+                channel.writer.fileno(),
+                channel.pending,
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+            )
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as err:
+            logger.debug(f"Relay {channel.name} splice to socket error: {err}")
+            return False
+        channel.pending -= sent
+        channel.transferred_len += sent
+        return True
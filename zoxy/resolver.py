@@ -0,0 +1,117 @@
+import ipaddress
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+class _Lookup:
+    # one in-flight resolution, concurrent callers wait for its result
+    def __init__(self):
+        self.done = threading.Event()
+        # the address or the error, set before done
+        self.result = RuntimeError("Lookup not done") # type: Union[str, Exception]
+
+
+class Resolver:
+    # hostname -> IPv4 address cache with negative caching and one lookup per name at a time
+    def __init__(
+        self,
+        ttl: float = 60,
+        negative_ttl: float = 5,
+        max_entries: int = 4096,
+        resolve_func: Callable[[str], str] = socket.gethostbyname,
+    ):
+        # the system resolver does not report record TTLs, so every answer is kept for ttl seconds
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.resolve_func = resolve_func
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.__cache = OrderedDict() # type: OrderedDict[str, Tuple[float, Union[str, Exception]]]
+        self.__lookups = {} # type: Dict[str, _Lookup]
+        self.__lock = threading.Lock()
+
+    def resolve(self, host: str) -> str:
+        if self.is_ip_address(host):
+            return host
+
+        with self.__lock:
+            entry = self.__cache.get(host)
+            if entry is not None and entry[0] > time.monotonic():
+                self.__cache.move_to_end(host)
+                result = entry[1]
+                if isinstance(result, Exception):
+                    self.negative_hits += 1
+                    raise result.with_traceback(None)
+                self.hits += 1
+                return result
+
+            lookup = self.__lookups.get(host)
+            is_leader = lookup is None
+            if lookup is None:
+                lookup = _Lookup()
+                self.__lookups[host] = lookup
+                self.misses += 1
+            else:
+                # somebody is resolving it right now
+                self.hits += 1
+
+        if is_leader:
+            self.__lookup(host, lookup)
+        else:
+            lookup.done.wait()
+
+        if isinstance(lookup.result, Exception):
+            raise lookup.result.with_traceback(None)
+        return lookup.result
+
+    def __lookup(self, host: str, lookup: _Lookup):
+        try:
+            result = self.resolve_func(host) # type: Union[str, Exception]
+            expires = time.monotonic() + self.ttl
+        except Exception as err:
+            logger.warning(f"Resolve {host} warning: {err}")
+            result = err
+            expires = time.monotonic() + self.negative_ttl
+        with self.__lock:
+            self.__cache[host] = (expires, result)
+            self.__cache.move_to_end(host)
+            while len(self.__cache) > self.max_entries:
+                self.__cache.popitem(last=False)
+            del self.__lookups[host]
+        lookup.result = result
+        lookup.done.set()
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.negative_hits + self.misses
+        return (self.hits + self.negative_hits) / total if total else 0.0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "entries": len(self.__cache),
+        }
+
+    @staticmethod
+    def is_ip_address(host: str) -> bool:
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return True
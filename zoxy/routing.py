@@ -0,0 +1,80 @@
+import ipaddress
+import socket
+from typing import Dict, Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar, Union
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+T = TypeVar("T")
+
+ADDRESS_BITS = {4: 32, 6: 128}
+
+
+def parse_address(host: str) -> Tuple[int, int]:
+    # (ip version, address as int), cheaper than ipaddress.ip_address on the accept path
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, host), "big")
+    except OSError:
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, host), "big")
+    except OSError:
+        raise ValueError(f"{host!r} does not appear to be an IPv4 or IPv6 address") from None
+
+
+class PrefixTable(Generic[T]):
+    # one hash table per prefix length, a lookup costs one probe per distinct length, not per rule
+    def __init__(self, entries: Iterable[Tuple[IPNetwork, T]] = ()):
+        tables = {4: {}, 6: {}} # type: Dict[int, Dict[int, Dict[int, List[T]]]]
+        self.__len = 0
+        for network, value in entries:
+            shift = ADDRESS_BITS[network.version] - network.prefixlen
+            key = int(network.network_address) >> shift
+            tables[network.version].setdefault(shift, {}).setdefault(key, []).append(value)
+            self.__len += 1
+        # longest prefix first
+        self.__tables = {
+            version: sorted(table.items())
+            for version, table in tables.items()
+        } # type: Dict[int, List[Tuple[int, Dict[int, List[T]]]]]
+
+    def __len__(self) -> int:
+        return self.__len
+
+    def lookup(self, host: str) -> Iterator[T]:
+        # values of every network containing host, longest prefix first
+        version, address = parse_address(host)
+        for shift, table in self.__tables[version]:
+            values = table.get(address >> shift)
+            if values is not None:
+                yield from values
+
+    def longest_match(self, host: str) -> List[T]:
+        version, address = parse_address(host)
+        for shift, table in self.__tables[version]:
+            values = table.get(address >> shift)
+            if values is not None:
+                return values
+        return []
+
+
+class FirstMatchTable(Generic[T]):
+    # ordered (network, port) rules, lookup returns the value of the first rule that matches like a linear scan
+    def __init__(self, rules: Iterable[Tuple[IPNetwork, str, T]] = ()):
+        # per network: port -> (rule index, value) of its first rule for that port, "*" included
+        port_maps = {} # type: Dict[IPNetwork, Dict[str, Tuple[int, T]]]
+        self.__len = 0
+        for index, (network, port, value) in enumerate(rules):
+            port_maps.setdefault(network, {}).setdefault(str(port), (index, value))
+            self.__len += 1
+        self.__prefix_table = PrefixTable(port_maps.items()) # type: PrefixTable[Dict[str, Tuple[int, T]]]
+
+    def __len__(self) -> int:
+        return self.__len
+
+    def lookup(self, host: str, port: Union[int, str, None]) -> Optional[T]:
+        port_str = str(port)
+        first_match = None # type: Optional[Tuple[int, T]]
+        for port_map in self.__prefix_table.lookup(host):
+            for match in (port_map.get(port_str), port_map.get("*")):
+                if match is not None and (first_match is None or match[0] < first_match[0]):
+                    first_match = match
+        return first_match[1] if first_match is not None else None
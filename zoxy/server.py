@@ -1,19 +1,37 @@
+import copy
+import functools
 import ipaddress
 import signal
 import socket
 import ssl
 import threading
+import time
 import logging
 from collections import defaultdict
-from typing import List, Tuple, Optional
+from typing import Any, Callable, Dict, List, Tuple, Optional, Union
 from urllib.parse import urlparse
 from types import FrameType
 
-from .http import http_request_parse, http_response_parse, HTTPResponse
-from .typings import LoadBalancingDict, SelfLoadBalancingDict
+from .admission import ConnectionLimiter, ConnectionWorkerPool
+from .balancing import BackendLease, RatePolicy, distribute_backend, get_balancing_policy
+from .cache import CacheLookup, HTTPCache
+from .coalesce import FanoutLagError, FanoutReader, FanoutSink, RequestCoalescer, get_coalescing_key
+from .http import FRAMING_CHUNKED, HTTPBodyReader, HTTPParser, HTTPRequest, HTTPRequestReader, HTTPParseError, HTTPHeaderTooLarge, HTTPBodyTooLarge
+from .h2c import H2cPool, H2cStream, H2cStreamRefused
+from .health import HealthChecker
+from .metrics import ProxyMetrics
+from .pool import ConnectionPool, DestClosedError
+from .ratelimit import ByteThrottle, RateLimitTable
+from .relay import SPLICE_SUPPORTED, AdaptiveBufferSize, Relay, SpliceRelay
+from .resolver import Resolver
+from .routing import FirstMatchTable, PrefixTable
+from .snapshot import ROUTING_SETTINGS, RoutingSnapshot
+from .typings import HealthCheckDict, LoadBalancingDict, SelfLoadBalancingDict
 
 logger = logging.getLogger(__name__)
 
+LOAD_BALANCING_HASH_KEYS = ("client_ip", "host")
+
 
 
 class ProxyServer:
@@ -28,35 +46,100 @@ class ProxyServer:
             "frontend": ["", ""],
             "backend": [],
         },
+        response_capture: Optional[Callable[[tuple, bytes], None]] = None,
+        keep_alive_timeout: float = 15,
+        max_keep_alive_requests: int = 100,
+        max_request_body_len: Optional[int] = 1024 * 1024 * 10,
+        connection_pool: Optional[ConnectionPool] = None,
+        resolver: Optional[Resolver] = None,
+        reuse_port: bool = False,
+        splice_tunnel: bool = True,
+        max_workers: int = 512,
+        max_queued_connections: int = 1024,
+        queue_timeout: float = 5,
+        overload_policy: str = "queue",
+        max_connections: Optional[int] = None,
+        max_connections_per_ip: Optional[int] = None,
+        client_rate_limits: List[List] = [],
+        dest_rate_limits: List[List] = [],
+        metrics: Optional[ProxyMetrics] = None,
+        http_cache: Optional[HTTPCache] = None,
+        coalescer: Optional[RequestCoalescer] = None,
+        h2c_pool: Optional[H2cPool] = None,
     ):
         self.__max_recv_len = 1024 * 1024 * 1
         self.__default_socket_timeout = 1
+        self.__max_header_len = 1024 * 64
+        self.__request_read_timeout = 10
         self.__dest_connection_timeout = 1
-        self.__max_pipe_timeout = 2 // self.__dest_connection_timeout // 2
+        self.__relay_idle_timeout = 60
         self.__listen_flag = True
-        self.__lb_condition_lock = threading.Condition()
+        # only writers take it, requests read the snapshot reference without a lock
+        self.__routing_lock = threading.Lock()
+        self.__routing = None # type: Optional[RoutingSnapshot]
+        # recv sizes of the connection a thread serves
+        self.__recv_sizes = threading.local()
+        # byte throttle of the request a thread serves
+        self.__byte_throttle = threading.local()
+        # client bytes a thread sent of the response it forwards
+        self.__response_sent = threading.local()
+
+        # called with (client address, response chunk), e.g. zoxy.capture.ResponseRingBuffer
+        self.response_capture = response_capture
+
+        # idle seconds and number of requests a plain HTTP client connection is kept for
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_keep_alive_requests = max_keep_alive_requests
+
+        # requests are buffered whole before forwarding, a larger body gets 413, None for no limit
+        self.max_request_body_len = max_request_body_len
+
+        # idle keep-alive dest connections reused by plain HTTP requests
+        self.connection_pool = connection_pool if connection_pool is not None else ConnectionPool()
+
+        # cached name lookups shared by routing and dest connections
+        self.resolver = resolver if resolver is not None else Resolver()
 
-        # filter controll flag
-        self.__enable_blocked_access = False
-        self.__enable_allowed_access = False
-        self.__enable_forwarding = False
-        self.__enable_load_balancing = False
+        # relay CONNECT tunnels with os.splice where the platform has it, bytes then stay in the kernel
+        self.splice_tunnel = splice_tunnel and SPLICE_SUPPORTED
 
-        # format: {ipaddress.ip_network: [port]}
-        self.allowed_accesses = allowed_accesses
+        # stored GET responses of plain HTTP requests, served without reaching the dest while fresh
+        self.http_cache = http_cache
 
-        # format: {ipaddress.ip_network: [port]}
-        self.blocked_accesses = blocked_accesses
+        # the same plain HTTP GETs at once share one dest fetch, the others stream its response
+        self.coalescer = coalescer
 
-        # format: [{
+        # plain HTTP requests to forwarding and load-balancing backends go as streams of a few h2c connections
+        self.h2c_pool = h2c_pool
+
+        # counters and latency histograms, zoxy.metrics.MetricsServer serves them to Prometheus
+        self.metrics = metrics if metrics is not None else ProxyMetrics()
+
+        # open client connections are limited in total and per client ip, over it they get 503 or 429
+        self.connection_limiter = ConnectionLimiter(max_connections, max_connections_per_ip)
+
+        # accepted connections are served by at most max_workers threads,
+        # on overload they wait up to queue_timeout in the queue or get 503 at once
+        self.worker_pool = ConnectionWorkerPool(
+            self.serve_connection,
+            self.reject_queued_connection,
+            max_workers=max_workers,
+            max_queue=max_queued_connections,
+            queue_timeout=queue_timeout,
+            overload_policy=overload_policy,
+        )
+        self.metrics.connections_open.set_function(lambda: self.connection_limiter.connections)
+        self.metrics.connections_queued.set_function(lambda: self.worker_pool.queued)
+        self.metrics.workers_active.set_function(lambda: self.worker_pool.active)
+
+        # access tables format: {ipaddress.ip_network: [port]}
+        # forwarding list format: [{
         #       "original_ip": ipaddress.ip_network,
         #       "original_port": str,
         #       "destination_ip": str,
         #       "destination_port": str,
         # }]
-        self.forwarding = forwarding
-
-        # fromat: {
+        # load balancing fromat: {
         #     "frontend": {
         #         "ipaddress": ipaddress.ip_network,
         #         "port": str,
@@ -68,7 +151,16 @@ class ProxyServer:
         #         "access_count": int: default 0,
         #     }],
         # }
-        self.load_balancing = load_balancing
+        # rate limits format: [[ip/mask, port, requests per second, bytes per second]], "*" is no limit
+        # client rules match the client ip and dest port, dest rules the dest ip and port, each ip has its own buckets
+        self.apply_settings({
+            "allowed_accesses": allowed_accesses,
+            "blocked_accesses": blocked_accesses,
+            "forwarding": forwarding,
+            "load_balancing": load_balancing,
+            "client_rate_limits": client_rate_limits,
+            "dest_rate_limits": dest_rate_limits,
+        })
 
         socket.setdefaulttimeout(self.__default_socket_timeout)
 
@@ -78,6 +170,9 @@ class ProxyServer:
 
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # several worker processes listen on the port, the kernel spreads connections over them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         self.server_socket.bind((url, port))
         
@@ -89,42 +184,131 @@ class ProxyServer:
             try:
                 (client_socket, client_address) = self.server_socket.accept() 
             except socket.timeout:
+                # no new connection for a while, the expired idle dest connections still get closed
+                self.evict_idle_connections()
                 continue
 
             logger.debug(f"Get new connect: {client_address}")
-
-            client_thread = threading.Thread(
-                name=self._get_client_name(client_address),
-                target=self.proxy_thread,
-                args=(client_socket, client_address)
-            )
-            client_thread.setDaemon(True)
-            client_thread.start()
+            self.metrics.connections_accepted.inc()
+            self.admit_connection(client_socket, client_address)
         self.close()
 
+    def evict_idle_connections(self):
+        self.connection_pool.evict_expired()
+        if self.h2c_pool is not None:
+            self.h2c_pool.evict_expired()
+
+    def admit_connection(self, client_socket: socket.socket, client_address: tuple) -> bool:
+        limit = self.connection_limiter.admit(client_address[0])
+        if limit is not None:
+            logger.warning(f"Connection refused by {limit}: {client_address}")
+            self.metrics.connections_rejected.labels(limit).inc()
+            self._refuse_connection(client_socket, b"429 Too Many Requests" if limit == "max_connections_per_ip" else b"503 Service Unavailable")
+            return False
+        if not self.worker_pool.submit(client_socket, client_address):
+            logger.warning(f"Connection refused, all {self.worker_pool.max_workers} workers busy: {client_address}")
+            self.connection_limiter.release(client_address[0])
+            self.metrics.connections_rejected.labels("overload").inc()
+            self._refuse_connection(client_socket, b"503 Service Unavailable")
+            return False
+        return True
+
+    def serve_connection(self, client_socket: socket.socket, client_address: tuple):
+        try:
+            self.proxy_thread(client_socket, client_address)
+        finally:
+            self.connection_limiter.release(client_address[0])
+
+    def reject_queued_connection(self, client_socket: socket.socket, client_address: tuple):
+        self.metrics.connections_rejected.labels("queue_timeout").inc()
+        try:
+            self._refuse_connection(client_socket, b"503 Service Unavailable")
+        finally:
+            self.connection_limiter.release(client_address[0])
+
+    def _refuse_connection(self, client_socket: socket.socket, status: bytes):
+        self._send_error(client_socket, status)
+        try:
+            client_socket.close()
+        except OSError:
+            pass
+
+    @property
+    def connection_stats(self) -> dict:
+        return {
+            "workers": self.worker_pool.workers,
+            "max_workers": self.worker_pool.max_workers,
+            "active": self.worker_pool.active,
+            "queued": self.worker_pool.queued,
+            "connections": self.connection_limiter.connections,
+            "rejected": self.connection_limiter.rejected + self.worker_pool.rejected,
+            "queue_timeouts": self.worker_pool.queue_timeouts,
+        }
+
     def close(self):
         self.server_socket.close()
+        self.worker_pool.shutdown()
+        self.connection_pool.clear()
+        if self.h2c_pool is not None:
+            self.h2c_pool.clear()
+        health_checker = self.routing.lb_health_checker
+        if health_checker is not None:
+            health_checker.stop()
 
     def proxy_thread(self, src_socket: socket.socket, src_address: tuple):
-        if self.__enable_blocked_access:
-            if self.is_connection_blocked(src_address[0], src_address[1]):
-                logger.warning(f"Blocked client: {src_address}")
-                src_socket.close()
-                return
-        if self.__enable_allowed_access:
-            if not self.is_connection_allowed(src_address[0], src_address[1]):
-                logger.warning(f"Not allowed client: {src_address}")
-                src_socket.close()
-                return
+        # a worker thread serves many connections, reads adapt to this one from the default size
+        vars(self.__recv_sizes).clear()
+        if self.is_client_refused(src_address):
+            src_socket.close()
+            return
 
-        request = b""
-        while True:
+        extra_data = b""
+        request_count = 0
+        keep_alive = True
+        while keep_alive:
+            # the first request gets the read timeout, later ones the keep-alive idle timeout
+            read_timeout = self.__request_read_timeout if request_count == 0 else self.keep_alive_timeout
             try:
-                request += src_socket.recv(self.__max_recv_len)
+                request_reader = self.read_request(src_socket, extra_data, read_timeout)
+            except HTTPHeaderTooLarge as err:
+                logger.warning(f"Request header too large: {src_address}: {err}")
+                self._send_error(src_socket, b"431 Request Header Fields Too Large")
+                break
+            except HTTPBodyTooLarge as err:
+                logger.warning(f"Request body too large: {src_address}: {err}")
+                self._send_error(src_socket, b"413 Content Too Large")
+                break
+            except HTTPParseError as err:
+                logger.warning(f"Bad request: {src_address}: {err}")
+                self._send_error(src_socket, b"400 Bad Request")
+                break
             except socket.timeout:
+                logger.warning(f"Request read timeout: {src_address}")
+                self._send_error(src_socket, b"408 Request Timeout")
+                break
+            if not request_reader.complete:
+                logger.debug(f"Incomplete request: {src_address}")
                 break
+            request, extra_data = request_reader.pop()
+            request_count += 1
+            keep_alive = self.proxy_request(src_socket, src_address, request_reader, request, extra_data)
+            if request_count >= self.max_keep_alive_requests:
+                keep_alive = False
+
+        try:
+            logger.debug("Shutdown src socket")
+            src_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            logger.debug("Close src socket")
+            src_socket.close()
+        except OSError:
+            pass
+
+    def proxy_request(self, src_socket: socket.socket, src_address: tuple, request_reader: HTTPRequestReader, request: bytes, extra_data: bytes) -> bool:
         logger.debug(request)
-        http_request = http_request_parse(request)
+        http_request = request_reader.get_http_request()
         dest_url = http_request.request_target
         logger.info(f"{src_address[0]}:{src_address[1]} -> {dest_url}")
 
@@ -132,72 +316,612 @@ class ProxyServer:
         is_https_tunnel = False
         if http_request.method == "CONNECT":
             is_https_tunnel = True
+        self.metrics.requests.labels("tunnel" if is_https_tunnel else "http").inc()
+
+        cache_lookup = None # type: Optional[CacheLookup]
+        coalescing_key = None # type: Optional[str]
+        if not is_https_tunnel:
+            if self.http_cache is not None:
+                # coalesced misses stream the fetch in flight instead of waiting for it to be stored
+                cache_lookup = self.http_cache.open(http_request.method, dest_url, request_reader.parser.headers, collapse=self.coalescer is None)
+            if self.coalescer is not None:
+                coalescing_key = get_coalescing_key(http_request.method, http_request.http_version, dest_url, request_reader.parser.headers)
+        if cache_lookup is None and coalescing_key is None:
+            return self.forward_request(src_socket, src_address, request_reader, http_request, request, extra_data)
+        try:
+            if cache_lookup is not None and cache_lookup.fresh:
+                # a hit never reaches routing, rate limits or a dest
+                self.metrics.cache_requests.labels("hit").inc()
+                return self.send_cached_response(src_socket, cache_lookup, request_reader.parser.keep_alive)
+            if cache_lookup is not None:
+                # the head of a read request is always complete
+                request = cache_lookup.get_upstream_request(request, request_reader.parser.header_len or 0)
+            if coalescing_key is not None:
+                keep_alive = self.proxy_coalesced_request(src_socket, src_address, request_reader, http_request, request, extra_data, coalescing_key, cache_lookup)
+            else:
+                keep_alive = self.forward_request(src_socket, src_address, request_reader, http_request, request, extra_data, cache_lookup)
+            if cache_lookup is not None:
+                self.metrics.cache_requests.labels("revalidated" if cache_lookup.not_modified else "miss").inc()
+            return keep_alive
+        finally:
+            if cache_lookup is not None:
+                cache_lookup.close()
+
+    def proxy_coalesced_request(
+        self,
+        src_socket: socket.socket,
+        src_address: tuple,
+        request_reader: HTTPRequestReader,
+        http_request: HTTPRequest,
+        request: bytes,
+        extra_data: bytes,
+        coalescing_key: str,
+        cache_lookup: Optional[CacheLookup] = None,
+    ) -> bool:
+        flight, reader = self.coalescer.join(coalescing_key) # type: ignore[union-attr]
+        if reader is not None:
+            self.metrics.coalesced_requests.labels("subscriber").inc()
+            # the client limits hold for a request the dest never sees too
+            allowed, byte_throttle = self.acquire_client_rate_limits(src_address[0], http_request.request_target)
+            if not allowed:
+                reader.close()
+                logger.warning(f"Rate limited: {src_address[0]} -> {http_request.request_target}")
+                self._send_error(src_socket, b"429 Too Many Requests")
+                return False
+            try:
+                keep_alive = self.stream_flight(src_socket, reader, request_reader.parser.keep_alive, byte_throttle)
+            finally:
+                reader.close()
+            if keep_alive is not None:
+                return keep_alive
+            # the fetch ended before its first byte, e.g. the dest refused it,
+            # or its response is for the leader's client only, fetch it again
+            flight, reader = self.coalescer.join(coalescing_key) # type: ignore[union-attr]
+            if reader is not None:
+                reader.close()
+                return self.forward_request(src_socket, src_address, request_reader, http_request, request, extra_data, cache_lookup)
+
+        self.metrics.coalesced_requests.labels("leader").inc()
+        # the fetch fills the buffer at the dest's pace, the leader's client reads it like the others
+        reader = flight.subscribe()
+        sink = FanoutSink(flight, self.__max_header_len)
+        fetch_thread = threading.Thread(
+            name="zoxy-coalesce-fetch",
+            target=self.fetch_flight,
+            args=(sink, src_address, request_reader, http_request, request, extra_data, coalescing_key, cache_lookup),
+            daemon=True,
+        )
+        fetch_thread.start()
+        try:
+            keep_alive = self.stream_flight(src_socket, reader, request_reader.parser.keep_alive, shared=False) # type: ignore[arg-type]
+        finally:
+            reader.close() # type: ignore[union-attr]
+            # the cache lookup is closed after the fetch
+            fetch_thread.join()
+        if keep_alive is None:
+            self._send_error(src_socket, sink.error or b"502 Bad Gateway")
+            return False
+        return keep_alive
+
+    def fetch_flight(
+        self,
+        sink: FanoutSink,
+        src_address: tuple,
+        request_reader: HTTPRequestReader,
+        http_request: HTTPRequest,
+        request: bytes,
+        extra_data: bytes,
+        coalescing_key: str,
+        cache_lookup: Optional[CacheLookup] = None,
+    ):
+        try:
+            self.forward_request(sink, src_address, request_reader, http_request, request, extra_data, cache_lookup) # type: ignore[arg-type]
+        except Exception as err:
+            logger.warning(f"Coalesced fetch error: {err!r}")
+        finally:
+            self.coalescer.finish(coalescing_key, sink.buffer) # type: ignore[union-attr]
+
+    def stream_flight(
+        self,
+        src_socket: socket.socket,
+        reader: FanoutReader,
+        request_keep_alive: bool,
+        byte_throttle: Optional[ByteThrottle] = None,
+        shared: bool = True,
+    ) -> Optional[bool]:
+        # sends the fetched response, None when the fetch ended before sending anything,
+        # or, for a shared reader, when the response is not for other clients
+        on_data = self.__get_on_response_data(src_socket)
+        parser = HTTPParser(self.__max_header_len, is_response=True, request_method="GET")
+        body_reader = None # type: Optional[HTTPBodyReader]
+        head = b""
+        try:
+            while True:
+                data = reader.read(self.__relay_idle_timeout)
+                if not data:
+                    break
+                offset = 0
+                if body_reader is None:
+                    header_len = parser.feed(data)
+                    if header_len is None:
+                        head += data
+                        continue
+                    if shared and not reader.buffer.shared:
+                        return None
+                    body_reader = HTTPBodyReader(parser.framing, parser.content_length)
+                    offset = header_len
+                    data = head + data
+                    offset += len(head)
+                    head = b""
+                body_reader.feed(data, offset)
+                self._send_response(src_socket, data, on_data)
+                if byte_throttle is not None:
+                    pause = byte_throttle(len(data))
+                    if pause > 0:
+                        time.sleep(pause)
+        except FanoutLagError:
+            logger.warning("Coalesced response dropped, too far behind the fetch")
+            self.metrics.coalesced_requests.labels("dropped").inc()
+            return False
+        except OSError as err:
+            logger.debug(f"Coalesced response warning: {err}")
+            return False
+        if body_reader is None:
+            # nothing, or a head cut short
+            return None if not head else False
+        if parser.status_code.startswith("1"):
+            return False
+        if not body_reader.complete:
+            body_reader.feed_eof()
+        return body_reader.complete and parser.keep_alive and request_keep_alive
+
+    def acquire_client_rate_limits(self, client_ip: str, dest_url: str, routing: Optional[RoutingSnapshot] = None) -> Tuple[bool, Optional[ByteThrottle]]:
+        # a request served without a dest: the client rules of its dest port
+        if routing is None:
+            routing = self.routing
+        if not routing.client_rate_limits:
+            return True, None
+        _, dest_port = self._parse_dest_url(dest_url)
+        allowed, byte_limit = routing.client_rate_limits.acquire(client_ip, str(dest_port))
+        return allowed, ByteThrottle([byte_limit]) if byte_limit is not None else None
+
+    def forward_request(
+        self,
+        src_socket: socket.socket,
+        src_address: tuple,
+        request_reader: HTTPRequestReader,
+        http_request: HTTPRequest,
+        request: bytes,
+        extra_data: bytes,
+        cache_lookup: Optional[CacheLookup] = None,
+    ) -> bool:
+        dest_url = http_request.request_target
+        is_https_tunnel = http_request.method == "CONNECT"
 
         # parse url
         dest_domain, dest_port = self._parse_dest_url(dest_url)
         org_dest_domain, org_dest_port = dest_domain, dest_port
+        # the request finishes on these rules even when a reload publishes new ones
+        routing = self.routing
+        lb_lease = None # type: Optional[BackendLease]
+        try:
+            dest_domain, dest_port, dest_ip, lb_lease = self.get_routing_dest(dest_domain, dest_port, src_address[0], routing)
+            if dest_domain is None or dest_port is None:
+                raise OSError(f"No dest host and port in {dest_url}")
+            allowed, byte_throttle = self.acquire_rate_limits(src_address[0], dest_ip, dest_port, routing)
+            if not allowed:
+                logger.warning(f"Rate limited: {src_address[0]} -> {dest_domain}:{dest_port}")
+                self._send_error(src_socket, b"429 Too Many Requests")
+                if lb_lease is not None:
+                    lb_lease.close()
+                return False
+            connect = functools.partial(self.connect_dest, dest_ip=dest_ip, lb_lease=lb_lease)
+            is_backend = lb_lease is not None or (dest_domain, dest_port) != (org_dest_domain, org_dest_port)
+            reused = False
+            if is_https_tunnel:
+                dest_socket = connect(dest_domain, dest_port)
+            elif is_backend and self.is_h2c_request(request_reader):
+                dest_socket = self.open_h2c_stream(dest_domain, dest_port, connect)
+            else:
+                dest_socket, reused = self.connection_pool.checkout(dest_domain, dest_port, connect)
+        except (OSError, UnicodeError) as err:
+            logger.warning(f"Connect dest warning: {dest_domain}:{dest_port}: {err}")
+            self._send_error(src_socket, b"502 Bad Gateway")
+            if lb_lease is not None:
+                lb_lease.close()
+            return False
 
-        if self.__enable_forwarding:
-            dest_domain, dest_port = self.get_forwarding_dest(dest_domain, dest_port)
-
-        if self.__enable_load_balancing:
-            logger.debug(f"Ready to get lock: {dest_domain} {dest_port}")
-            self.__lb_condition_lock.acquire()
-            dest_domain, dest_port = self.get_load_balancing_dest(dest_domain, dest_port)
-            self.__lb_condition_lock.notify()
-            logger.debug(f"Notify: {dest_domain} {dest_port}")
-            self.__lb_condition_lock.release()
-            logger.debug(f"Release: {dest_domain} {dest_port}")
-
-        dest_socket = None
+        keep_alive = False
+        self.__byte_throttle.throttle = byte_throttle
+        self.__response_sent.bytes = 0
         try:
             request = request.replace(f"{org_dest_domain}:{org_dest_port}".encode(), f"{dest_domain}:{dest_port}".encode())
-            dest_socket = self.get_dest_socket(dest_domain, dest_port)
-            self.pipe(src_socket, request, dest_socket, is_https_tunnel)
-        except socket.timeout:
-            pass
+            if is_https_tunnel:
+                # bytes the client sent right after CONNECT belong to the tunnel
+                self.pipe(src_socket, request, dest_socket, is_https_tunnel, extra_data)
+            else:
+                try:
+                    keep_alive = self.exchange(src_socket, dest_socket, request_reader, http_request, request, cache_lookup)
+                except DestClosedError as err:
+                    if not reused and not isinstance(err, H2cStreamRefused):
+                        raise
+                    # the server closed the idle connection while the request was on its way,
+                    # or refused the h2c stream without processing it, once more on a new one
+                    logger.debug(f"Request to {dest_domain}:{dest_port} not processed, retrying: {err}")
+                    dest_socket = self.reopen_dest(dest_socket, dest_domain, dest_port, connect)
+                    keep_alive = self.exchange(src_socket, dest_socket, request_reader, http_request, request, cache_lookup)
+        except DestClosedError as err:
+            logger.warning(f"No response from dest: {dest_domain}:{dest_port}: {err}")
+            self._send_error(src_socket, b"502 Bad Gateway")
+        except HTTPParseError as err:
+            # a malformed or too large response head or body, the client connection ends with it
+            logger.warning(f"Bad response from dest: {dest_domain}:{dest_port}: {err}")
+            keep_alive = False
+            if not self.__response_sent.bytes:
+                self._send_error(src_socket, b"502 Bad Gateway")
+        except OSError as err:
+            logger.debug(f"Pipe warning: {err}")
+        finally:
+            self.__byte_throttle.throttle = None
+            if lb_lease is not None:
+                lb_lease.close()
+            self.finish_dest(dest_socket, dest_domain, dest_port, is_https_tunnel, keep_alive)
+        return keep_alive
+
+    def finish_dest(self, dest_socket: socket.socket, dest_domain: str, dest_port: int, is_https_tunnel: bool, keep_alive: bool):
+        if isinstance(dest_socket, H2cStream):
+            # the connection stays with the h2c pool
+            dest_socket.close()
+            return
+        if not is_https_tunnel:
+            # a dest connection that ended its response cleanly goes back to the pool
+            self.connection_pool.release(dest_domain, dest_port, dest_socket, keep_alive)
+            return
 
         try:
             logger.debug("Shutdown dest socket")
-            if dest_socket:
-                dest_socket.shutdown(socket.SHUT_RDWR)
-        except socket.timeout:
+            dest_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
         try:
             logger.debug("Close dest socket")
-            if dest_socket:
-                dest_socket.close()
-        except socket.timeout:
+            dest_socket.close()
+        except OSError:
             pass
 
+    def reopen_dest(
+        self,
+        dest_socket: socket.socket,
+        dest_domain: str,
+        dest_port: int,
+        connect: Callable[[str, int], socket.socket],
+    ) -> socket.socket:
+        # a new dest connection, or h2c stream, in place of one closed before any response byte
         try:
-            logger.debug("Shutdown src socket")
-            src_socket.shutdown(socket.SHUT_RDWR)
-        except socket.timeout:
+            dest_socket.close()
+        except OSError:
             pass
         try:
-            logger.debug("Close src socket")
-            src_socket.close()
-        except socket.timeout:
+            if isinstance(dest_socket, H2cStream):
+                return self.open_h2c_stream(dest_domain, dest_port, connect)
+            return connect(dest_domain, dest_port)
+        except OSError as err:
+            raise DestClosedError(f"Reconnect failed: {err}") from err
+
+    def open_h2c_stream(self, dest_domain: str, dest_port: int, connect: Callable[[str, int], socket.socket]) -> socket.socket:
+        # an H2cStream, it stands in for the dest socket of one request
+        if self.h2c_pool is None:
+            raise ConnectionRefusedError("Upstream HTTP/2 is not enabled")
+        return self.h2c_pool.open_stream(dest_domain, dest_port, connect) # type: ignore[return-value]
+
+    def exchange(
+        self,
+        src_socket: socket.socket,
+        dest_socket: socket.socket,
+        request_reader: HTTPRequestReader,
+        http_request: HTTPRequest,
+        request: bytes,
+        cache_lookup: Optional[CacheLookup] = None,
+    ) -> bool:
+        # send one request and forward its response, returns whether both connections may be reused
+        if cache_lookup is not None:
+            self.send_request(dest_socket, request)
+            keep_alive = self.pipe_response(src_socket, dest_socket, http_request.method, cache_lookup)
+            if cache_lookup.not_modified:
+                # the 304 answered the validator of the cache, the client gets the stored response
+                self.send_cached_response(src_socket, cache_lookup, request_reader.parser.keep_alive)
+        else:
+            keep_alive = self.pipe(src_socket, request, dest_socket, False, request_method=http_request.method)
+        return keep_alive and request_reader.parser.keep_alive
+
+    def is_h2c_request(self, request_reader: HTTPRequestReader) -> bool:
+        # HTTP/2 carries no chunked bodies and no protocol upgrades, those requests keep HTTP/1.1
+        if self.h2c_pool is None:
+            return False
+        parser = request_reader.parser
+        return parser.framing != FRAMING_CHUNKED and "upgrade" not in parser.connection_tokens
+
+    def connect_dest(self, dest_domain: Optional[str], dest_port: Optional[int], dest_ip: Optional[str] = None, lb_lease: Optional[BackendLease] = None) -> socket.socket:
+        # a new dest connection, its connect latency and errors feed the load-balancing policy and health checker
+        start_time = time.monotonic()
+        try:
+            dest_socket = self.get_dest_socket(dest_domain, dest_port, dest_ip=dest_ip)
+        except OSError:
+            if lb_lease is not None:
+                lb_lease.on_connect_error()
+                self.metrics.backend_errors.labels(lb_lease.backend_name).inc()
+            raise
+        latency = time.monotonic() - start_time
+        self.metrics.upstream_connect_seconds.observe(latency)
+        if lb_lease is not None:
+            lb_lease.on_connect(latency)
+        return dest_socket
+
+    def acquire_rate_limits(self, client_ip: str, dest_ip: str, dest_port: Optional[int], routing: Optional[RoutingSnapshot] = None) -> Tuple[bool, Optional[ByteThrottle]]:
+        # one request: whether the request rate limits allow it, and the throttle its bytes go through
+        if routing is None:
+            routing = self.routing
+        if not (routing.client_rate_limits or routing.dest_rate_limits):
+            return True, None
+        byte_limits = []
+        for rate_limits, ip in ((routing.client_rate_limits, client_ip), (routing.dest_rate_limits, dest_ip)):
+            allowed, byte_limit = rate_limits.acquire(ip, str(dest_port))
+            if not allowed:
+                return False, None
+            if byte_limit is not None:
+                byte_limits.append(byte_limit)
+        return True, ByteThrottle(byte_limits) if byte_limits else None
+
+    def is_client_refused(self, src_address: tuple) -> bool:
+        routing = self.routing
+        if routing.blocked_accesses:
+            if self.is_testee_in_access_index(routing.blocked_access_index, src_address[0], src_address[1]):
+                logger.warning(f"Blocked client: {src_address}")
+                return True
+        if routing.allowed_accesses:
+            if not self.is_testee_in_access_index(routing.allowed_access_index, src_address[0], src_address[1]):
+                logger.warning(f"Not allowed client: {src_address}")
+                return True
+        return False
+
+    def get_routing_dest(
+        self,
+        dest_domain: Optional[str],
+        dest_port: Optional[int],
+        client_ip: Optional[str] = None,
+        routing: Optional[RoutingSnapshot] = None,
+    ) -> Tuple[Optional[str], Optional[int], str, Optional[BackendLease]]:
+        # the name is resolved once per request, routing rules and the dest connection share the address
+        # a returned lease must be closed once the request to the backend is done
+        if routing is None:
+            routing = self.routing
+        dest_ip = self.resolver.resolve(str(dest_domain))
+        lb_lease = None
+        if routing.forwarding_list:
+            org_dest_domain = dest_domain
+            dest_domain, dest_port = self.get_forwarding_dest(dest_domain, dest_port, dest_ip, routing)
+            if dest_domain != org_dest_domain:
+                dest_ip = self.resolver.resolve(str(dest_domain))
+
+        if routing.load_balancing_enabled:
+            org_dest_domain = dest_domain
+            dest_domain, dest_port, lb_lease = self.select_load_balancing_backend(dest_domain, dest_port, dest_ip, client_ip, routing)
+            if dest_domain != org_dest_domain:
+                try:
+                    dest_ip = self.resolver.resolve(str(dest_domain))
+                except BaseException:
+                    if lb_lease is not None:
+                        lb_lease.close()
+                    raise
+        return dest_domain, dest_port, dest_ip, lb_lease
+
+    def read_request(self, src_socket: socket.socket, data: bytes = b"", timeout: Optional[float] = None) -> HTTPRequestReader:
+        # raises socket.timeout once a started request is not complete in time
+        request_reader = HTTPRequestReader(self.__max_header_len, self.max_request_body_len)
+        if data:
+            request_reader.feed(data)
+        deadline = time.monotonic() + (self.__request_read_timeout if timeout is None else timeout)
+        # from the first byte, a keep-alive connection may be idle long before it
+        start_time = time.monotonic() if data else None
+        while not request_reader.complete:
+            try:
+                data = self._recv(src_socket, "request")
+            except socket.timeout:
+                if time.monotonic() >= deadline:
+                    logger.debug("Read request timeout")
+                    if start_time is not None:
+                        raise
+                    break
+                continue
+            if not data:
+                break
+            if start_time is None:
+                start_time = time.monotonic()
+            request_reader.feed(data)
+        if request_reader.complete and start_time is not None:
+            self.metrics.request_read_seconds.observe(time.monotonic() - start_time)
+        return request_reader
+
+    def _send_error(self, src_socket: socket.socket, status: bytes):
+        if isinstance(src_socket, FanoutSink):
+            # a failed fetch: the leader's client gets the error, the others fetch on their own
+            src_socket.error = status
+            return
+        try:
+            src_socket.sendall(b"HTTP/1.1 " + status + b"\r\nConnection: close\r\nContent-Length: 0\r\n\r\n")
+        except OSError:
             pass
 
-    def get_dest_socket(self, dest_domain: Optional[str], dest_port: Optional[int]) -> socket.socket:
+    def get_dest_socket(self, dest_domain: Optional[str], dest_port: Optional[int], dest_ip: Optional[str] = None) -> socket.socket:
         logger.info(f"Get dest {dest_domain}:{dest_port}")
+        if dest_ip is None:
+            dest_ip = self.resolver.resolve(str(dest_domain))
         dest_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        dest_socket.connect((dest_domain, dest_port))
+        dest_socket.connect((dest_ip, dest_port))
         dest_socket.settimeout(self.__dest_connection_timeout)
         return dest_socket
 
-    def pipe(self, src_socket: socket.socket, request: bytes, dest_socket: socket.socket, is_https_tunnel: bool):
+    def pipe(self, src_socket: socket.socket, request: bytes, dest_socket: socket.socket, is_https_tunnel: bool, tunnel_data: bytes = b"", request_method: str = "GET") -> bool:
         if is_https_tunnel:
             src_socket.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
-        else:
-            logger.debug(f"Request: {str(request)}")
+            if tunnel_data:
+                dest_socket.sendall(tunnel_data)
+
+            # pipe data
+            start_time = time.monotonic()
+            response_len = self.pipe_data(src_socket, dest_socket)
+            self.metrics.tunnel_duration_seconds.observe(time.monotonic() - start_time)
+            logger.debug(f"Response: {response_len} bytes")
+            return False
+
+        logger.debug(f"Request: {str(request)}")
+        self.send_request(dest_socket, request)
+        return self.pipe_response(src_socket, dest_socket, request_method)
+
+    @staticmethod
+    def send_request(dest_socket: socket.socket, request: bytes):
+        try:
             dest_socket.sendall(request)
+        except (BrokenPipeError, ConnectionResetError) as err:
+            raise DestClosedError(f"Dest closed the connection before the request was sent: {err}") from err
 
-        # pipe data
-        response_data = self.pipe_data(src_socket, dest_socket)
-        logger.debug(f"Response: {str(response_data)}")
+    def pipe_response(
+        self,
+        src_socket: socket.socket,
+        dest_socket: socket.socket,
+        request_method: str = "GET",
+        cache_lookup: Optional[CacheLookup] = None,
+    ) -> bool:
+        # forward exactly one response, returns whether the client connection may be reused
+        # with a cache lookup the final response is recorded for the cache, and its head sent once complete
+        on_data = self.__get_on_response_data(src_socket)
+
+        # the request was sent right before
+        request_time = time.monotonic() # type: Optional[float]
+        data = b""
+        while True:
+            parser = HTTPParser(self.__max_header_len, is_response=True, request_method=request_method)
+            header_len = None # type: Optional[int]
+            while header_len is None:
+                if not data:
+                    try:
+                        data = self._recv_response(dest_socket)
+                    except ConnectionResetError as err:
+                        if request_time is not None:
+                            raise DestClosedError("Dest reset the connection before responding") from err
+                        raise
+                    if not data:
+                        if request_time is not None:
+                            raise DestClosedError("Dest closed the connection before responding")
+                        return False
+                    if request_time is not None:
+                        self.metrics.time_to_first_byte_seconds.observe(time.monotonic() - request_time)
+                        request_time = None
+                header_len = parser.feed(data)
+                if header_len is None:
+                    if cache_lookup is None:
+                        self._send_response(src_socket, data, on_data)
+                    data = b""
+
+            if parser.status_code == "101":
+                # switching protocols, e.g. websocket, nothing is HTTP after this
+                if cache_lookup is not None:
+                    self._send_response(src_socket, parser.head, on_data)
+                    data = data[header_len:]
+                self._send_response(src_socket, data, on_data)
+                self.pipe_data(src_socket, dest_socket)
+                return False
+
+            is_final = not parser.status_code.startswith("1")
+            recorder = cache_lookup if is_final else None
+            forward = recorder.on_head(parser) if recorder is not None else True
+            body_reader = HTTPBodyReader(parser.framing, parser.content_length)
+            response_end = header_len + body_reader.feed(data, header_len)
+            if cache_lookup is None:
+                self._send_response(src_socket, memoryview(data)[:response_end], on_data)
+            else:
+                body = memoryview(data)[header_len:response_end]
+                if forward:
+                    self._send_response(src_socket, parser.head, on_data)
+                    self._send_response(src_socket, body, on_data)
+                if recorder is not None:
+                    recorder.on_body(body)
+            data = data[response_end:]
+            while not body_reader.complete:
+                data = self._recv_response(dest_socket)
+                if not data:
+                    body_reader.feed_eof()
+                    break
+                response_end = body_reader.feed(data)
+                body = memoryview(data)[:response_end]
+                if forward:
+                    self._send_response(src_socket, body, on_data)
+                if recorder is not None:
+                    recorder.on_body(body)
+                data = data[response_end:]
+            if recorder is not None:
+                recorder.on_end(body_reader.complete)
+
+            if not is_final:
+                # interim response, the final one follows
+                continue
+            logger.debug(f"Response: {parser.status_code} {parser.framing}")
+            return body_reader.complete and parser.keep_alive
+
+    def __get_on_response_data(self, src_socket: socket.socket) -> Optional[Callable[[bytes], None]]:
+        # a fetch is captured by the clients that read it
+        if self.response_capture is None or isinstance(src_socket, FanoutSink):
+            return None
+        return functools.partial(self.response_capture, self._get_peer_address(src_socket))
+
+    def send_cached_response(self, src_socket: socket.socket, cache_lookup: CacheLookup, keep_alive: bool) -> bool:
+        head, body = cache_lookup.get_response(keep_alive)
+        on_data = self.__get_on_response_data(src_socket)
+        try:
+            self._send_response(src_socket, head, on_data)
+            self._send_response(src_socket, body, on_data)
+        except OSError as err:
+            logger.debug(f"Send cached response warning: {err}")
+            return False
+        finally:
+            body.release()
+        return keep_alive
+
+    def _recv_response(self, dest_socket: socket.socket) -> bytes:
+        deadline = time.monotonic() + self.__relay_idle_timeout
+        while True:
+            try:
+                return self._recv(dest_socket, "response")
+            except socket.timeout:
+                if time.monotonic() >= deadline:
+                    raise
+
+    def _recv(self, sock: socket.socket, direction: str) -> bytes:
+        # ask for what this connection's recent reads filled, not __max_recv_len every time
+        buffer_size = getattr(self.__recv_sizes, direction, None)
+        if buffer_size is None:
+            buffer_size = AdaptiveBufferSize(max_len=self.__max_recv_len)
+            setattr(self.__recv_sizes, direction, buffer_size)
+        requested = buffer_size.len
+        data = sock.recv(requested)
+        buffer_size.observe(len(data), requested)
+        if direction == "request":
+            self.metrics.client_bytes_received.inc(len(data))
+        throttle = getattr(self.__byte_throttle, "throttle", None)
+        if throttle is not None and data:
+            pause = throttle(len(data))
+            if pause > 0:
+                time.sleep(pause)
+        return data
+
+    def _send_response(self, src_socket: socket.socket, data: Union[bytes, memoryview], on_data: Optional[Callable[[bytes], None]]):
+        if not data:
+            return
+        src_socket.sendall(data)
+        self.__response_sent.bytes = getattr(self.__response_sent, "bytes", 0) + len(data)
+        self.metrics.client_bytes_sent.inc(len(data))
+        if on_data is not None:
+            on_data(bytes(data))
 
     def shutdown(self, singal_handler: signal.Signals, frame: FrameType):
         self.__listen_flag = False
@@ -207,8 +931,12 @@ class ProxyServer:
         return f"proxy_{address}"
 
     def _parse_dest_url(self, dest_url: str) -> Tuple[Optional[str], Optional[int]]:
-        if "://" not in dest_url and ":443" in dest_url:
-            dest_url = f"https://{dest_url}"
+        if "://" not in dest_url:
+            if ":443" in dest_url:
+                dest_url = f"https://{dest_url}"
+            elif not dest_url.startswith("/"):
+                # CONNECT authority-form, e.g. example.org:8443
+                dest_url = f"//{dest_url}"
 
         uri = urlparse(dest_url)
         logger.debug(uri)
@@ -222,65 +950,116 @@ class ProxyServer:
                 port = 443
         return host, port
 
-    def pipe_data(self, src_socket: socket.socket, dest_socket: socket.socket) -> bytes:
-        response_data = b""
-        count = 0
+    def pipe_data(self, src_socket: socket.socket, dest_socket: socket.socket) -> int:
+        on_dest_data = None
+        if self.response_capture is not None:
+            on_dest_data = functools.partial(self.response_capture, self._get_peer_address(src_socket))
+        throttle = getattr(self.__byte_throttle, "throttle", None) # type: Optional[ByteThrottle]
+        recv_len = throttle.read_len(self.__max_recv_len) if throttle is not None else self.__max_recv_len
+        relay = None # type: Optional[Relay]
+        if self.splice_tunnel and on_dest_data is None:
+            try:
+                relay = SpliceRelay(src_socket, dest_socket, recv_len, self.__max_recv_len, self.__relay_idle_timeout, throttle=throttle)
+            except OSError as err:
+                # e.g. out of file descriptors for its pipes, copy through Python instead
+                logger.debug(f"Splice relay not available: {err}")
+        if relay is None:
+            relay = Relay(src_socket, dest_socket, recv_len, self.__max_recv_len, self.__relay_idle_timeout, on_dest_data, throttle)
         try:
-            while True:
-                d_to_s_response_data = b""
-                s_to_d_response_data = b""
-                try:
-                    d_to_s_response_data = dest_socket.recv(self.__max_recv_len)
-                    src_socket.sendall(d_to_s_response_data)
-                except (socket.error, socket.timeout) as err:
-                    pass
-                try:
-                    s_to_d_response_data = src_socket.recv(self.__max_recv_len)
-                    dest_socket.sendall(s_to_d_response_data)
-                except (socket.error, socket.timeout) as err:
-                    pass
-
-                if d_to_s_response_data != b"":
-                    response_data += d_to_s_response_data
-                if d_to_s_response_data == b"" and s_to_d_response_data == b"":
-                    count += 1
-                    if count >= self.__max_pipe_timeout:
-                        break
-                else:
-                    count = 0
+            relay.run()
         except Exception as err:
             logger.warning(f"Pipe data warning: {err}")
-            response_data = b""
-        
-        return response_data
+
+        self.metrics.client_bytes_received.inc(relay.s_to_d.transferred_len)
+        self.metrics.client_bytes_sent.inc(relay.d_to_s.transferred_len)
+        return relay.d_to_s.transferred_len
+
+    def _get_peer_address(self, sock: socket.socket) -> tuple:
+        try:
+            return sock.getpeername()
+        except OSError:
+            return ()
+
+    @property
+    def routing(self) -> RoutingSnapshot:
+        # read it once and use it for a whole request
+        return self.__routing # type: ignore[return-value]
+
+    @classmethod
+    def build_routing_changes(cls, settings: Dict[str, Any]) -> Dict[str, Any]:
+        # the compiled parts of a snapshot for the given rule sets, raises on any invalid one,
+        # nothing is started so the supervisor validates settings with it too
+        unknown_settings = set(settings) - set(ROUTING_SETTINGS)
+        if unknown_settings:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown_settings))}, expected some of {', '.join(ROUTING_SETTINGS)}")
+        builders = {
+            "allowed_accesses": cls.__build_allowed_accesses,
+            "blocked_accesses": cls.__build_blocked_accesses,
+            "forwarding": cls.__build_forwarding,
+            "load_balancing": cls.__build_load_balancing,
+            "client_rate_limits": cls.__build_client_rate_limits,
+            "dest_rate_limits": cls.__build_dest_rate_limits,
+        } # type: Dict[str, Callable[[Any], Dict[str, Any]]]
+        changes = {} # type: Dict[str, Any]
+        for name, value in settings.items():
+            changes.update(builders[name](value))
+        return changes
+
+    def apply_settings(self, settings: Dict[str, Any]):
+        # build every given rule set first, then publish them in one snapshot swap, settings not given stay
+        changes = self.build_routing_changes(settings)
+        with self.__routing_lock:
+            old_routing = self.__routing
+            changes["settings"] = dict(old_routing.settings) if old_routing is not None else {}
+            for name, value in settings.items():
+                changes["settings"][name] = copy.deepcopy(value)
+            if old_routing is None:
+                routing = RoutingSnapshot(**changes)
+            else:
+                routing = old_routing._replace(**changes)
+            self.__routing = routing
+        old_health_checker = old_routing.lb_health_checker if old_routing is not None else None
+        if old_health_checker is not routing.lb_health_checker:
+            if old_health_checker is not None:
+                old_health_checker.stop()
+            if routing.lb_health_checker is not None:
+                routing.lb_health_checker.start()
 
     @property
     def allowed_accesses(self) -> List[List]:
-        return self.__get_accesses_list(self._allowed_accesses)
+        return self.__get_accesses_list(self.routing.allowed_accesses)
 
     @allowed_accesses.setter
     def allowed_accesses(self, allowed_access: List[List]):
-        allowed_accesses = self.__get_access_table(allowed_access)
+        self.apply_settings({"allowed_accesses": allowed_access})
+
+    @classmethod
+    def __build_allowed_accesses(cls, allowed_access: List[List]) -> Dict[str, Any]:
+        allowed_accesses = cls.__get_access_table(allowed_access)
         logger.debug(f"Initial allowed accessed: {allowed_accesses}")
-        self._allowed_accesses = allowed_accesses
-        if self._allowed_accesses:
-            self.__enable_allowed_access = True
-        else:
-            self.__enable_allowed_access = False
+        return {"allowed_accesses": allowed_accesses, "allowed_access_index": cls.__get_access_index(allowed_accesses)}
+
+    @property
+    def _allowed_accesses(self) -> defaultdict:
+        return self.routing.allowed_accesses
 
     @property
     def blocked_accesses(self) -> List[List]:
-        return self.__get_accesses_list(self._blocked_accesses)
+        return self.__get_accesses_list(self.routing.blocked_accesses)
 
     @blocked_accesses.setter
     def blocked_accesses(self, blocked_access: List[List]):
-        blocked_accesses = self.__get_access_table(blocked_access)
+        self.apply_settings({"blocked_accesses": blocked_access})
+
+    @classmethod
+    def __build_blocked_accesses(cls, blocked_access: List[List]) -> Dict[str, Any]:
+        blocked_accesses = cls.__get_access_table(blocked_access)
         logger.debug(f"Initial blocked accessed: {blocked_accesses}")
-        self._blocked_accesses = blocked_accesses
-        if self._blocked_accesses:
-            self.__enable_blocked_access = True
-        else:
-            self.__enable_blocked_access = False
+        return {"blocked_accesses": blocked_accesses, "blocked_access_index": cls.__get_access_index(blocked_accesses)}
+
+    @property
+    def _blocked_accesses(self) -> defaultdict:
+        return self.routing.blocked_accesses
 
     def __get_accesses_list(self, accesses: defaultdict) -> List[List]:
         accesses_list = []
@@ -290,16 +1069,63 @@ class ProxyServer:
                 accesses_list.append([ip_address_str, port])
         return accesses_list
 
-    def __get_access_table(self, access_list: List[List]) -> defaultdict:
+    @staticmethod
+    def __get_access_table(access_list: List[List]) -> defaultdict:
         accesses = defaultdict(list)
         for ip_adr, port in access_list:
             accesses[ipaddress.ip_network(ip_adr)].append(str(port))
         return accesses
 
+    @staticmethod
+    def __get_access_index(accesses: defaultdict) -> PrefixTable[str]:
+        return PrefixTable(
+            (ip_address, port)
+            for ip_address, port_list in accesses.items()
+            for port in port_list
+        )
+
+    @property
+    def client_rate_limits(self) -> List[List]:
+        return self.routing.client_rate_limits.to_list()
+
+    @client_rate_limits.setter
+    def client_rate_limits(self, client_rate_limits: List[List]):
+        self.apply_settings({"client_rate_limits": client_rate_limits})
+
+    @classmethod
+    def __build_client_rate_limits(cls, client_rate_limits: List[List]) -> Dict[str, Any]:
+        # buckets start full again
+        return {"client_rate_limits": RateLimitTable(client_rate_limits)}
+
+    @property
+    def dest_rate_limits(self) -> List[List]:
+        return self.routing.dest_rate_limits.to_list()
+
+    @dest_rate_limits.setter
+    def dest_rate_limits(self, dest_rate_limits: List[List]):
+        self.apply_settings({"dest_rate_limits": dest_rate_limits})
+
+    @classmethod
+    def __build_dest_rate_limits(cls, dest_rate_limits: List[List]) -> Dict[str, Any]:
+        return {"dest_rate_limits": RateLimitTable(dest_rate_limits)}
+
+    @property
+    def rate_limit_stats(self) -> dict:
+        routing = self.routing
+        client_rate_limits = routing.client_rate_limits
+        dest_rate_limits = routing.dest_rate_limits
+        return {
+            "client_keys": client_rate_limits.keys,
+            "client_limited": client_rate_limits.limited,
+            "dest_keys": dest_rate_limits.keys,
+            "dest_limited": dest_rate_limits.limited,
+            "evictions": client_rate_limits.evictions + dest_rate_limits.evictions,
+        }
+
     @property
     def forwarding(self):
         forwarding = []
-        for forwarding_setting in self._forwarding_list:
+        for forwarding_setting in self.routing.forwarding_list:
             forwarding.append([
                 str(forwarding_setting["original_ip"]),
                 forwarding_setting["original_port"],
@@ -310,6 +1136,10 @@ class ProxyServer:
 
     @forwarding.setter
     def forwarding(self, forwarding: List[List]):
+        self.apply_settings({"forwarding": forwarding})
+
+    @classmethod
+    def __build_forwarding(cls, forwarding: List[List]) -> Dict[str, Any]:
         forwarding_list = []
         for original_ip, original_port, destination_ip, destination_port in forwarding:
             forwarding_list.append({
@@ -319,33 +1149,49 @@ class ProxyServer:
                 "destination_port": str(destination_port),
             })
         logger.debug(f"Initial forwarding list: {forwarding_list}")
-        self._forwarding_list = forwarding_list
-        if self._forwarding_list:
-            self.__enable_forwarding = True
-        else:
-            self.__enable_forwarding = False
+        forwarding_index = FirstMatchTable(
+            (forwarding_setting["original_ip"], forwarding_setting["original_port"], forwarding_setting)
+            for forwarding_setting in forwarding_list
+        )
+        return {"forwarding_list": forwarding_list, "forwarding_index": forwarding_index}
+
+    @property
+    def _forwarding_list(self) -> List[dict]:
+        return self.routing.forwarding_list
 
-    def get_forwarding_dest(self, dest_domain: Optional[str], dest_port: Optional[int]) -> Tuple[Optional[str], Optional[int]]:
-        dest_ip_address = ipaddress.ip_network(socket.gethostbyname(str(dest_domain)))
+    def get_forwarding_dest(
+        self,
+        dest_domain: Optional[str],
+        dest_port: Optional[int],
+        dest_ip: Optional[str] = None,
+        routing: Optional[RoutingSnapshot] = None,
+    ) -> Tuple[Optional[str], Optional[int]]:
+        if routing is None:
+            routing = self.routing
+        if dest_ip is None:
+            dest_ip = self.resolver.resolve(str(dest_domain))
         forwarding_domain, forwarding_port = dest_domain, dest_port
-        for forwarding in self._forwarding_list.copy():
-            original_ip = forwarding["original_ip"]
-            original_port = forwarding["original_port"]
-            destination_ip = forwarding["destination_ip"]
+        forwarding = routing.forwarding_index.lookup(dest_ip, dest_port)
+        if forwarding is not None:
             destination_port = forwarding["destination_port"]
-            if original_ip.supernet_of(dest_ip_address) and (original_port == "*" or str(dest_port) == original_port):
-                if destination_port != "*":
-                    forwarding_port = int(destination_port)
-                forwarding_domain = destination_ip
-                logger.info(f"Forward {dest_domain}:{dest_port} to {forwarding_domain}:{forwarding_port}")
-                break
+            if destination_port != "*":
+                forwarding_port = int(destination_port)
+            forwarding_domain = forwarding["destination_ip"]
+            logger.info(f"Forward {dest_domain}:{dest_port} to {forwarding_domain}:{forwarding_port}")
         return forwarding_domain, forwarding_port
 
     def is_connection_allowed(self, host: str, port: int) -> bool:
-        return self.is_testee_in_access_table(self._allowed_accesses, host, port)
+        return self.is_testee_in_access_index(self.routing.allowed_access_index, host, port)
 
     def is_connection_blocked(self, host: str, port: int) -> bool:
-        return self.is_testee_in_access_table(self._blocked_accesses, host, port)
+        return self.is_testee_in_access_index(self.routing.blocked_access_index, host, port)
+
+    def is_testee_in_access_index(self, access_index: PrefixTable[str], host: str, port: Optional[int]) -> bool:
+        port_str = str(port)
+        for access_port in access_index.lookup(host):
+            if access_port == "*" or access_port == port_str:
+                return True
+        return False
     
     def is_testee_in_access_table(self, accesses: dict, host: str, port: int) -> bool:
         tested_ip_address = ipaddress.ip_network(host)
@@ -362,22 +1208,36 @@ class ProxyServer:
             "frontend": ["", ""],
             "backend": [],
         }
-        if self.__enable_load_balancing:
-            load_balancing["frontend"][0] = str(self._load_balancing["frontend"]["ipaddress"])
-            load_balancing["frontend"][1] = self._load_balancing["frontend"]["port"]
+        routing = self.routing
+        if routing.load_balancing_enabled:
+            load_balancing["frontend"][0] = str(routing.load_balancing["frontend"]["ipaddress"])
+            load_balancing["frontend"][1] = routing.load_balancing["frontend"]["port"]
 
-            for backend_setting in self._load_balancing["backend"]:
+            for backend_setting in routing.load_balancing["backend"]:
                 load_balancing["backend"].append([
                     backend_setting["destination_ip"],
                     backend_setting["destination_port"],
                     str(int(backend_setting["access_rate"] * 100)),
                 ])
+            if routing.lb_policy.name != RatePolicy.name:
+                load_balancing["policy"] = routing.lb_policy.name
+            if routing.lb_hash_key is not None:
+                load_balancing["hash_key"] = routing.lb_hash_key
+            if routing.load_balancing_health_check:
+                load_balancing["health_check"] = dict(routing.load_balancing_health_check)
         return load_balancing
 
     @load_balancing.setter
     def load_balancing(self, load_balancing: LoadBalancingDict):
-        self.__lb_condition_lock.acquire()
-        self._load_balancing = {
+        self.apply_settings({"load_balancing": load_balancing})
+
+    @property
+    def _load_balancing(self) -> SelfLoadBalancingDict:
+        return self.routing.load_balancing
+
+    @classmethod
+    def __build_load_balancing(cls, load_balancing: LoadBalancingDict) -> Dict[str, Any]:
+        load_balancing_setting = {
             "frontend": {
                 "ipaddress": None,
                 "port": "",
@@ -386,56 +1246,98 @@ class ProxyServer:
             ],
         } # type: SelfLoadBalancingDict
         enable_flag = False
-        if load_balancing["frontend"] and load_balancing["frontend"] != ["", ""]:
+        if load_balancing.get("frontend") and list(load_balancing["frontend"]) != ["", ""]:
             enable_flag = True
             # TODO: socket.gethostbyname
-            self._load_balancing["frontend"]["ipaddress"] = ipaddress.ip_network(load_balancing["frontend"][0])
-            self._load_balancing["frontend"]["port"] = load_balancing["frontend"][1]
+            load_balancing_setting["frontend"]["ipaddress"] = ipaddress.ip_network(load_balancing["frontend"][0])
+            load_balancing_setting["frontend"]["port"] = load_balancing["frontend"][1]
 
-        if load_balancing["backend"]:
+        if load_balancing.get("backend"):
             enable_flag = True
             for backend_setting in load_balancing["backend"]:
-                self._load_balancing["backend"].append({
+                load_balancing_setting["backend"].append({
                     "destination_ip": backend_setting[0],
                     "destination_port": backend_setting[1],
                     "access_rate": int(backend_setting[2]) / 100,
                     "access_count": 0,
                 })
 
-        self.__enable_load_balancing = enable_flag
-        self.__lb_condition_lock.notify()
-        self.__lb_condition_lock.release()
+        policy = get_balancing_policy(
+            load_balancing.get("policy", RatePolicy.name),
+            [backend_setting["access_rate"] for backend_setting in load_balancing_setting["backend"]],
+            [f"{backend_setting['destination_ip']}:{backend_setting['destination_port']}" for backend_setting in load_balancing_setting["backend"]],
+        )
+        # the request attribute the hash policy maps to a backend
+        hash_key = load_balancing.get("hash_key")
+        if hash_key is not None and hash_key not in LOAD_BALANCING_HASH_KEYS:
+            raise ValueError(f"Unknown load balancing hash key: {hash_key}, expected one of {', '.join(LOAD_BALANCING_HASH_KEYS)}")
+        frontend_index = PrefixTable() # type: PrefixTable[str]
+        if load_balancing_setting["frontend"]["ipaddress"] is not None:
+            frontend_index = PrefixTable([(load_balancing_setting["frontend"]["ipaddress"], load_balancing_setting["frontend"]["port"])])
+        health_check = HealthCheckDict(**load_balancing.get("health_check", {}))
+        health_checker = None
+        if load_balancing_setting["backend"]:
+            health_checker = HealthChecker(
+                policy,
+                [
+                    (backend_setting["destination_ip"], int(backend_setting["destination_port"]) if backend_setting["destination_port"] != "*" else None)
+                    for backend_setting in load_balancing_setting["backend"]
+                ],
+                **health_check,
+            )
+        # the health checker starts once the snapshot is published
+        return {
+            "load_balancing_enabled": enable_flag,
+            "load_balancing": load_balancing_setting,
+            "load_balancing_health_check": health_check,
+            "lb_frontend_index": frontend_index,
+            "lb_policy": policy,
+            "lb_health_checker": health_checker,
+            "lb_hash_key": hash_key,
+        }
+
+    @property
+    def load_balancing_health(self) -> List[dict]:
+        health_checker = self.routing.lb_health_checker
+        return health_checker.states if health_checker is not None else []
 
-    def get_load_balancing_dest(self, dest_domain: Optional[str], dest_port: Optional[int]) -> Tuple[Optional[str], Optional[int]]:
-        dest_ip_address = ipaddress.ip_network(socket.gethostbyname(str(dest_domain)))
+    def get_load_balancing_dest(self, dest_domain: Optional[str], dest_port: Optional[int], dest_ip: Optional[str] = None) -> Tuple[Optional[str], Optional[int]]:
+        load_balancing_domain, load_balancing_port, lb_lease = self.select_load_balancing_backend(dest_domain, dest_port, dest_ip)
+        if lb_lease is not None:
+            lb_lease.close()
+        return load_balancing_domain, load_balancing_port
+
+    def select_load_balancing_backend(
+        self,
+        dest_domain: Optional[str],
+        dest_port: Optional[int],
+        dest_ip: Optional[str] = None,
+        client_ip: Optional[str] = None,
+        routing: Optional[RoutingSnapshot] = None,
+    ) -> Tuple[Optional[str], Optional[int], Optional[BackendLease]]:
+        if routing is None:
+            routing = self.routing
+        if dest_ip is None:
+            dest_ip = self.resolver.resolve(str(dest_domain))
+        load_balancing_setting = routing.load_balancing
+        frontend_index, policy, health_checker, hash_key = routing.lb_frontend_index, routing.lb_policy, routing.lb_health_checker, routing.lb_hash_key
         load_balancing_domain, load_balancing_port = dest_domain, dest_port
-        if self._load_balancing["frontend"]["ipaddress"] is not None and self._load_balancing["frontend"]["ipaddress"].supernet_of(dest_ip_address) and (
-            self._load_balancing["frontend"]["port"] == "*" or str(dest_port) == self._load_balancing["frontend"]["port"]
-        ):
-            backend_access_count = [backend_setting["access_count"] for backend_setting in self._load_balancing["backend"]]
-            backend_access_rate = [backend_setting["access_rate"] for backend_setting in self._load_balancing["backend"]]
-            backend_index = self.distribute_backend(backend_access_count, backend_access_rate)
-            load_balancing_domain = self._load_balancing["backend"][backend_index]["destination_ip"]
-            destination_port = self._load_balancing["backend"][backend_index]["destination_port"]
+        lb_lease = None
+        if len(policy) and self.is_testee_in_access_index(frontend_index, dest_ip, dest_port):
+            # the client address unless hash_key says host, only the hash policy uses it
+            key = str(dest_domain).lower() if hash_key == "host" else client_ip
+            backend_index = policy.select(key)
+            lb_lease = BackendLease(policy, backend_index, health_checker)
+            self.metrics.backend_selections.labels(lb_lease.backend_name).inc()
+            backend_setting = load_balancing_setting["backend"][backend_index]
+            load_balancing_domain = backend_setting["destination_ip"]
+            destination_port = backend_setting["destination_port"]
             if destination_port != "*":
                 load_balancing_port = int(destination_port)
-            self._load_balancing["backend"][backend_index]["access_count"] += 1
+            # only a statistic, concurrent requests may lose an increment
+            backend_setting["access_count"] += 1
         logger.info(f"Load balancing {dest_domain}:{dest_port} to {load_balancing_domain}:{load_balancing_port}")
-        return load_balancing_domain, load_balancing_port
+        return load_balancing_domain, load_balancing_port, lb_lease
 
     def distribute_backend(self, backend_access_count: List, backend_access_rate: List) -> int:
-        total_backend_access = sum(backend_access_count)
-        min_rate_diff = float("-inf")
-        min_rate_diff_index = -1
-        for index, (current_backend_access_count, current_backend_access_rate) in enumerate(zip(backend_access_count, backend_access_rate)):
-            if total_backend_access != 0 and current_backend_access_count != 0:
-                rate = current_backend_access_count / total_backend_access
-                rate_diff = current_backend_access_rate - rate
-            else:
-                rate_diff = float("inf")
-            if rate_diff > min_rate_diff:
-                min_rate_diff = rate_diff
-                min_rate_diff_index = index
-
-        return min_rate_diff_index
-        
\ No newline at end of file
+        return distribute_backend(backend_access_count, backend_access_rate)
@@ -0,0 +1,42 @@
+from collections import defaultdict
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from .balancing import BalancingPolicy
+from .health import HealthChecker
+from .ratelimit import RateLimitTable
+from .routing import FirstMatchTable, PrefixTable
+from .typings import HealthCheckDict, SelfLoadBalancingDict
+
+# the rule sets a config file sets, and a reload replaces
+ROUTING_SETTINGS = (
+    "allowed_accesses",
+    "blocked_accesses",
+    "forwarding",
+    "load_balancing",
+    "client_rate_limits",
+    "dest_rate_limits",
+)
+
+
+class RoutingSnapshot(NamedTuple):
+    # every rule set a request is routed by, compiled and never changed in place,
+    # a new one replaces it whole so a request sees the old or the new rules, never a mix
+    # the settings each part was built from, by name in ROUTING_SETTINGS
+    settings: Dict[str, Any]
+    # format: {ipaddress.ip_network: [port]}
+    allowed_accesses: defaultdict
+    allowed_access_index: PrefixTable[str]
+    blocked_accesses: defaultdict
+    blocked_access_index: PrefixTable[str]
+    forwarding_list: List[dict]
+    forwarding_index: FirstMatchTable[dict]
+    load_balancing_enabled: bool
+    # only the backend access_count statistics change
+    load_balancing: SelfLoadBalancingDict
+    load_balancing_health_check: HealthCheckDict
+    lb_frontend_index: PrefixTable[str]
+    lb_policy: BalancingPolicy
+    lb_health_checker: Optional[HealthChecker]
+    lb_hash_key: Optional[str]
+    client_rate_limits: RateLimitTable
+    dest_rate_limits: RateLimitTable
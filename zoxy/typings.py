@@ -10,7 +10,23 @@ try:
 except ImportError:
     from mypy_extensions import TypedDict # <=3.7
 
-class LoadBalancingDict(TypedDict):
+class HealthCheckDict(TypedDict, total=False):
+    probe: str
+    interval: float
+    timeout: float
+    path: str
+    healthy_threshold: int
+    unhealthy_threshold: int
+    consecutive_errors: int
+    ejection_time: float
+    max_ejection_time: float
+
+class LoadBalancingOptionsDict(TypedDict, total=False):
+    policy: str
+    hash_key: str
+    health_check: HealthCheckDict
+
+class LoadBalancingDict(LoadBalancingOptionsDict):
     frontend: Tuple[str, str]
     backend: List[Tuple[str, str, str]]
 
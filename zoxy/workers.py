@@ -0,0 +1,219 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
+import threading
+import time
+from types import FrameType
+from typing import Any, Dict, List, Optional, Type
+
+from .server import ProxyServer
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(server_class: Type[ProxyServer], config: dict, control: multiprocessing.connection.Connection):
+    if hasattr(signal, "SIGHUP"):
+        # the supervisor reloads the config file and sends the settings
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    proxy_server = server_class(**config, reuse_port=True)
+    threading.Thread(name="zoxy-worker-control", target=apply_settings, args=(proxy_server, control), daemon=True).start()
+    proxy_server.listen()
+
+
+def apply_settings(proxy_server: ProxyServer, control: multiprocessing.connection.Connection):
+    while True:
+        try:
+            name, value = control.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            if name == "settings":
+                proxy_server.apply_settings(value)
+            else:
+                setattr(proxy_server, name, value)
+        except Exception as err:
+            logger.warning(f"Worker setting {name} failed: {err}")
+
+
+class Worker:
+    def __init__(self, process: multiprocessing.process.BaseProcess, control: multiprocessing.connection.Connection):
+        self.process = process
+        self.control = control
+        self.start_time = time.monotonic()
+
+
+class WorkerSupervisor:
+    # forks worker processes that each listen on the same port with SO_REUSEPORT, restarts the ones that die
+    def __init__(self, workers: int, server_class: Type[ProxyServer] = ProxyServer, restart_delay: float = 1, **config: Any):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise OSError("Worker processes need SO_REUSEPORT, which this platform does not support")
+        self.worker_count = workers
+        self.server_class = server_class
+        # a worker dying sooner than this after its start is restarted only after this delay
+        self.restart_delay = restart_delay
+        self.config = dict(config)
+        self.workers = [] # type: List[Optional[Worker]]
+        self.restarts = 0
+        self.__context = multiprocessing.get_context("fork")
+        self.__stop_flag = False
+        self.__lock = threading.Lock()
+        self.__port_socket = None # type: Optional[socket.socket]
+
+    @property
+    def port(self) -> int:
+        return self.config["port"]
+
+    def start(self):
+        # a bound socket that never listens keeps the port, port 0 included, for workers started later
+        self.__port_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__port_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__port_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.__port_socket.bind((self.config["url"], self.config["port"]))
+        self.config["port"] = self.__port_socket.getsockname()[1]
+        logger.info(f"Proxy server: {self.config['url']}:{self.port} with {self.worker_count} workers")
+        with self.__lock:
+            self.workers = [self.__spawn() for _ in range(self.worker_count)]
+
+    def listen(self):
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        self.start()
+        try:
+            self.supervise()
+        finally:
+            self.close()
+
+    def supervise(self):
+        while not self.__stop_flag:
+            with self.__lock:
+                sentinels = [worker.process.sentinel for worker in self.workers if worker is not None and worker.process.is_alive()]
+            if sentinels:
+                multiprocessing.connection.wait(sentinels, timeout=self.restart_delay)
+            else:
+                time.sleep(self.restart_delay)
+            if self.__stop_flag:
+                break
+            with self.__lock:
+                for index, worker in enumerate(self.workers):
+                    if worker is None or worker.process.is_alive():
+                        continue
+                    if time.monotonic() - worker.start_time < self.restart_delay:
+                        # crashing right after its start, wait before forking it again
+                        continue
+                    logger.warning(f"Worker {worker.process.pid} exited with {worker.process.exitcode}, restarting")
+                    worker.control.close()
+                    self.workers[index] = self.__spawn()
+                    self.restarts += 1
+
+    def close(self):
+        self.__stop_flag = True
+        with self.__lock:
+            workers = [worker for worker in self.workers if worker is not None]
+            self.workers = []
+        for worker in workers:
+            worker.process.terminate()
+        for worker in workers:
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+            worker.control.close()
+        if self.__port_socket is not None:
+            self.__port_socket.close()
+            self.__port_socket = None
+
+    def shutdown(self, singal_handler: signal.Signals, frame: Optional[FrameType]):
+        self.__stop_flag = True
+
+    def pids(self) -> List[int]:
+        with self.__lock:
+            return [worker.process.pid for worker in self.workers if worker is not None and worker.process.pid is not None]
+
+    def __spawn(self) -> Worker:
+        receiver, sender = self.__context.Pipe(duplex=False)
+        process = self.__context.Process(
+            name="zoxy-worker",
+            target=run_worker,
+            args=(self.server_class, self.config, receiver),
+            daemon=True,
+        )
+        process.start()
+        receiver.close()
+        return Worker(process, sender)
+
+    def __set_runtime_setting(self, name: str, value: Any):
+        # workers started later get it from config, running ones through their control pipe
+        self.server_class.build_routing_changes({name: value})
+        with self.__lock:
+            self.config[name] = value
+            for worker in self.workers:
+                if worker is None:
+                    continue
+                try:
+                    worker.control.send((name, value))
+                except OSError as err:
+                    logger.debug(f"Worker {worker.process.pid} setting {name} not sent: {err}")
+
+    def apply_settings(self, settings: Dict[str, Any]):
+        # every worker swaps in all the settings at once, like ProxyServer.apply_settings,
+        # invalid settings raise here and reach no worker
+        self.server_class.build_routing_changes(settings)
+        with self.__lock:
+            self.config.update(settings)
+            for worker in self.workers:
+                if worker is None:
+                    continue
+                try:
+                    worker.control.send(("settings", settings))
+                except OSError as err:
+                    logger.debug(f"Worker {worker.process.pid} settings not sent: {err}")
+
+    @property
+    def allowed_accesses(self) -> List[List]:
+        return self.config.get("allowed_accesses", [])
+
+    @allowed_accesses.setter
+    def allowed_accesses(self, allowed_accesses: List[List]):
+        self.__set_runtime_setting("allowed_accesses", allowed_accesses)
+
+    @property
+    def blocked_accesses(self) -> List[List]:
+        return self.config.get("blocked_accesses", [])
+
+    @blocked_accesses.setter
+    def blocked_accesses(self, blocked_accesses: List[List]):
+        self.__set_runtime_setting("blocked_accesses", blocked_accesses)
+
+    @property
+    def forwarding(self) -> List[List]:
+        return self.config.get("forwarding", [])
+
+    @forwarding.setter
+    def forwarding(self, forwarding: List[List]):
+        self.__set_runtime_setting("forwarding", forwarding)
+
+    @property
+    def client_rate_limits(self) -> List[List]:
+        return self.config.get("client_rate_limits", [])
+
+    @client_rate_limits.setter
+    def client_rate_limits(self, client_rate_limits: List[List]):
+        self.__set_runtime_setting("client_rate_limits", client_rate_limits)
+
+    @property
+    def dest_rate_limits(self) -> List[List]:
+        return self.config.get("dest_rate_limits", [])
+
+    @dest_rate_limits.setter
+    def dest_rate_limits(self, dest_rate_limits: List[List]):
+        self.__set_runtime_setting("dest_rate_limits", dest_rate_limits)
+
+    @property
+    def load_balancing(self) -> Dict:
+        return self.config.get("load_balancing", {"frontend": ["", ""], "backend": []})
+
+    @load_balancing.setter
+    def load_balancing(self, load_balancing: Dict):
+        self.__set_runtime_setting("load_balancing", load_balancing)